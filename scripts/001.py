@@ -3,9 +3,10 @@
 # Fetch all past and future observations, combine into .csv files, filter to valid calibration solutions and fetch their .jsons
 ################################################################################
 
-import json, requests, itertools, csv, time
-from datetime import datetime
+import csv, time, os
 from pathlib import Path
+from doctor import fetch, paging, merge, storage, logs, shards
+from doctor.catalogue import Catalogue
 
 ################################################################################
 # Paths and Constants
@@ -15,21 +16,31 @@ from pathlib import Path
 REFRESH_PAST = False             # Fetch the latest pages of past observations
 REFRESH_FUTURE = False           # Fetch ALL pages of future observations
 
+PAGE_WORKERS = 4        # Maximum number of pages to fetch at the same time
+PAGE_RETRIES = 5        # Number of times to retry a page before giving up (the next run resumes from it)
+PAGE_BACKOFF = 2        # Seconds to wait after the first server error (doubles while errors continue)
+
 REFRESH_CSV = False              # Update future.csv and past.csv based on the pages found above
 REFRESH_CALIBS = False           # Populate calibrations.csv with the calibration observations in past.csv
 
 FETCH_FITS = True             # Attempt to fetch the .json for each observation id in calibrations.csv
-FORCE_RETRY_FITS = False      # By default, fits that are known to not exist (from past requests) are skipped automatically. TRUE to override this behaviour.
+FORCE_RETRY_FITS = False      # By default, fits that are known to not exist (from past requests) are skipped until they are due a retry (below). TRUE to retry them all now.
+
+RETRY_AGE_FRACTION = 0.1        # A missing fit is retried after this fraction of the observation's age (new observations get solutions soon, old ones rarely do)...
+RETRY_MIN = 6 * 3600            # ...but no sooner than this (seconds)...
+RETRY_MAX = 180 * 24 * 3600     # ...and no later than this. The wait doubles with every further 404.
+
+FETCH_WORKERS = 8       # Number of fits to fetch at the same time
+FETCH_RETRIES = 3       # Number of times to retry a fit after an internal server error
+FETCH_BACKOFF = 2       # Seconds to wait before the first retry (doubles after each retry)
 
 ################
 
-LOGS = Path("logging/001/")
 OUTPUT = Path("output/001/")
 ALL_PAST_OBSERVATIONS = OUTPUT / "past/"
 ALL_FUTURE_OBSERVATIONS = OUTPUT / "future/"
 ALL_CALIBRATIONS = OUTPUT / "calibrations/"
 
-LOGS.mkdir(parents=True, exist_ok=True)
 OUTPUT.mkdir(parents=True, exist_ok=True)
 ALL_PAST_OBSERVATIONS.mkdir(parents=True, exist_ok=True)
 ALL_FUTURE_OBSERVATIONS.mkdir(parents=True, exist_ok=True)
@@ -38,56 +49,36 @@ ALL_CALIBRATIONS.mkdir(parents=True, exist_ok=True)
 PAST_COMBINED = OUTPUT / "past.csv"
 FUTURE_COMBINED = OUTPUT / "future.csv"
 CALIBRATIONS = OUTPUT / "calibrations.csv"
-MISSING = OUTPUT / "missing.csv"
+MISSING = OUTPUT / "missing.csv"    # Only read, to import into the catalogue
+PAST_CHECKPOINT = OUTPUT / "past_checkpoint.json"
+FUTURE_CHECKPOINT = OUTPUT / "future_checkpoint.json"
+PAST_MANIFEST = OUTPUT / "past_manifest.json"
+FUTURE_MANIFEST = OUTPUT / "future_manifest.json"
+CALIBRATIONS_MANIFEST = OUTPUT / "calibrations_manifest.json"
 
 # Create log file
-LOG_START = datetime.now()
-LOG_FILE = LOGS / f"log_{LOG_START.strftime("%Y-%m-%dT%H-%M-%S")}.txt"
-with open(LOG_FILE, "a") as f:
-    f.write(f"({LOG_START.strftime("%Y-%m-%d %H-%M-%S")}) Starting...\n")
-    print(f"({LOG_START.strftime("%Y-%m-%d %H-%M-%S")}) Starting...")
-
-################################################################################
-# Helper functions
-################################################################################
-
-def log(message):
-    time_tag = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-    with open(LOG_FILE, "a") as f:
-        f.write(f"({time_tag}) {message}\n")
-        print(f"({time_tag}) {message}")
+LOGGER = logs.setup("001")
+log = LOGGER.info
 
 ################################################################################
 # Web service functions (this is only used to fetch all past and future observations)
 ################################################################################
 
 def update(start_page = 1, future = 0):
-    # this sometimes gives a random error... maybe from reading too fast? just restart from the last successful page and it should work
-    if future: output_folder = ALL_FUTURE_OBSERVATIONS
-    else: output_folder = ALL_PAST_OBSERVATIONS
-
-    for i in itertools.count(start_page, 1):
-        log(f"Fetching page {i}...")
-        payload = {"page": i, "future": future}
-        r = requests.get('https://ws.mwatelescope.org/metadata/find', params=payload)
-        observations = r.json()
-
-        # End on empty response
-        if not observations:
-            log(f"Failed to fetch page {i}!")
-            break
-
-        output_path = Path(output_folder / f"results{i:04d}.json")
-        with open(output_path, 'w') as f:
-            json.dump(observations, f, indent=4)
+    # Interrupted or failed runs pick up from the checkpoint, so just run this again
+    if future: output_folder, checkpoint = ALL_FUTURE_OBSERVATIONS, FUTURE_CHECKPOINT
+    else: output_folder, checkpoint = ALL_PAST_OBSERVATIONS, PAST_CHECKPOINT
+
+    finished = paging.fetch_pages(output_folder, checkpoint, start_page, future, workers=PAGE_WORKERS, retries=PAGE_RETRIES, backoff=PAGE_BACKOFF, log=log)
+    if not finished:
+        log(f"Stopped before the last page!")
         
 ################################################################################
 # Fetch required .json files for all past and future observations
 ################################################################################
 
 # For past observations, get the latest page of results and fetch from that point
-if REFRESH_PAST:
+def refresh_past():
     latest_past = sorted(set(ALL_PAST_OBSERVATIONS.glob("*.json")))
     try: page = int(str(latest_past[-1]).split("past/results")[1].split(".json")[0])   # idk
     except: page = 1
@@ -97,7 +88,7 @@ if REFRESH_PAST:
     log(f"Done!")
 
 # For future observations, fetch everything as they change from page 1
-if REFRESH_FUTURE:
+def refresh_future():
     log(f"Updating future observations...")
     update(1, 1)
     log(f"Done!")
@@ -106,47 +97,47 @@ if REFRESH_FUTURE:
 # Combine each set of observations into a single past/future .csv file
 ################################################################################
 
-if REFRESH_PAST or REFRESH_CSV:
+# Only pages that are new or have changed since the last run are read, the rest are copied from the existing .csv
+def combine_past():
     log(f"Combining past observations into past.csv...")
-    with PAST_COMBINED.open("w", newline="", encoding="utf-8") as csv_output:
-        writer = csv.writer(csv_output)
-        for page in sorted(ALL_PAST_OBSERVATIONS.glob("*.json"), reverse=True):
-            with page.open("r", encoding="utf-8") as f:
-                data = json.load(f)
-                for row in data: writer.writerow(row)
-        log(f"Done!")
-
-if REFRESH_FUTURE or REFRESH_CSV:
+    changed = merge.merge_pages(ALL_PAST_OBSERVATIONS, PAST_COMBINED, PAST_MANIFEST)
+    log(f"Done! ({len(changed)} new or changed pages)")
+
+    log(f"Adding new past observations to the catalogue...")
+    catalogue = Catalogue()
+    if not catalogue.count("project IS NOT NULL"):
+        changed = [page.name for page in ALL_PAST_OBSERVATIONS.glob("results*.json")]
+    catalogue.add_observations(merge.read_rows(PAST_COMBINED, PAST_MANIFEST, changed))
+    log(f"Done!")
+
+def combine_future():
     log(f"Combining future observations into future.csv...")
-    with FUTURE_COMBINED.open("w", newline="", encoding="utf-8") as csv_output:
-        writer = csv.writer(csv_output)
-        for page in sorted(ALL_FUTURE_OBSERVATIONS.glob("*.json"), reverse=True):
-            with page.open("r", encoding="utf-8") as f:
-                data = json.load(f)
-                for row in data: writer.writerow(row)
-        log(f"Done!")
+    changed = merge.merge_pages(ALL_FUTURE_OBSERVATIONS, FUTURE_COMBINED, FUTURE_MANIFEST)
+    log(f"Done! ({len(changed)} new or changed pages)")
 
 ################################################################################
 # Filter past.csv to calibrations.csv, which contains only observations with project code D0006
 ################################################################################
 
-if REFRESH_CALIBS:
+def retry_due(obs_id, last_tried, attempts, now):
+    # obs_ids are GPS seconds. GPS time is unix time less 315964800 (the GPS epoch), plus 18 leap seconds.
+    age = max(0, now - 315964800 + 18 - int(obs_id))
+    wait = min(RETRY_MAX, max(RETRY_MIN, age * RETRY_AGE_FRACTION) * 2 ** (attempts - 1))
+    return now - last_tried >= wait
+
+def is_calibration(row):
+    return row[3].strip() == "D0006"
+
+def refresh_calibs():
     log(f"Finding calibration observations in past.csv...")
-    with PAST_COMBINED.open("r", newline="", encoding="utf-8") as observations:
-        with CALIBRATIONS.open("w", newline="", encoding="utf-8") as calibrations:
-            reader = csv.reader(observations)
-            writer = csv.writer(calibrations)
-
-            for row in reader:
-                isCalibration = (row[3].strip() == "D0006")
-                if isCalibration: writer.writerow(row)
-    log(f"Done!")
+    changed = merge.filter_pages(PAST_COMBINED, PAST_MANIFEST, CALIBRATIONS, CALIBRATIONS_MANIFEST, is_calibration)
+    log(f"Done! ({len(changed)} new or changed pages)")
 
 ################################################################################
 # Fetch .json for all calibration fits that exist among each calibration observation
 ################################################################################
 
-if FETCH_FITS:
+def fetch_fits():
     skipped_exist = 0       # we already have these 
     skipped_nonexist = 0    # these do not exist
 
@@ -156,22 +147,33 @@ if FETCH_FITS:
         calib_number = calib.name.split("fit_")[1].split(".")[0]
         existing_calibs.add(calib_number)
 
-    log(f"Checking known missing fits...")
-    missing_fits = set()
-    try:
+    catalogue = Catalogue()
+    catalogue.set_fits(existing_calibs)
+
+    # missing.csv (one line per 404, never deduplicated) is replaced by the not_found table of the catalogue.
+    # Its ids are imported once, as last tried when the file was last written.
+    if MISSING.exists():
+        log(f"Importing {MISSING} into the catalogue...")
         with open(MISSING, 'r') as f:
-            for line in f:
-                missing_fit_id = line.strip()
-                missing_fits.add(missing_fit_id)
-    except:
-        log("Missing fits file does not exist. Skipping...")
-        pass
-
-    log(f"Fetching data from all calibrations...")
+            ids = {line.strip() for line in f if line.strip()}
+        catalogue.set_not_found(ids, os.path.getmtime(MISSING), attempts=1)
+        MISSING.replace(MISSING.with_suffix(".csv.imported"))
+
+    log(f"Checking known missing fits...")
+    now = time.time()
+    missing_fits = {str(obs_id) for obs_id, (last_tried, attempts) in catalogue.not_found().items()
+                    if not retry_due(obs_id, last_tried, attempts, now)}
+
+    log(f"Finding fits to fetch...")
+    to_fetch = []
     with CALIBRATIONS.open("r", newline="", encoding="utf-8") as calibrations:
         reader = csv.reader(calibrations)
         for row in reader:
             id = row[0].strip()
+
+            # Left to another shard (see shards)
+            if not shards.mine(id):
+                continue
             
             # Do not fetch fits we already have
             if id in existing_calibs:
@@ -179,28 +181,53 @@ if FETCH_FITS:
                 skipped_exist += 1
                 continue
 
-            # Do not fetch fits we know do not exist
+            # Do not fetch fits we know do not exist (until they are due a retry)
             if (id in missing_fits) and (not FORCE_RETRY_FITS):
                 # log(f"Skipping {id} as record is known to not exist...")
                 skipped_nonexist += 1
                 continue
 
-            # Fetch the fit associated with the given obs_id
-            payload = {"obs_id": id}
-            r = requests.get("https://ws.mwatelescope.org/calib/get_cal_json", params=payload)
-
-            match r.status_code:
-                case 400: log(f"Faulty request for {id}! Skipping...")
-                case 500: log(f"Internal server error for {id}! Skipping...")
-                case 404:
-                    with open(MISSING, 'a') as f: f.write(f"{id}\n")
-                    log(f"No fit found for {id}! Skipping...")
-                case _:
-                    fit = r.json()
-                    log(f"Fetched fit for {id}...")
-                    with open(Path(ALL_CALIBRATIONS / f"fit_{id}.json"), 'w') as f:
-                        json.dump(fit, f, indent=4)
+            to_fetch.append(id)
+
+    # Fetch the fit associated with each obs_id, several at a time over a shared connection pool
+    log(f"Fetching data from {len(to_fetch)} calibrations...")
+    fetched = []
+    not_found = []
+    results = fetch.fetch_many("/calib/get_cal_json", to_fetch, workers=FETCH_WORKERS, retries=FETCH_RETRIES, backoff=FETCH_BACKOFF, log=log)
+    for id, r in results:
+        if isinstance(r, Exception):
+            log(f"Could not connect for {id} ({r})! Skipping...")
+            continue
+
+        match r.status_code:
+            case 400: log(f"Faulty request for {id}! Skipping...")
+            case 500: log(f"Internal server error for {id}! Skipping...")
+            case 404:
+                not_found.append(id)
+                LOGGER.debug(f"No fit found for {id}! Skipping...")
+            case _:
+                fit = r.json()
+                LOGGER.debug(f"Fetched fit for {id}...")
+                storage.write(ALL_CALIBRATIONS / f"fit_{id}.json", fit)
+                fetched.append(id)
+
+    catalogue.set_fits(fetched)
+    catalogue.set_not_found(not_found, time.time())
+    catalogue.clear_not_found(fetched)
 
     log(f"Skipped {skipped_exist} fits as records already exist...")
-    log(f"Skipped {skipped_nonexist} fits as records are known to not exist...")
-    log(f"Done!")
\ No newline at end of file
+    log(f"Skipped {skipped_nonexist} fits as records are known to not exist (not due a retry)...")
+    log(f"{len(not_found)} fits were not found...")
+    log(f"Done!")
+
+################################################################################
+# Run the steps selected at the top of this file (run.py instead runs only the steps whose inputs have changed)
+################################################################################
+
+if __name__ == "__main__":
+    if REFRESH_PAST: refresh_past()
+    if REFRESH_FUTURE: refresh_future()
+    if REFRESH_PAST or REFRESH_CSV: combine_past()
+    if REFRESH_FUTURE or REFRESH_CSV: combine_future()
+    if REFRESH_CALIBS: refresh_calibs()
+    if FETCH_FITS: fetch_fits()
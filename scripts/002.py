@@ -3,116 +3,275 @@
 # Fetch observation .json files for each valid calibration and sort them by calibrator
 ################################################################################
 
-import json, requests, itertools, csv, shutil
-from datetime import datetime
+import itertools, shutil, os, time
 from pathlib import Path
+from doctor.cube import GainsCube, record
+from doctor.trends import TrendStore
+from doctor.catalogue import Catalogue
+from doctor.files import link
+from doctor import fetch, storage, logs, shards
 
 ################################################################################
 # Paths and Constants
 ################################################################################
 
 THRESHOLD = 1000  # Minimum number of observations for a calibrator to be added to the list.
+                  # Calibrator folders only hold links to the files in fits/ and observations/, so changing this is cheap.
+
+METADATA_WORKERS = 8    # Number of observations to fetch metadata for at the same time
+METADATA_RETRIES = 3    # Number of times to retry after an internal server error or dropped connection
+METADATA_BACKOFF = 2    # Seconds to wait before the first retry (doubles after each retry)
 
 ################
 
-LOGS = Path("logging/002/")
 OUTPUT = Path("output/002/")
 FITS = OUTPUT / "fits/"
 OBSERVATIONS = OUTPUT / "observations/"
 CALIBRATORS = OUTPUT / "calibrators/"
+CUBE = OUTPUT / "cube/"
+TRENDS = OUTPUT / "trends/"
+
+SOLUTIONS = Path("output/001/") / "calibrations"
 
-LOGS.mkdir(parents=True, exist_ok=True)
 OUTPUT.mkdir(parents=True, exist_ok=True)
 FITS.mkdir(parents=True, exist_ok=True)
 OBSERVATIONS.mkdir(parents=True, exist_ok=True)
 CALIBRATORS.mkdir(parents=True, exist_ok=True)
 
 # Create log file
-LOG_START = datetime.now()
-LOG_FILE = LOGS / f"log_{LOG_START.strftime("%Y-%m-%dT%H-%M-%S")}.txt"
-with open(LOG_FILE, "a") as f:
-    f.write(f"({LOG_START.strftime("%Y-%m-%d %H-%M-%S")}) Starting...\n")
-    print(f"({LOG_START.strftime("%Y-%m-%d %H-%M-%S")}) Starting...")
+LOGGER = logs.setup("002")
+log = LOGGER.info
 
 ################################################################################
-# Helper functions
+# Copy over the calibration solutions from 001 where we have valid metadata
 ################################################################################
 
-def log(message):
-    time_tag = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+def problem(metadata):
+    # What is missing from a /metadata/obs response that 002 and 003 need, or None if nothing is
+    try:
+        metadata["metadata"]["calibrators"]
+        metadata["rfstreams"]["0"]["frequencies"]
+        metadata["rfstreams"]["0"]["tileset"]["xlist"]
+    except (KeyError, TypeError) as e:
+        return f"missing field {e}"
+    return None
+
+def fill(metadata, obs_id, listed):
+    # The start time and project are already known from past.csv (through the catalogue), so they do not have to come
+    # from the response. obs_id is also the GPS start time, if the observation was never listed.
+    starttime, project = listed.get(int(obs_id), (int(obs_id), None))
+    metadata.setdefault("starttime", starttime)
+    metadata.setdefault("metadata", {}).setdefault("observation_number", int(obs_id))
+    if project: metadata["metadata"].setdefault("project", project)
+    return metadata
+
+def fetch_metadata():
+    catalogue = Catalogue()
+    meter = logs.Meter("Metadata", log, unit="observations")
+
+    # Fits without metadata yet, less those whose last request failed and are not due another try (see Catalogue.due)
+    now = time.time()
+    due = catalogue.due("metadata", now)
+    waiting = {str(obs_id) for obs_id in catalogue.failed("metadata") if obs_id not in due}
+    calibrations = {}
+    for calibration in SOLUTIONS.glob("*.json"):
+        obs_id = calibration.name.removeprefix("fit_").removesuffix(".json")
+        if not shards.mine(obs_id): continue    # Left to another shard (see shards)
+        if Path(FITS / f"fit_{obs_id}.json").exists():
+            LOGGER.debug(f"Observation metadata for obs_id {obs_id} already exists. Skipping...")
+            meter.count("skipped")
+            continue
+        if obs_id in waiting:
+            LOGGER.debug(f"Observation metadata for obs_id {obs_id} failed recently (not due a retry). Skipping...")
+            meter.count("waiting")
+            continue
+        calibrations[obs_id] = calibration
+    listed = catalogue.listed(calibrations)
+
+    saved, failed = [], {}
+    def save(obs_id, metadata, outcome, size=0):
+        error = problem(metadata)
+        if error:
+            LOGGER.debug(f"Unusable observation metadata for obs_id {obs_id} ({error}). Skipping...")
+            failed[obs_id] = error
+            meter.count("failed")
+            return
+        storage.write(OBSERVATIONS / f"obs_{obs_id}.json", metadata)
+        link(calibrations[obs_id], FITS / f"fit_{obs_id}.json")
+        saved.append(metadata)
+        meter.count(outcome, size=size)
+
+        # Add to the catalogue in batches to keep memory use down
+        if len(saved) >= 500:
+            catalogue.set_metadata(saved)
+            catalogue.set_fits(obs["metadata"]["observation_number"] for obs in saved)
+            saved.clear()
+
+    # Observations saved by an earlier run that stopped before linking their fits do not need fetching again
+    to_fetch = []
+    for obs_id in calibrations:
+        observation = OBSERVATIONS / f"obs_{obs_id}.json"
+        if observation.exists(): save(obs_id, fill(storage.read(observation), obs_id, listed), "reused")
+        else: to_fetch.append(obs_id)
+
+    # Fetch the rest several at a time. Server errors and dropped connections are retried (see fetch.get) before giving up.
+    log(f"Fetching observation metadata for {len(to_fetch)} fits...")
+    meter.total = meter.done + len(to_fetch)
+    for obs_id, r in fetch.fetch_many("/metadata/obs", to_fetch, workers=METADATA_WORKERS, retries=METADATA_RETRIES, backoff=METADATA_BACKOFF, log=LOGGER.debug):
+        if isinstance(r, Exception):
+            error = f"could not connect ({r.__class__.__name__})"
+        elif r.status_code != 200:
+            error = f"HTTP {r.status_code}"
+        else:
+            try:
+                save(obs_id, fill(r.json(), obs_id, listed), "fetched", len(r.content))
+                continue
+            except ValueError:
+                error = "invalid JSON"
+        LOGGER.debug(f"Failed to fetch observation metadata for obs_id {obs_id} ({error}). Skipping...")
+        failed[obs_id] = error
+        meter.count("failed")
 
-    with open(LOG_FILE, "a") as f:
-        f.write(f"({time_tag}) {message}\n")
-        print(f"({time_tag}) {message}")
+    meter.finish()
+    catalogue.set_metadata(saved)
+    catalogue.set_fits(obs["metadata"]["observation_number"] for obs in saved)
+    catalogue.clear_failed("metadata", [obs_id for obs_id in catalogue.failed("metadata")
+                                        if str(obs_id) not in failed and str(obs_id) not in waiting and shards.mine(obs_id)])
+    catalogue.set_failed("metadata", failed, time.time())
+
+    # Every failure is kept in the catalogue (SELECT * FROM failures) until a later run gets the metadata
+    if failed:
+        LOGGER.warning(f"No usable metadata for {len(failed)} observations (they are retried once due): " +
+                       ", ".join(f"{obs_id} ({error})" for obs_id, error in itertools.islice(failed.items(), 10)) +
+                       (", ..." if len(failed) > 10 else ""))
+
+    # Catch up on observations saved before the catalogue existed (each one is only ever loaded once), and mark those
+    # with a linked fit so Catalogue.window finds them
+    known = set(catalogue.ids("has_metadata = 1 AND has_fit = 1"))
+    backfill, linked = [], []
+    for observation in OBSERVATIONS.glob("*.json"):
+        obs_id = int(observation.name.removeprefix("obs_").removesuffix(".json"))
+        if obs_id in known or not shards.mine(obs_id):
+            continue
+        backfill.append(storage.read(observation))
+        if (FITS / f"fit_{obs_id}.json").exists(): linked.append(obs_id)
+    if backfill:
+        log(f"Added {len(backfill)} existing observations to the catalogue.")
+        catalogue.set_metadata(backfill)
+        catalogue.set_fits(linked)
 
 ################################################################################
-# Copy over the calibration solutions from 001 where we have valid metadata
+# Get a list of all calibrators, create folders for each one and populate them with links to the observation and fit files
 ################################################################################
 
-SOLUTIONS = Path("output/001/") / "calibrations"
+def calibrator_folder(calibrator):
+    # CALIBRATORS/<calibrator>, or None if the name is missing or is not a plain folder name (e.g. "", ".." or "a/b"),
+    # so nothing outside a single calibrator's folder is ever created or removed
+    if not isinstance(calibrator, str) or not calibrator.strip(): return None
+    folder = CALIBRATORS / calibrator
+    if folder.parent != CALIBRATORS or folder.name != calibrator or calibrator in (".", ".."): return None
+    return folder
 
-for calibration in SOLUTIONS.glob("*.json"):
-    obs_id = calibration.name.removeprefix("fit_").removesuffix(".json")
+def partition():
+    catalogue = Catalogue()
+    calibrators = {}
+    for calibrator, count in catalogue.calibrators().items():
+        if calibrator_folder(calibrator) is None:
+            LOGGER.warning(f"Skipping {count} observations with no usable calibrator name ({calibrator!r}).")
+            continue
+        calibrators[calibrator] = count
 
-    # Skip obs_ids which have been previously processed.
-    if Path(FITS / f"fit_{obs_id}.json").exists():
-        log(f"Observation metadata for obs_id {obs_id} already exists. Skipping...")
-        continue
+    for calibrator in calibrators:
+        if calibrators[calibrator] > THRESHOLD:
+            log(f"Creating folder for calibrator: {calibrator} [{calibrators[calibrator]}]")
+            (CALIBRATORS / calibrator / "observations").mkdir(parents=True, exist_ok=True)
+            (CALIBRATORS / calibrator / "fits").mkdir(parents=True, exist_ok=True)
+        elif Path(CALIBRATORS / calibrator).exists():
+            # Left over from a lower THRESHOLD. It only holds links, so nothing is lost.
+            log(f"Removing folder for calibrator: {calibrator} [{calibrators[calibrator]}]")
+            shutil.rmtree(calibrator_folder(calibrator))
 
-    # I would make this more robust if I had more time.
-    try:
-        payload = {"obs_id": obs_id}
-        log(f"Got observation metadata for obs_id {obs_id}.")
-        r = requests.get('https://ws.mwatelescope.org/metadata/obs', params=payload)
-        metadata = r.json()
-    except:
-        log(f"Failed to fetch observation metadata for obs_id {obs_id}. Skipping...")
-        continue
+    # Populate calibrator folders with links to the observation and fit files
+    meter = logs.Meter("Partition", log, unit="observations")
+    for calibrator in calibrators:
+        if not Path(CALIBRATORS / calibrator).exists():
+            continue
+
+        for obs_id in catalogue.calibrator_ids(calibrator):
+            observation = OBSERVATIONS / f"obs_{obs_id}.json"
+            fit = FITS / f"fit_{obs_id}.json"
+            observation_link = CALIBRATORS / calibrator / f"observations/obs_{obs_id}.json"
+            fit_link = CALIBRATORS / calibrator / f"fits/fit_{obs_id}.json"
+
+            # Copies made before calibrator folders were links are replaced, which frees their space
+            if observation_link.exists() and os.path.samefile(observation, observation_link):
+                LOGGER.debug(f"Observation and fit files for {obs_id} already exist in {calibrator} folder. Skipping...")
+                meter.count("skipped")
+                continue
+            link(observation, observation_link)
+            link(fit, fit_link)
+            LOGGER.debug(f"Linked observation and fit files for {obs_id} to {calibrator} folder.")
+            meter.count("linked")
+    meter.finish()
+
+################################################################################
+# Pack every fit into the gains cube so later stages do not need to parse the .jsons
+################################################################################
 
-    # Save the relevant files.
-    with open(OBSERVATIONS / f"obs_{obs_id}.json", "w") as f:
-        json.dump(metadata, f, indent=4)
+def pack_cube():
+    log(f"Adding new fits to the gains cube...")
+    cube = GainsCube(CUBE)
+    if cube.outdated():
+        # Every row is added again, so the trends are summarised again from the start too
+        log(f"Rebuilding the gains cube with full precision gains (it holds float32 gains)...")
+        shutil.rmtree(CUBE)
+        (TRENDS / "meta.json").unlink(missing_ok=True)
+        cube = GainsCube(CUBE)
+    meter = logs.Meter("Gains cube", log, unit="observations")
+    records = []
 
-    shutil.copy2(calibration, FITS / f"fit_{obs_id}.json")
+    for observation in OBSERVATIONS.glob("*.json"):
+        obs_id = observation.name.removeprefix("obs_").removesuffix(".json")
+        fit = FITS / f"fit_{obs_id}.json"
+        if obs_id in cube or not fit.exists():
+            continue
+
+        obs_data = storage.read(observation)
+        fit_data = storage.read(fit)
+
+        try:
+            records.append(record(fit_data, obs_data))
+        except (KeyError, ValueError) as e:
+            log(f"Could not add {obs_id} to the gains cube ({e!r}). Skipping...")
+            meter.count("failed")
+            continue
+        meter.count("added")
+
+        # Write in batches to keep memory use down
+        if len(records) >= 500:
+            cube.append(records)
+            records = []
+
+    cube.append(records)
+    meter.finish()
+    log(f"Gains cube holds {len(cube)} observations.")
 
 ################################################################################
-# Get a list of all calibrators and create folders for each one
+# Summarise the observations added to the cube into the daily and weekly trends of each tile
 ################################################################################
-calibrators = {}
-
-for observation in OBSERVATIONS.glob("*.json"):
-    
-    with observation.open("r", encoding="utf-8") as f:
-        data = json.load(f)
-    metadata = data["metadata"]
-    calibrator = metadata["calibrators"]
-    
-    if calibrator in calibrators.keys():
-        calibrators[calibrator] += 1
-    else:
-        calibrators[calibrator] = 1
-
-for calibrator in calibrators:
-    if calibrators[calibrator] > THRESHOLD:
-        log(f"Creating folder for calibrator: {calibrator} [{calibrators[calibrator]}]")
-        (CALIBRATORS / calibrator / "observations").mkdir(parents=True, exist_ok=True)
-        (CALIBRATORS / calibrator / "fits").mkdir(parents=True, exist_ok=True)
+
+def update_trends():
+    cube = GainsCube(CUBE)
+    trends = TrendStore(TRENDS)
+    updated = trends.update(cube, log=log)
+    log(f"Updated {updated} days and weeks of trends ({trends.meta['rows']} observations summarised).")
 
 ################################################################################
-# Populate calibrator folders with observation and fit files
+# Run every step (run.py instead runs only the steps whose inputs have changed)
 ################################################################################
-for observation in OBSERVATIONS.glob("*.json"):
-    
-    with observation.open("r", encoding="utf-8") as f:
-        data = json.load(f)
-    metadata = data["metadata"]
-    calibrator = metadata["calibrators"]
-    obs_id = metadata["observation_number"]
-
-    if Path(CALIBRATORS / calibrator).exists():
-        if Path(CALIBRATORS / calibrator / f"observations/obs_{obs_id}.json").exists():
-            log(f"Observation and fit files for {obs_id} already exist in {calibrator} folder. Skipping...")
-            continue
-        shutil.copy2(observation, CALIBRATORS / calibrator / f"observations/obs_{obs_id}.json")
-        shutil.copy2(FITS / f"fit_{obs_id}.json", CALIBRATORS / calibrator / f"fits/fit_{obs_id}.json")
-        log(f"Copied observation and fit files for {obs_id} to {calibrator} folder.")
\ No newline at end of file
+
+if __name__ == "__main__":
+    fetch_metadata()
+    partition()
+    pack_cube()
+    update_trends()
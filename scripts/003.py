@@ -1,12 +1,17 @@
 ################################################################################
 # 003
-# Plot data for a calibrator over a given date range.
+# Plot data for one or more calibrators, each over a given date range.
 ################################################################################
 
-import json, requests, itertools, csv, shutil, matplotlib.pyplot as plt, imageio
-from datetime import datetime, timedelta
+from collections import defaultdict
+from datetime import datetime
 from pathlib import Path
 from astropy.time import Time
+from doctor import window, animate, storage, logs, files, documents
+from doctor.catalogue import Catalogue
+from doctor.cube import GainsCube, POLS, plain
+from doctor.bands import BANDS, band_name
+from doctor.render import Renderer
 
 ################################################################################
 # Paths and Constants
@@ -14,108 +19,161 @@ from astropy.time import Time
 
 REFRESH_DATA = True    # If True, plots individual observations and saves data for GIF creation.
                         # Else, only creates combined plots and GIFs for each tile from existing data.
+FROM_CUBE = True        # If True, reads gains from the gains cube built by 002 instead of every fit/observation .json
 
 START_DATE = datetime(year=2025, month=12, day=1)    # Starts at 0:00 on this date
 END_DATE   = datetime(year=2026, month=1, day=1)    # Ends at 0:00 on this date
 
 CALIBRATOR = "HydA"
 
+TILES = None    # Only plot these tiles (e.g. [11, 42]), or None for every tile. Reading the .jsons, only these tiles are parsed.
+
+# (calibrator, start date, end date) of every search to plot. They are planned together, so an observation in more than
+# one of them is read and plotted once, and its plots and band data are linked into the other searches' folders.
+JOBS = [
+    (CALIBRATOR, START_DATE, END_DATE),
+    # ("PicA", datetime(year=2025, month=12, day=1), datetime(year=2026, month=1, day=1)),
+]
+
 Y_LIM = (0, 2)
 
 GIF_FPS = 1    # Frames per second for the GIFs
+ANIMATION_FORMAT = "gif"    # "gif", or a video format such as "mp4" (needs the imageio-ffmpeg package)
+SAVE_COMBINED_PNGS = False  # If True, also saves each frame as a combined .png in plots/<date>/ (the animations do not need them)
+
+RENDER_WORKERS = 4    # Number of processes drawing plots (0 draws everything in this process)
 
 ################
 
-LOGS = Path("logging/003/")
 OUTPUT = Path("output/003/")
 
-SEARCH = OUTPUT / f"{CALIBRATOR}_{START_DATE.strftime("%Y-%m-%d")}_{END_DATE.strftime("%Y-%m-%d")}/"
-DATES = SEARCH / "dates/"
-PLOTS = SEARCH / "plots/"
-GIFS = SEARCH / "gifs/"
-
 DATA = Path("output/002/") / "calibrators"
+CUBE = Path("output/002/") / "cube"
 
-LOGS.mkdir(parents=True, exist_ok=True)
 OUTPUT.mkdir(parents=True, exist_ok=True)
-PLOTS.mkdir(parents=True, exist_ok=True)
-GIFS.mkdir(parents=True, exist_ok=True)
-SEARCH.mkdir(parents=True, exist_ok=True)
 
 # Create log file
-LOG_START = datetime.now()
-LOG_FILE = LOGS / f"log_{LOG_START.strftime("%Y-%m-%dT%H-%M-%S")}.txt"
-with open(LOG_FILE, "a") as f:
-    f.write(f"({LOG_START.strftime("%Y-%m-%d %H-%M-%S")}) Starting...\n")
-    print(f"({LOG_START.strftime("%Y-%m-%d %H-%M-%S")}) Starting...")
+LOGGER = logs.setup("003")
+log = LOGGER.info
 
 ################################################################################
-# Helper functions
+# Searches
 ################################################################################
 
-def log(message):
-    time_tag = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+class Search:
+    # One calibrator over one date range, with its own folder in output/003/
+    def __init__(self, calibrator, start_date, end_date):
+        self.calibrator = calibrator
+        self.start_date = start_date
+        self.end_date = end_date
+        self.start, self.end = window.gps_bounds(start_date, end_date)
 
-    with open(LOG_FILE, "a") as f:
-        f.write(f"({time_tag}) {message}\n")
-        print(f"({time_tag}) {message}")
+        self.folder = OUTPUT / f"{calibrator}_{start_date.strftime('%Y-%m-%d')}_{end_date.strftime('%Y-%m-%d')}/"
+        self.dates = self.folder / "dates/"
+        self.plots = self.folder / "plots/"
+        self.gifs = self.folder / "gifs/"
+
+        self.plots.mkdir(parents=True, exist_ok=True)
+        self.gifs.mkdir(parents=True, exist_ok=True)
+
+    def __str__(self):
+        return f"{self.calibrator} from {self.start_date.strftime('%Y-%m-%d')} to {self.end_date.strftime('%Y-%m-%d')}"
 
 ################################################################################
 # Plotting individual observations
 ################################################################################
 
-if REFRESH_DATA:
-    log(f"Creating tile gifs for calibrator {CALIBRATOR} from {START_DATE.strftime('%Y-%m-%d')} to {END_DATE.strftime('%Y-%m-%d')}.")
-
-    fits = []
-    observations = []
-    for fit in sorted(DATA.glob(f"{CALIBRATOR}/fits/*.json"), reverse=True):
-        fits.append(fit)
-    for observation in sorted(DATA.glob(f"{CALIBRATOR}/observations/*.json"), reverse=True):
-        observations.append(observation)
-
-    # Go through each fit/observation pair
-    for fit_file, obs_file in zip(fits, observations):
-        with open(fit_file, "r") as f:
-            fit_data = json.load(f)
-            fit_meta = fit_data["metadata"]
-
-        with open(obs_file, "r") as f:
-            obs_data = json.load(f)
-            obs_meta = obs_data["metadata"]
-            obs_id = obs_meta["observation_number"]
-            obs_time = Time(obs_data["starttime"], format="gps").to_datetime()
-            channels = obs_data["rfstreams"]["0"]["frequencies"]
-            tiles = obs_data["rfstreams"]["0"]["tileset"]
-
-        # I really should do this earlier to avoid wasting time, but this is fine for now
-        if obs_time < START_DATE or obs_time >= END_DATE:
-            log(f"Observation {obs_id} is outside date range. Skipping...")
-            continue
-
-        log(f"Processing observation {obs_id}...")
-
-        # Make a folder for the date of the observation if it does not exist.
-        date_folder = DATES / f"{obs_time.strftime('%Y-%m-%d')}"
-        date_folder.mkdir(parents=True, exist_ok=True)
-
-        date_channel_folders = [
-            date_folder / "Solar",
-            date_folder / "Ch57-80",
-            date_folder / "Ch81-104",
-            date_folder / "Ch109-132",
-            date_folder / "Ch133-156",
-            date_folder / "Ch157-180",
-        ]
-
-        for folder in date_channel_folders:
-            folder.mkdir(parents=True, exist_ok=True)
+# Plots are queued on the renderer and drawn by worker processes while the data is being read.
+# Every observation is read and plotted once, into the first search that needs it, then linked into the others.
+def refresh_data(renderer, searches):
+    log(f"Creating tile gifs for {len(searches)} searches: {', '.join(map(str, searches))}.")
+
+    def plan(selections):
+        # selections: for each search, the (obs_id, ...) entries it needs. Returns [(entry, [searches needing it]), ...],
+        # newest first, with each entry once however many of the date ranges it is in.
+        needed = defaultdict(list)
+        for search, selected in zip(searches, selections):
+            for entry in selected: needed[entry].append(search)
+        shared = sum(1 for covering in needed.values() if len(covering) > 1)
+        log(f"Found {len(needed)} observations in date ranges ({shared} in more than one).")
+        meter.total = len(needed)
+        return sorted(needed.items(), key=lambda item: item[0][0], reverse=True)
+
+    def rebuild(tile_list, channels, gains, sigma, chi2, quality):
+        # Just the parts of a fit that are used below, from arrays of tile x pol (x channel)
+        return {str(tile): {pol: {
+            "gains": plain(gains[slot, p, :len(channels)]),
+            "phase_sigma_resid": plain(sigma[slot, p])[0],
+            "phase_chi2dof": plain(chi2[slot, p])[0],
+            "phase_fit_quality": plain(quality[slot, p])[0],
+        } for p, pol in enumerate(POLS)} for slot, tile in enumerate(tile_list)}
+
+    def wanted(tile_list):
+        return [tile for tile in tile_list if TILES is None or tile in TILES]
+
+    def json_observations():
+        # The date ranges are looked up in the catalogue, only those fit/observation pairs are opened, and only the tiles
+        # and fields used below are parsed from them (see documents)
+        catalogue = Catalogue()
+        selected = plan([window.pairs(DATA / search.calibrator, catalogue.window(search.calibrator, search.start, search.end)) for search in searches])
+
+        loaded = window.load_pairs((pair for pair, _ in selected),
+                                   load_fit=lambda fit: documents.read_fit(fit, TILES), load_obs=documents.read_observation)
+        for (_, covering), (obs_id, fit, obs) in zip(selected, loaded):
+            obs_time = Time(obs["starttime"], format="gps").to_datetime()
+            channels = obs["channels"].tolist()
+            tile_list = wanted(obs["tiles"].tolist())
+            tiles = {"xlist": tile_list, "ylist": tile_list}
+
+            fit_data = rebuild(fit["tiles"].tolist(), channels, fit["gains"], fit["phase_sigma_resid"], fit["phase_chi2dof"], fit["phase_fit_quality"])
+
+            yield fit_data, obs_id, obs_time, channels, tiles, covering
+
+    def cube_observations():
+        # Same as json_observations(), but the date ranges are looked up in the cube's index and only those rows are read
+        cube = GainsCube(CUBE)
+        selected = plan([[(int(cube.obs_ids[row]), int(row)) for row in cube.select(search.calibrator, search.start, search.end)] for search in searches])
+
+        for (obs_id, row), covering in selected:
+            obs_time = Time(obs_id, format="gps").to_datetime()
+            channels = [int(c) for c in cube.channels[row] if c >= 0]
+            tile_list = [int(t) for t in cube.tiles[row] if t >= 0]
+            slots = [slot for slot, tile in enumerate(tile_list) if TILES is None or tile in TILES]
+            tile_list = [tile_list[slot] for slot in slots]
+            tiles = {"xlist": tile_list, "ylist": tile_list}
+
+            fit_data = rebuild(tile_list, channels,
+                               cube.gains[row, slots], cube.sigma[row, slots], cube.chi2[row, slots], cube.quality[row, slots])
+
+            yield fit_data, obs_id, obs_time, channels, tiles, covering
+
+    meter = logs.Meter("Observations", log, unit="observations")
+    if FROM_CUBE and CUBE.exists(): observations = cube_observations()
+    else: observations = json_observations()
+
+    shared_plots = []    # (folder of plots, [folders to link them into]), once the plots have been drawn
+    for fit_data, obs_id, obs_time, channels, tiles, covering in observations:
+        LOGGER.debug(f"Processing observation {obs_id}...")
+        search, others = covering[0], covering[1:]
+        calibrator = search.calibrator
+
+        # Make a folder for the date of the observation in each search if it does not exist.
+        date_folders = [each.dates / f"{obs_time.strftime('%Y-%m-%d')}" for each in covering]
+        for date_folder in date_folders:
+            for band in BANDS:
+                (date_folder / band).mkdir(parents=True, exist_ok=True)
+        date_folder = date_folders[0]
+
+        img_folder = search.plots / f"{calibrator}_{obs_id}"
+        img_folder.mkdir(parents=True, exist_ok=True)
+        if others: shared_plots.append((img_folder, [other.plots / img_folder.name for other in others]))
 
         # Plot each tile for this observation
+        plot_jobs = []
         for tile_x, tile_y in zip(tiles["xlist"], tiles["ylist"]):
             if tile_x != tile_y: exit(1)
 
-            log(f"Plotting tile {tile_x}...")
+            LOGGER.debug(f"Plotting tile {tile_x}...")
             try:
                 x_gains = fit_data[str(tile_x)]["X"]["gains"]
                 x_sigma = fit_data[str(tile_x)]["X"]["phase_sigma_resid"]
@@ -127,155 +185,92 @@ if REFRESH_DATA:
                 y_chi2 = fit_data[str(tile_x)]["Y"]["phase_chi2dof"]
                 y_quality = fit_data[str(tile_x)]["Y"]["phase_fit_quality"]
             except KeyError as e:
-                log(f"Tile {e} does not exist in the fit data. Skipping...")
+                LOGGER.debug(f"Tile {e} does not exist in the fit data. Skipping...")
                 continue
 
-            plt.figure(figsize=(10, 6))
-            plt.plot(channels, x_gains, label="X Gain", color="blue")
-            plt.plot(channels, y_gains, label="Y Gain", color="red")
-            plt.title(f"Tile: {tile_x}, Calibrator: {CALIBRATOR}, Date: {obs_time}")
-            plt.xlabel("Channel")
-            plt.ylabel("Gain")
-            plt.legend()
-
-            img_folder = PLOTS / f"{CALIBRATOR}_{obs_id}"
-            img_folder.mkdir(parents=True, exist_ok=True)
-
             plot_path = img_folder / f"tile{tile_x}.png"
-            plt.savefig(plot_path)
-            plt.close()
+            plot_jobs.append((plot_path, f"Tile: {tile_x}, Calibrator: {calibrator}, Date: {obs_time}", channels, x_gains, y_gains))
 
             # Save this tile's x_gains and y_gains for later GIF creation
-            match channels:
-                case [58, 61, 65, 69, 73, 77, 81, 86, 91, 96, 101, 107, 113, 120, 127, 134, 142, 150, 158, 167, 177, 187, 210, 226]:
-                    channels_name = "Solar"
-                case [57, 58, 59, 60, 61, 62, 63, 64, 65, 66, 67, 68, 69, 70, 71, 72, 73, 74, 75, 76, 77, 78, 79, 80]:
-                    channels_name = "Ch57-80"
-                case [81, 82, 83, 84, 85, 86, 87, 88, 89, 90, 91, 92, 93, 94, 95, 96, 97, 98, 99, 100, 101, 102, 103, 104]:
-                    channels_name = "Ch81-104"
-                case [109, 110, 111, 112, 113, 114, 115, 116, 117, 118, 119, 120, 121, 122, 123, 124, 125, 126, 127, 128, 129, 130, 131, 132]:
-                    channels_name = "Ch109-132"
-                case [133, 134, 135, 136, 137, 138, 139, 140, 141, 142, 143, 144, 145, 146, 147, 148, 149, 150, 151, 152, 153, 154, 155, 156]:
-                    channels_name = "Ch133-156"
-                case [157, 158, 159, 160, 161, 162, 163, 164, 165, 166, 167, 168, 169, 170, 171, 172, 173, 174, 175, 176, 177, 178, 179, 180]:
-                    channels_name = "Ch157-180"
-                case _:
-                    log(f"{channels} does not match any known band. Skipping saving gains for tile {tile_x}...")
-                    continue
-
-            with open(date_folder / f"{channels_name}" / f"{tile_x}.json", "w") as f:
-                data = {
-                    "x": {
-                        "x_gains": x_gains,
-                        "x_sigma": x_sigma,
-                        "x_chi2": x_chi2,
-                        "x_quality": x_quality
-                    },
-                    "y": {
-                        "y_gains": y_gains,
-                        "y_sigma": y_sigma,
-                        "y_chi2": y_chi2,   
-                        "y_quality": y_quality
-                    }
+            channels_name = band_name(channels)
+            if channels_name is None:
+                LOGGER.debug(f"{channels} does not match any known band. Skipping saving gains for tile {tile_x}...")
+                continue
+
+            data = {
+                "x": {
+                    "x_gains": x_gains,
+                    "x_sigma": x_sigma,
+                    "x_chi2": x_chi2,
+                    "x_quality": x_quality
+                },
+                "y": {
+                    "y_gains": y_gains,
+                    "y_sigma": y_sigma,
+                    "y_chi2": y_chi2,   
+                    "y_quality": y_quality
                 }
-                json.dump(data, f, indent=4)
+            }
+            band_file = date_folder / f"{channels_name}" / f"{tile_x}.json"
+            storage.write(band_file, data)
+            for other in date_folders[1:]:
+                files.link(band_file, other / f"{channels_name}" / f"{tile_x}.json")
+
+        renderer.tiles(plot_jobs)
+        meter.count("shared" if others else "plotted")
+
+    meter.finish()
+
+    # Plots shared between searches can only be linked once they have been drawn
+    if shared_plots:
+        renderer.wait()
+        for img_folder, destinations in shared_plots:
+            for destination in destinations:
+                destination.mkdir(parents=True, exist_ok=True)
+                for plot in img_folder.glob("*.png"):
+                    files.link(plot, destination / plot.name)
 
 ################################################################################
-# Create GIF frames by combining band plots into one image for each tile on each date
+# Create GIFs of the combined band plots for each tile over the date range of a search
 ################################################################################
 
-for date_folder in sorted(DATES.glob("*")):
-    # Build a combined plot of all bands for each tile on this date
-    for data_solar in (date_folder / "Solar").glob("*.json"):
-        log(f"Creating combined plot for tile {data_solar.name.removesuffix('.json')} on {date_folder.name}...")
-        tile_number = data_solar.name.removesuffix(".json")
-
-        data = {
-            "Solar": data_solar,
-            "Ch57-80": Path(date_folder / "Ch57-80" / f"{tile_number}.json"),
-            "Ch81-104": Path(date_folder / "Ch81-104" / f"{tile_number}.json"),
-            "Ch109-132": Path(date_folder / "Ch109-132" / f"{tile_number}.json"),
-            "Ch133-156": Path(date_folder / "Ch133-156" / f"{tile_number}.json"),
-            "Ch157-180": Path(date_folder / "Ch157-180" / f"{tile_number}.json"),
-        }
-
-        fig, axs = plt.subplots(2, 3, figsize=(15, 10))
-
-        axs[0, 0].set_title("Solar")
-        with open(data["Solar"], "r") as f:
-            solar_data = json.load(f)
-            channels = [58, 61, 65, 69, 73, 77, 81, 86, 91, 96, 101, 107, 113, 120, 127, 134, 142, 150, 158, 167, 177, 187, 210, 226]
-            axs[0, 0].plot(channels, solar_data["x"]["x_gains"], label="X Gain", color="blue")
-            axs[0, 0].plot(channels, solar_data["y"]["y_gains"], label="Y Gain", color="red")
-            axs[0, 0].set_ylim(Y_LIM)
-            axs[0, 0].legend()
-
-        axs[0, 1].set_title("Ch57-80")
-        with open(data["Ch57-80"], "r") as f:
-            Ch57_80_data = json.load(f)
-            channels = list(range(57, 81))
-            axs[0, 1].plot(channels, Ch57_80_data["x"]["x_gains"], label="X Gain", color="blue")
-            axs[0, 1].plot(channels, Ch57_80_data["y"]["y_gains"], label="Y Gain", color="red")
-            axs[0, 1].set_ylim(Y_LIM)
-            axs[0, 1].legend()
-
-        axs[0, 2].set_title("Ch81-104")
-        with open(data["Ch81-104"], "r") as f:
-            Ch81_104_data = json.load(f)
-            channels = list(range(81, 105))
-            axs[0, 2].plot(channels, Ch81_104_data["x"]["x_gains"], label="X Gain", color="blue")
-            axs[0, 2].plot(channels, Ch81_104_data["y"]["y_gains"], label="Y Gain", color="red")
-            axs[0, 2].set_ylim(Y_LIM)
-            axs[0, 2].legend()
-
-        axs[1, 0].set_title("Ch109-132")
-        with open(data["Ch109-132"], "r") as f:
-            Ch109_132_data = json.load(f)
-            channels = list(range(109, 133))
-            axs[1, 0].plot(channels, Ch109_132_data["x"]["x_gains"], label="X Gain", color="blue")
-            axs[1, 0].plot(channels, Ch109_132_data["y"]["y_gains"], label="Y Gain", color="red")
-            axs[1, 0].set_ylim(Y_LIM)
-            axs[1, 0].legend()
-
-        axs[1, 1].set_title("Ch133-156")
-        with open(data["Ch133-156"], "r") as f:
-            Ch133_156_data = json.load(f)
-            channels = list(range(133, 157))
-            axs[1, 1].plot(channels, Ch133_156_data["x"]["x_gains"], label="X Gain", color="blue")
-            axs[1, 1].plot(channels, Ch133_156_data["y"]["y_gains"], label="Y Gain", color="red")
-            axs[1, 1].set_ylim(Y_LIM)
-            axs[1, 1].legend()
-
-        axs[1, 2].set_title("Ch157-180")
-        with open(data["Ch157-180"], "r") as f:
-            Ch157_180_data = json.load(f)
-            channels = list(range(157, 181))
-            axs[1, 2].plot(channels, Ch157_180_data["x"]["x_gains"], label="X Gain", color="blue")
-            axs[1, 2].plot(channels, Ch157_180_data["y"]["y_gains"], label="Y Gain", color="red")
-            axs[1, 2].set_ylim(Y_LIM)
-            axs[1, 2].legend()
-
-        fig.suptitle(f"Tile {tile_number} - {date_folder.name}")
-        plot_path = PLOTS / f"{date_folder.name}"
-        plot_path.mkdir(parents=True, exist_ok=True)
-        fig_path = plot_path / f"tile{tile_number}.png"
-        plt.savefig(fig_path)
-        plt.close()
+def make_animations(renderer, search):
+    # Each frame is drawn from the band data and streamed straight into the animation, so no frame is read back from disk
+    # and only one is in memory at a time
+    date_folders = sorted(search.dates.glob("*"))
+    tile_numbers = sorted({data_solar.name.removesuffix(".json") for date_folder in date_folders for data_solar in (date_folder / "Solar").glob("*.json")}, key=int)
+
+    if SAVE_COMBINED_PNGS:
+        for date_folder in date_folders:
+            (search.plots / f"{date_folder.name}").mkdir(parents=True, exist_ok=True)
+
+    animation_jobs = []
+    for tile_number in tile_numbers:
+        LOGGER.debug(f"Creating GIF for tile {tile_number}...")
+
+        frames = []
+        for date_folder in date_folders:
+            data = {band: Path(date_folder / band / f"{tile_number}.json") for band in BANDS}
+            png_path = search.plots / f"{date_folder.name}" / f"tile{tile_number}.png" if SAVE_COMBINED_PNGS else None
+            frames.append((f"Tile {tile_number} - {date_folder.name}", data, png_path))
+
+        gif_path = search.gifs / f"tile{tile_number}.{ANIMATION_FORMAT}"
+        animation_jobs.append((gif_path, GIF_FPS, frames))
+
+    log(f"Creating {len(animation_jobs)} animations of {len(date_folders)} dates for {search}...")
+    renderer.submit(animate.save_animations, animation_jobs)
 
 ################################################################################
-# Create GIFs by stitching together combined plots for each tile over the date range
+# Run everything (REFRESH_DATA is overridden by run.py, which only refreshes the data when its inputs have changed)
 ################################################################################
 
-date_folder = sorted(DATES.glob("*"))[0]
-for data_solar in (date_folder / "Solar").glob("*.json"):
-        tile_number = data_solar.name.removesuffix(".json")
-        log(f"Creating GIF for tile {tile_number}...")
-
-        img_files = []
-        for date_folder in sorted(DATES.glob("*")):
-            plot_path = PLOTS / f"{date_folder.name}" / f"tile{tile_number}.png"
-            img_files.append(plot_path)
+def run(refresh=REFRESH_DATA, jobs=JOBS):
+    # The worker processes are started before anything else so they are forked from a process with no other threads
+    renderer = Renderer(RENDER_WORKERS, Y_LIM)
+    searches = [Search(*job) for job in dict.fromkeys(jobs)]
+    if refresh: refresh_data(renderer, searches)
+    for search in searches: make_animations(renderer, search)
+    renderer.close()
 
-        gif_path = GIFS / f"tile{tile_number}.gif"
-        frames = [imageio.v2.imread(p) for p in img_files]
-        imageio.mimsave(gif_path, frames, duration=1 / GIF_FPS, loop=0)
+if __name__ == "__main__":
+    run()
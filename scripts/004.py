@@ -0,0 +1,62 @@
+################################################################################
+# 004
+# Rank tiles by how anomalous their gains are for a calibrator over a given date range.
+################################################################################
+
+import csv
+from datetime import datetime
+from pathlib import Path
+from doctor import anomaly, window, logs
+from doctor.cube import GainsCube
+
+################################################################################
+# Paths and Constants
+################################################################################
+
+START_DATE = datetime(year=2025, month=12, day=1)    # Starts at 0:00 on this date
+END_DATE   = datetime(year=2026, month=1, day=1)    # Ends at 0:00 on this date
+
+CALIBRATOR = "HydA"
+
+SUSPECT_SCORE = 3    # Tiles scoring above this are listed in the log (the report has every tile)
+
+################
+
+OUTPUT = Path("output/004/")
+
+CUBE = Path("output/002/") / "cube"
+REPORT = OUTPUT / f"{CALIBRATOR}_{START_DATE.strftime("%Y-%m-%d")}_{END_DATE.strftime("%Y-%m-%d")}.csv"
+
+OUTPUT.mkdir(parents=True, exist_ok=True)
+
+# Create log file
+LOGGER = logs.setup("004")
+log = LOGGER.info
+
+################################################################################
+# Load gains for every tile and observation in the date range, score them and write the ranked report
+################################################################################
+
+def write_report():
+    log(f"Loading gains for calibrator {CALIBRATOR} from {START_DATE.strftime('%Y-%m-%d')} to {END_DATE.strftime('%Y-%m-%d')}...")
+    start, end = window.gps_bounds(START_DATE, END_DATE)
+    data = anomaly.load(GainsCube(CUBE), CALIBRATOR, start, end)
+    log(f"Loaded {len(data['obs_ids'])} observations of {len(data['tiles'])} tiles.")
+
+    # Score each tile, band and polarisation and write the ranked report
+    report = anomaly.scores(data)
+
+    with REPORT.open("w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=["tile", "band", "pol", "observations", "array", "history", "chi2", "missing", "score"])
+        writer.writeheader()
+        writer.writerows(report)
+
+    for row in report:
+        if row["score"] <= SUSPECT_SCORE: break
+        log(f"Suspect: tile {row['tile']} {row['band']} {row['pol']} (score {row['score']}, array {row['array']}, history {row['history']}, chi2 {row['chi2']})")
+
+    log(f"Wrote report for {len(report)} tile/band/polarisations to {REPORT}.")
+    log(f"Done!")
+
+if __name__ == "__main__":
+    write_report()
@@ -0,0 +1,93 @@
+################################################################################
+# 005
+# Plot the long-term gain trends of every tile for a calibrator, from the daily and weekly summaries kept by 002.
+################################################################################
+
+import csv, warnings
+import numpy as np
+from pathlib import Path
+from doctor import logs
+from doctor.bands import BANDS
+from doctor.cube import POLS
+from doctor.trends import TrendStore, STATISTICS, rolling
+
+################################################################################
+# Paths and Constants
+################################################################################
+
+START_DATE = None    # First day (or week) to include, or None for everything summarised so far
+END_DATE   = None    # Day (or week) to stop before, or None
+
+CALIBRATOR = "HydA"
+
+PERIOD = "daily"    # "daily" or "weekly"
+ROLLING = 7         # Periods in the rolling median drawn for each tile
+
+Y_LIM = (0, 2)
+
+################
+
+OUTPUT = Path("output/005/")
+
+TRENDS = Path("output/002/") / "trends"
+NAME = f"{CALIBRATOR}_{PERIOD}"
+
+OUTPUT.mkdir(parents=True, exist_ok=True)
+
+# Create log file
+LOGGER = logs.setup("005")
+log = LOGGER.info
+
+################################################################################
+# Write every tile's trends to a .csv and plot them, one figure per band
+################################################################################
+
+def plot_trends():
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    log(f"Loading {PERIOD} trends for calibrator {CALIBRATOR}...")
+    series = TrendStore(TRENDS).series(CALIBRATOR, PERIOD, START_DATE, END_DATE)
+    dates, tiles = series["dates"], series["tiles"]
+    log(f"Loaded {len(dates)} periods of {len(tiles)} tiles.")
+    if not dates:
+        log(f"Nothing to plot. Done!")
+        return
+
+    smoothed = rolling(series["gain"], ROLLING)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)    # Bands with no observations in a period
+        array = np.nanmedian(series["gain"], axis=1)
+
+    with open(OUTPUT / f"{NAME}.csv", "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["date", "tile", "band", "pol", *STATISTICS, "rolling_gain"])
+        for i, t, b, p in zip(*np.nonzero(series["count"])):
+            writer.writerow([dates[i].strftime("%Y-%m-%d"), int(tiles[t]), list(BANDS)[b], POLS[p],
+                             int(series["count"][i, t, b, p]), *(round(float(series[name][i, t, b, p]), 6) for name in STATISTICS[1:]),
+                             round(float(smoothed[i, t, b, p]), 6)])
+
+    for b, band in enumerate(BANDS):
+        # Only the periods with observations in this band
+        observed = series["count"][:, :, b].any(axis=(1, 2))
+        if not observed.any(): continue
+        band_dates = [date for date, seen in zip(dates, observed) if seen]
+
+        fig, axs = plt.subplots(len(POLS), 1, figsize=(15, 10), sharex=True)
+        for p, (ax, pol) in enumerate(zip(axs, POLS)):
+            # Every tile faintly, with the median of the array over it
+            ax.plot(band_dates, smoothed[observed, :, b, p], color="grey", alpha=0.3, linewidth=0.5)
+            ax.plot(band_dates, array[observed, b, p], color="blue" if pol == "X" else "red", marker="o", label=f"{pol} Gain (array median)")
+            ax.set_ylim(Y_LIM)
+            ax.set_ylabel("Gain")
+            ax.legend()
+        fig.suptitle(f"{CALIBRATOR} - {band} ({PERIOD}, {ROLLING}-period rolling median per tile)")
+        fig.savefig(OUTPUT / f"{NAME}_{band}.png")
+        plt.close(fig)
+
+    log(f"Wrote {OUTPUT / f'{NAME}.csv'} and plots of {len(dates)} periods to {OUTPUT}.")
+    log(f"Done!")
+
+if __name__ == "__main__":
+    plot_trends()
@@ -0,0 +1,77 @@
+################################################################################
+# 006
+# Find groups of tiles whose gains go wrong together for a calibrator over a given date range.
+################################################################################
+
+import csv, time
+from datetime import datetime
+from pathlib import Path
+from doctor import correlation, window, logs, shards
+from doctor.cube import GainsCube
+
+################################################################################
+# Paths and Constants
+################################################################################
+
+START_DATE = datetime(year=2025, month=12, day=1)    # Starts at 0:00 on this date
+END_DATE   = datetime(year=2026, month=1, day=1)    # Ends at 0:00 on this date
+
+CALIBRATOR = "HydA"
+
+SIMILAR = 0.7      # Two tiles deviate "the same way" in an observation when their normalised gain curves are at least this similar
+DEVIATING = 3      # A tile is deviating when it strays this many (normal-scaled) median absolute deviations further from the array than most
+TOGETHER = 0.5     # Tiles are grouped when they deviate the same way in at least this fraction of the observations either deviates in
+MINIMUM = 3        # ... and there are at least this many of those observations
+
+################
+
+OUTPUT = Path("output/006/")
+
+CUBE = Path("output/002/") / "cube"
+SIMILARITY = OUTPUT / "similarity"    # Kept between runs, so a longer date range only works out the new observations
+REPORT = OUTPUT / f"{CALIBRATOR}_{START_DATE.strftime("%Y-%m-%d")}_{END_DATE.strftime("%Y-%m-%d")}.csv"
+
+OUTPUT.mkdir(parents=True, exist_ok=True)
+
+# Create log file
+LOGGER = logs.setup("006")
+log = LOGGER.info
+
+################################################################################
+# Compare every pair of tiles in each observation in the date range, group the ones that go wrong together and write them
+################################################################################
+
+def write_groups():
+    log(f"Finding tiles that go wrong together for calibrator {CALIBRATOR} from {START_DATE.strftime('%Y-%m-%d')} to {END_DATE.strftime('%Y-%m-%d')}...")
+    cube = GainsCube(CUBE)
+    rows = cube.select(CALIBRATOR, *window.gps_bounds(START_DATE, END_DATE))
+
+    store = correlation.CorrelationStore(SIMILARITY)
+    started = time.perf_counter()
+    new = store.update(cube, [row for row in rows if shards.mine(cube.obs_ids[row])], log)
+    if new: log(f"Compared the tiles of {new} new observations in {time.perf_counter() - started:.1f}s.")
+
+    # A shard only compares the tiles of its own observations. The groups are found once the shards are merged.
+    if shards.SHARD:
+        log(f"Done!")
+        return
+
+    data = store.load(cube, rows)
+    log(f"Loaded {len(data['obs_ids'])} observations of {len(data['tiles'])} tiles.")
+    found = correlation.groups(data, SIMILAR, DEVIATING, TOGETHER, MINIMUM)
+
+    with REPORT.open("w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=["pol", "tiles", "receivers", "observations", "bands", "first", "last", "similarity"])
+        writer.writeheader()
+        for group in found:
+            writer.writerow({**group, **{name: " ".join(map(str, group[name])) for name in ["tiles", "receivers", "bands"]}})
+
+    for group in found:
+        log(f"Group: tiles {', '.join(map(str, group['tiles']))} {group['pol']} (receivers {', '.join(map(str, group['receivers']))}, "
+            f"{group['observations']} observations, similarity {group['similarity']})")
+
+    log(f"Wrote {len(found)} groups to {REPORT}.")
+    log(f"Done!")
+
+if __name__ == "__main__":
+    write_groups()
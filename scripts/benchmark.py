@@ -0,0 +1,147 @@
+################################################################################
+# benchmark
+# Time every stage of 001 -> 006 on synthetic data served by a local stand-in for the web services
+################################################################################
+
+import argparse, json, os, shutil, subprocess, sys, tempfile, time
+from datetime import datetime
+from pathlib import Path
+from doctor import logs, profiling, synthetic
+
+################################################################################
+# Paths and Constants
+################################################################################
+
+SCALES = {"1k": 1_000, "10k": 10_000, "100k": 100_000}    # Calibration observations (each with a fit, unless missing)
+
+# (stage, script, function), in the order they run. Names match run.py.
+STAGES = [
+    ("past", "001", "refresh_past"),
+    ("past_csv", "001", "combine_past"),
+    ("calibrations", "001", "refresh_calibs"),
+    ("fits", "001", "fetch_fits"),
+    ("metadata", "002", "fetch_metadata"),
+    ("partition", "002", "partition"),
+    ("cube", "002", "pack_cube"),
+    ("trends", "002", "update_trends"),
+    ("plots", "003", "run"),
+    ("report", "004", "write_report"),
+    ("trend_plots", "005", "plot_trends"),
+    ("groups", "006", "write_groups"),
+]
+LEAVES = {"plots"}    # Nothing later needs these, so they only run when they are being timed
+
+SLOWER = 1.2    # A stage taking more than this times its --baseline wall time is flagged
+
+SCRIPTS = Path(__file__).parent
+OUTPUT = Path("output/benchmark/")
+
+# Create log file
+LOGGER = logs.setup("benchmark")
+log = LOGGER.info
+
+################################################################################
+# Helper functions
+################################################################################
+
+def snapshot(folder):
+    # {path: (size, mtime)} of every file under folder, except the logs
+    files = {}
+    for root, dirs, names in os.walk(folder):
+        if Path(root) == folder: dirs[:] = [d for d in dirs if d != "logging"]
+        for name in names:
+            stat = os.stat(os.path.join(root, name), follow_symlinks=False)
+            files[os.path.join(root, name)] = (stat.st_size, stat.st_mtime_ns)
+    return files
+
+# Runs in the stage's process, then prints the peak RSS (ru_maxrss, see profiling.rss_bytes) of that process and of
+# the largest of its own children (003's render workers)
+STAGE = """
+import sys, resource
+sys.path.insert(0, {scripts!r})
+from doctor.pipeline import load_script
+load_script({script!r}).{function}()
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+"""
+
+def run_stage(script, function, workdir, env):
+    # Runs one stage in its own process, so its peak memory is its own.
+    # Returns (seconds, peak RSS of the stage, peak RSS of its largest worker, exit status), with RSS in bytes.
+    code = STAGE.format(scripts=str(SCRIPTS), script=script, function=function)
+    with open(workdir / "logging" / "stderr.txt", "a") as stderr:
+        start = time.perf_counter()
+        process = subprocess.run([sys.executable, "-c", code], cwd=workdir, env=env, stdout=subprocess.PIPE, stderr=stderr, text=True)
+        seconds = time.perf_counter() - start
+    if process.returncode != 0: return seconds, 0, 0, process.returncode
+    peak, workers = map(int, process.stdout.split()[-2:])
+    return seconds, profiling.rss_bytes(peak), profiling.rss_bytes(workers), 0
+
+################################################################################
+# Run each stage against the stand-in server and report wall time, peak memory, files touched and requests made
+################################################################################
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline on synthetic data.")
+    parser.add_argument("--scale", default="1k", help=f"{', '.join(SCALES)} or a number of calibration observations (default: 1k)")
+    parser.add_argument("--stages", nargs="*", default=[stage for stage, _, _ in STAGES], help="stages to time (the ones before them still run, untimed)")
+    parser.add_argument("--workdir", type=Path, help="where to build the output tree (default: a temporary folder, deleted afterwards)")
+    parser.add_argument("--baseline", type=Path, help="earlier results .json to compare against")
+    args = parser.parse_args()
+
+    calibrations = SCALES.get(args.scale) or int(args.scale)
+    workdir = (args.workdir or Path(tempfile.mkdtemp(prefix="mwa-doctor-benchmark-"))).resolve()
+    (workdir / "logging").mkdir(parents=True, exist_ok=True)
+
+    log(f"Generating {calibrations} calibrations ({2 * calibrations} observations) in {workdir}...")
+    dataset = synthetic.Dataset(calibrations)
+    server = synthetic.serve(dataset)
+    env = dict(os.environ, MWA_WEB_SERVICE=server.url, MWA_LOG_LEVEL="WARNING")
+
+    last = max(i for i, (stage, _, _) in enumerate(STAGES) if stage in args.stages)
+    results = {}
+    try:
+        for stage, script, function in STAGES[:last + 1]:
+            if stage in LEAVES and stage not in args.stages:
+                continue
+            before = snapshot(workdir)
+            requests_before = dict(server.requests)
+            seconds, peak, workers, status = run_stage(script, function, workdir, env)
+            after = snapshot(workdir)
+
+            if status != 0:
+                log(f"{stage} failed (exit status {status}), see {workdir / 'logging' / 'stderr.txt'}. Stopping...")
+                break
+            if stage not in args.stages:
+                continue
+
+            results[stage] = {
+                "seconds": round(seconds, 3),
+                "peak_mb": round(peak / 1e6, 1),
+                "worker_peak_mb": round(workers / 1e6, 1),
+                "files_created": len(after.keys() - before.keys()),
+                "files_changed": sum(1 for path in after.keys() & before.keys() if after[path] != before[path]),
+                "files_deleted": len(before.keys() - after.keys()),
+                "requests": sum(server.requests.values()) - sum(requests_before.values()),
+            }
+            log(f"{stage:>12}: {seconds:8.2f}s, {peak / 1e6:7.1f} MB peak ({workers / 1e6:.1f} MB workers), {results[stage]['files_created']} created, "
+                f"{results[stage]['files_changed']} changed, {results[stage]['files_deleted']} deleted, {results[stage]['requests']} requests")
+    finally:
+        server.shutdown()
+        if not args.workdir: shutil.rmtree(workdir, ignore_errors=True)
+
+    OUTPUT.mkdir(parents=True, exist_ok=True)
+    report = OUTPUT / f"{args.scale}_{datetime.now().strftime('%Y-%m-%dT%H-%M-%S')}.json"
+    with open(report, "w") as f:
+        json.dump({"scale": args.scale, "calibrations": calibrations, "stages": results}, f, indent=4)
+    log(f"Wrote {report}.")
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)["stages"]
+        for stage, result in results.items():
+            if stage not in baseline: continue
+            ratio = result["seconds"] / max(baseline[stage]["seconds"], 1e-3)
+            flag = "  <-- slower" if ratio > SLOWER else ""
+            log(f"{stage:>12}: {baseline[stage]['seconds']:8.2f}s -> {result['seconds']:8.2f}s ({ratio:.2f}x){flag}")
+
+    log(f"Done!")
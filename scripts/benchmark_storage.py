@@ -0,0 +1,85 @@
+################################################################################
+# benchmark_storage
+# Compare bytes on disk and load time of the artefacts in the old (indent=4) format and the compact storage formats
+################################################################################
+
+import argparse, json, random, tempfile, time
+from pathlib import Path
+from doctor import storage, logs
+
+################################################################################
+# Paths and Constants
+################################################################################
+
+SAMPLE = 500    # Files sampled from each kind of artefact
+REPEATS = 3     # Loads of each sample (the fastest is reported)
+
+OUTPUT = Path("output/")
+
+# Create log file
+LOGGER = logs.setup("benchmark_storage")
+log = LOGGER.info
+
+################################################################################
+# Helper functions
+################################################################################
+
+# Each format: (how it is written, how it is read back)
+FORMATS = {
+    "indent=4": (lambda data: json.dumps(data, indent=4).encode(), lambda path: json.loads(Path(path).read_bytes())),
+    "compact": (lambda data: storage.dumps(data, compress=False), storage.read),
+    "gzip": (lambda data: storage.dumps(data, compress=True), storage.read),
+}
+
+def measure(files, folder):
+    # For each format: apparent bytes, bytes on disk (whole blocks, which is what small files really cost) and
+    # seconds to load every file
+    data = [storage.read(file) for file in files]
+    results = {}
+    for name, (encode, decode) in FORMATS.items():
+        paths = []
+        for i, item in enumerate(data):
+            path = folder / f"{name}_{i}.json"
+            path.write_bytes(encode(item))
+            paths.append(path)
+
+        apparent = sum(path.stat().st_size for path in paths)
+        on_disk = sum(path.stat().st_blocks * 512 for path in paths)
+        best = float("inf")
+        for _ in range(REPEATS):
+            start = time.perf_counter()
+            for path in paths: decode(path)
+            best = min(best, time.perf_counter() - start)
+
+        for path in paths: path.unlink()
+        results[name] = (apparent, on_disk, best)
+    return results
+
+################################################################################
+# Sample each kind of artefact in an output/ tree and compare the formats
+################################################################################
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the storage formats on a sample of the artefacts under output/.")
+    parser.add_argument("--root", type=Path, default=OUTPUT, help="output folder to sample (default: output/)")
+    parser.add_argument("--sample", type=int, default=SAMPLE, help=f"files sampled from each kind of artefact (default: {SAMPLE})")
+    args = parser.parse_args()
+
+    log(f"Parsing with {'orjson' if storage.orjson else 'json'} (the indent=4 format is always parsed with json, as before).")
+    rng = random.Random(0)
+
+    with tempfile.TemporaryDirectory(dir=args.root) as tmp:
+        for pattern in storage.ARTEFACTS:
+            files = sorted(args.root.glob(pattern))
+            if not files: continue
+            files = rng.sample(files, min(args.sample, len(files)))
+
+            results = measure(files, Path(tmp))
+            base_apparent, base_on_disk, base_time = results["indent=4"]
+            log(f"{pattern} ({len(files)} files):")
+            for name, (apparent, on_disk, seconds) in results.items():
+                log(f"    {name:>8}: {apparent / len(files) / 1e3:8.1f} kB/file ({apparent / base_apparent:5.1%}), "
+                    f"{on_disk / len(files) / 1e3:8.1f} kB/file on disk ({on_disk / base_on_disk:5.1%}), "
+                    f"{seconds / len(files) * 1e3:7.3f} ms/load ({seconds / base_time:5.1%})")
+
+    log(f"Done!")
@@ -0,0 +1,56 @@
+################################################################################
+# compare_runs
+# Compare two run reports (output/runs/*.json, see run.py --profile) or two benchmark results (output/benchmark/*.json)
+################################################################################
+
+import argparse, json
+from pathlib import Path
+
+################################################################################
+# Paths and Constants
+################################################################################
+
+SLOWER = 1.2    # Anything taking more than this times as long (or as much memory) as before is flagged
+
+################################################################################
+# Helper functions
+################################################################################
+
+def load(path):
+    with open(path, "r") as f:
+        return json.load(f)["stages"]
+
+def line(name, before, after, unit=""):
+    # "name: before -> after (ratio)", flagged if after is more than SLOWER times before
+    if before is None or after is None:
+        return f"{name:>24}: {'-' if before is None else f'{before:.2f}{unit}':>10} -> {'-' if after is None else f'{after:.2f}{unit}':>10}"
+    ratio = after / max(before, 1e-3)
+    flag = "  <-- worse" if ratio > SLOWER and after - before > 0.1 else ""
+    return f"{name:>24}: {before:9.2f}{unit} -> {after:9.2f}{unit} ({ratio:.2f}x){flag}"
+
+def numbers(stage):
+    # The numeric results of a stage (seconds, cpu_seconds, peak_rss_mb / peak_mb, files_created, requests, ...)
+    return {key: value for key, value in stage.items() if isinstance(value, (int, float))}
+
+################################################################################
+# Print every stage in either file, then its timers (where both have them)
+################################################################################
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare two run reports or benchmark results, stage by stage.")
+    parser.add_argument("before", type=Path)
+    parser.add_argument("after", type=Path)
+    args = parser.parse_args()
+
+    before, after = load(args.before), load(args.after)
+
+    for stage in list(before) + [stage for stage in after if stage not in before]:
+        print(f"{stage}:")
+        old, new = before.get(stage, {}), after.get(stage, {})
+        old_numbers, new_numbers = numbers(old), numbers(new)
+        for key in list(old_numbers) + [key for key in new_numbers if key not in old_numbers]:
+            print(line(key, old_numbers.get(key), new_numbers.get(key)))
+
+        old_timers, new_timers = old.get("timers", {}), new.get("timers", {})
+        for timer in sorted(old_timers.keys() | new_timers.keys()):
+            print(line(f"[{timer}]", old_timers.get(timer, {}).get("seconds"), new_timers.get(timer, {}).get("seconds"), "s"))
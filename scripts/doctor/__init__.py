@@ -0,0 +1,4 @@
+################################################################################
+# doctor
+# Shared helpers for the numbered scripts (001, 002, 003, ...)
+################################################################################
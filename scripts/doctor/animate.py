@@ -0,0 +1,44 @@
+################################################################################
+# animate
+# Stream combined band plots straight into an animation, one frame at a time
+################################################################################
+
+import imageio
+import numpy as np
+from pathlib import Path
+from doctor import profiling, render
+
+################################################################################
+# Helper functions
+################################################################################
+
+def frame(fig):
+    # The figure as an RGBA image, without going through a .png
+    fig.canvas.draw()
+    return np.asarray(fig.canvas.buffer_rgba())
+
+def writer(path, fps):
+    # GIFs use the legacy Pillow GIF writer, which writes each frame as it arrives rather than holding them all
+    # until the end. Anything else (e.g. .mp4) goes through ffmpeg, which needs the imageio-ffmpeg package.
+    if Path(path).suffix == ".gif":
+        return imageio.get_writer(path, format="GIF-PIL", mode="I", duration=1 / fps, loop=0)
+    return imageio.get_writer(path, fps=fps)
+
+################################################################################
+# Animations (these run in the render worker processes)
+################################################################################
+
+def save_animations(jobs):
+    # jobs: [(animation path, fps, [(title, {band: band .json path}, .png path or None), ...]), ...]
+    # Only one frame is ever held in memory, however many dates there are.
+    for path, fps, frames in jobs:
+        with writer(path, fps) as w:
+            for title, band_files, png_path in frames:
+                band_data = {band: render.read_band(file) for band, file in band_files.items() if Path(file).exists()}
+                with profiling.timer("plot"):
+                    fig = render.draw_combined(title, band_data)
+                if png_path:
+                    with profiling.timer("savefig"): fig.savefig(png_path)
+                with profiling.timer("encode"):
+                    w.append_data(frame(fig))
+    return len(jobs)
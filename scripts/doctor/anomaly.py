@@ -0,0 +1,87 @@
+################################################################################
+# anomaly
+# Score every tile, band and polarisation for how far it strays from the rest of the array and from itself
+################################################################################
+
+import warnings
+import numpy as np
+from doctor.bands import band_name
+from doctor.cube import POLS
+
+################################################################################
+# Loading
+################################################################################
+
+def load(cube, calibrator, start, end):
+    # Everything in the cube for a calibrator with start <= obs_id < end, with the tiles lined up:
+    #   obs_ids (obs), bands (obs), tiles (tile)
+    #   gains (obs x tile x pol x channel), chi2 and quality (obs x tile x pol), NaN where a tile is missing
+    rows = cube.select(calibrator, start, end)
+    slots = np.asarray(cube.tiles[rows])
+    tiles = np.unique(slots[slots >= 0])
+
+    obs_index, slot_index = np.nonzero(slots >= 0)
+    tile_index = np.searchsorted(tiles, slots[obs_index, slot_index])
+
+    def dense(array):
+        out = np.full((len(rows), len(tiles), *array.shape[2:]), np.nan, dtype=np.float32)
+        out[obs_index, tile_index] = np.asarray(array[rows])[obs_index, slot_index]
+        return out
+
+    return {
+        "obs_ids": np.asarray(cube.obs_ids[rows]),
+        "bands": np.array([band_name(c[c >= 0]) or "" for c in np.asarray(cube.channels[rows])]),
+        "tiles": tiles,
+        "gains": dense(cube.gains),
+        "chi2": dense(cube.chi2),
+        "quality": dense(cube.quality),
+    }
+
+################################################################################
+# Scoring
+################################################################################
+
+def robust_z(values, axis):
+    # Distance from the median in units of the (normal-scaled) median absolute deviation along axis
+    median = np.nanmedian(values, axis=axis, keepdims=True)
+    mad = 1.4826 * np.nanmedian(np.abs(values - median), axis=axis, keepdims=True)
+    return np.abs(values - median) / np.maximum(mad, 1e-6)
+
+def scores(data):
+    # One row per tile, band and polarisation, most suspicious first:
+    #   array     median over observations and channels of the deviation from all the other tiles in the same observation
+    #   history   90th percentile over observations of the (channel median) deviation from the tile's own median across the window
+    #   chi2      median over observations of the deviation of phase_chi2dof from all the other tiles in the same observation
+    #   missing   fraction of observations where the tile has no solution
+    #   score     the largest of array, history and chi2
+    report = []
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)    # All-NaN slices (missing tiles) are expected
+
+        for band in sorted(set(data["bands"].tolist()) - {""}):    # Plain str, so the report is plain Python data
+            in_band = data["bands"] == band
+            gains = data["gains"][in_band]      # obs x tile x pol x channel
+            chi2 = data["chi2"][in_band]        # obs x tile x pol
+
+            array = np.nanmedian(robust_z(gains, axis=1), axis=(0, 3))
+            history = np.nanpercentile(np.nanmedian(robust_z(gains, axis=0), axis=3), 90, axis=0)
+            chi2_score = np.nanmedian(robust_z(chi2, axis=1), axis=0)
+            missing = np.isnan(gains).all(axis=3).mean(axis=0)
+
+            for t, tile in enumerate(data["tiles"]):
+                for p, pol in enumerate(POLS):
+                    values = [array[t, p], history[t, p], chi2_score[t, p]]
+                    report.append({
+                        "tile": int(tile),
+                        "band": band,
+                        "pol": pol,
+                        "observations": int(in_band.sum()),
+                        "array": round(float(array[t, p]), 3),
+                        "history": round(float(history[t, p]), 3),
+                        "chi2": round(float(chi2_score[t, p]), 3),
+                        "missing": round(float(missing[t, p]), 3),
+                        "score": round(float(np.nanmax(values)) if not np.isnan(values).all() else 0.0, 3),
+                    })
+
+    report.sort(key=lambda row: (-row["score"], row["tile"], row["band"], row["pol"]))
+    return report
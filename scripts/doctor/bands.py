@@ -0,0 +1,20 @@
+################################################################################
+# bands
+# The coarse channel sets used by calibration observations
+################################################################################
+
+BANDS = {
+    "Solar": [58, 61, 65, 69, 73, 77, 81, 86, 91, 96, 101, 107, 113, 120, 127, 134, 142, 150, 158, 167, 177, 187, 210, 226],
+    "Ch57-80": list(range(57, 81)),
+    "Ch81-104": list(range(81, 105)),
+    "Ch109-132": list(range(109, 133)),
+    "Ch133-156": list(range(133, 157)),
+    "Ch157-180": list(range(157, 181)),
+}
+
+def band_name(channels):
+    # Name of the band with exactly these channels, or None if it is not one of the above
+    for name, band in BANDS.items():
+        if list(channels) == band:
+            return name
+    return None
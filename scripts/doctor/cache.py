@@ -0,0 +1,166 @@
+################################################################################
+# cache
+# Persistent cache of web service responses, revalidated with ETag/Last-Modified, and the size-bounded SQLite store
+# of blobs it (and diagnostics' cache of drawn images) keeps them in
+################################################################################
+
+import gzip, sqlite3, threading, time, requests
+from pathlib import Path
+
+HTTP_CACHE = Path("output/http_cache.db")
+
+MAX_BYTES = 500 * 1024**2    # Least recently used responses are dropped once the (compressed) bodies add up to more than this
+
+# Seconds a response is used without asking the server again. After that it is revalidated, which costs a round trip
+# but no download if the server says it has not changed (304). Endpoints that are not listed are never cached.
+TTLS = {
+    "/metadata/find": 10 * 60,          # Pages shift as new observations arrive
+    "/metadata/obs": 7 * 24 * 3600,     # Metadata of a past observation hardly ever changes
+}
+# /calib/get_cal_json is left out on purpose: every fit fetched is already kept in output/001/calibrations/
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    url TEXT PRIMARY KEY,               -- including the query string
+    etag TEXT,
+    last_modified TEXT,
+    content_type TEXT,
+    body BLOB NOT NULL,                 -- gzipped
+    size INTEGER NOT NULL,              -- of the gzipped body
+    stored REAL NOT NULL,               -- when the server last sent or confirmed this response
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS by_last_used ON responses (last_used);
+"""
+
+################################################################################
+# Least recently used blobs
+################################################################################
+
+class BlobStore:
+    # One table (created by schema) of blobs, keyed by its key column, with at least body, size and last_used columns.
+    # The least recently used rows are dropped once the sizes add up to more than max_bytes. lock is shared by every
+    # thread using the store.
+    def __init__(self, path, schema, table, key, max_bytes):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.executescript(schema)
+        self.table = table
+        self.key = key
+        self.lock = threading.Lock()
+        self.max_bytes = max_bytes
+        self.total = self.db.execute(f"SELECT COALESCE(SUM(size), 0) FROM {table}").fetchone()[0]
+
+    def close(self):
+        self.db.close()
+
+    def find(self, key, columns):
+        # The columns of key's row, or None if it is not stored (or has been evicted)
+        with self.lock:
+            return self.db.execute(f"SELECT {', '.join(columns)} FROM {self.table} WHERE {self.key} = ?", (key,)).fetchone()
+
+    def use(self, key, **values):
+        # Marks key's row as just used, setting any other columns given too
+        values.setdefault("last_used", time.time())
+        with self.lock, self.db:
+            self.db.execute(f"UPDATE {self.table} SET {', '.join(f'{column} = ?' for column in values)} WHERE {self.key} = ?",
+                            (*values.values(), key))
+
+    def put(self, key, body, **values):
+        # Stores (or replaces) key's row, with the other columns given
+        values = {self.key: key, "body": body, "size": len(body), "last_used": time.time(), **values}
+        with self.lock, self.db:
+            old = self.db.execute(f"SELECT size FROM {self.table} WHERE {self.key} = ?", (key,)).fetchone()
+            self.total += len(body) - (old[0] if old else 0)
+            self.db.execute(f"INSERT OR REPLACE INTO {self.table} ({', '.join(values)}) VALUES ({', '.join('?' * len(values))})",
+                            tuple(values.values()))
+            self.evict()
+
+    def evict(self):
+        # Drops the least recently used rows until the store is back under 90% of max_bytes.
+        # The running total is checked against the database first, in case another run has changed it.
+        if self.total <= self.max_bytes: return
+        self.total = self.db.execute(f"SELECT COALESCE(SUM(size), 0) FROM {self.table}").fetchone()[0]
+        if self.total <= self.max_bytes: return
+
+        target = self.total - 0.9 * self.max_bytes
+        dropped = []
+        for key, size in self.db.execute(f"SELECT {self.key}, size FROM {self.table} ORDER BY last_used"):
+            if target <= 0: break
+            dropped.append((key,))
+            target -= size
+            self.total -= size
+        self.db.executemany(f"DELETE FROM {self.table} WHERE {self.key} = ?", dropped)
+
+################################################################################
+# Cache
+################################################################################
+
+class ResponseCache:
+    def __init__(self, path=HTTP_CACHE, max_bytes=MAX_BYTES, ttls=TTLS):
+        self.blobs = BlobStore(path, SCHEMA, "responses", "url", max_bytes)
+        self.lock = self.blobs.lock    # Shared by every thread using the session
+        self.ttls = ttls
+        self.stats = {"fresh": 0, "revalidated": 0, "changed": 0, "missed": 0}
+
+    def close(self):
+        self.blobs.close()
+
+    def summary(self):
+        return ", ".join(f"{count} {name}" for name, count in self.stats.items())
+
+    ############################################################################
+    # Requests
+    ############################################################################
+
+    def get(self, s, endpoint, url, params, timeout):
+        # Same as s.get(url, params=params, timeout=timeout), but answered from the cache where possible
+        ttl = self.ttls.get(endpoint)
+        if ttl is None:
+            return s.get(url, params=params, timeout=timeout)
+
+        key = requests.Request("GET", url, params=params).prepare().url
+        row = self.blobs.find(key, ["etag", "last_modified", "content_type", "body", "stored"])
+
+        if row and time.time() - row[4] < ttl:
+            self.blobs.use(key)
+            self.count("fresh")
+            return self.response(key, row)
+
+        headers = {}
+        if row and row[0]: headers["If-None-Match"] = row[0]
+        if row and row[1]: headers["If-Modified-Since"] = row[1]
+        r = s.get(url, params=params, timeout=timeout, headers=headers)
+
+        if r.status_code == 304 and row:
+            now = time.time()
+            self.blobs.use(key, last_used=now, stored=now)
+            self.count("revalidated")
+            return self.response(key, row)
+        if r.status_code == 200 and "no-store" not in r.headers.get("Cache-Control", ""):
+            self.store(key, r)
+        self.count("changed" if row else "missed")
+        return r
+
+    def count(self, name):
+        # Under the lock, as fetch's worker threads share the cache
+        with self.lock:
+            self.stats[name] += 1
+
+    def response(self, url, row):
+        # A stand-in for the response the server sent when the entry was stored
+        r = requests.Response()
+        r.status_code = 200
+        r.url = url
+        r._content = gzip.decompress(row[3])
+        r.encoding = "utf-8"
+        if row[0]: r.headers["ETag"] = row[0]
+        if row[1]: r.headers["Last-Modified"] = row[1]
+        if row[2]: r.headers["Content-Type"] = row[2]
+        r.from_cache = True
+        return r
+
+    def store(self, url, r):
+        now = time.time()
+        self.blobs.put(url, gzip.compress(r.content, mtime=0), etag=r.headers.get("ETag"), last_modified=r.headers.get("Last-Modified"),
+                       content_type=r.headers.get("Content-Type"), stored=now, last_used=now)
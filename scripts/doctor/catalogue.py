@@ -0,0 +1,185 @@
+################################################################################
+# catalogue
+# SQLite catalogue of every observation, filled in by 001 and 002
+################################################################################
+
+import sqlite3
+from pathlib import Path
+
+CATALOGUE = Path("output/catalogue.db")
+
+RETRY_MIN = 3600                # A failed request (see failures below) is tried again after this long (seconds)...
+RETRY_MAX = 7 * 24 * 3600       # ...doubling with every further failure, up to this
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS observations (
+    obs_id INTEGER PRIMARY KEY,         -- also the GPS start time of the observation
+    starttime INTEGER NOT NULL,
+    project TEXT,
+    calibrator TEXT,
+    channels TEXT,                      -- coarse channel numbers, comma separated
+    has_fit INTEGER NOT NULL DEFAULT 0,
+    has_metadata INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS by_calibrator ON observations (calibrator, starttime);
+CREATE INDEX IF NOT EXISTS by_project ON observations (project, has_fit, starttime);
+
+CREATE TABLE IF NOT EXISTS failures (
+    obs_id INTEGER NOT NULL,            -- requests that failed for a reason other than a 404 (which goes in not_found)
+    step TEXT NOT NULL,                 -- e.g. "metadata"
+    error TEXT NOT NULL,                -- the last reason it failed
+    attempts INTEGER NOT NULL,
+    last_tried REAL NOT NULL,           -- unix time
+    PRIMARY KEY (obs_id, step)
+);
+
+CREATE TABLE IF NOT EXISTS not_found (
+    obs_id INTEGER PRIMARY KEY,         -- fits that /calib/get_cal_json answered with 404
+    last_tried REAL NOT NULL,           -- unix time
+    attempts INTEGER NOT NULL
+);
+"""
+
+################################################################################
+# Retries
+################################################################################
+
+def retry_due(attempts, last_tried, now):
+    wait = min(RETRY_MAX, RETRY_MIN * 2 ** (attempts - 1))
+    return now - last_tried >= wait
+
+################################################################################
+# Catalogue
+################################################################################
+
+class Catalogue:
+    def __init__(self, path=CATALOGUE):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    ############################################################################
+    # Writing
+    ############################################################################
+
+    def add_observations(self, rows):
+        # rows are rows of past.csv (obs_id, name, creator, project code, ...)
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO observations (obs_id, starttime, project) VALUES (?1, ?1, ?2) "
+                "ON CONFLICT (obs_id) DO UPDATE SET project = excluded.project",
+                ((int(row[0]), row[3].strip()) for row in rows))
+
+    def set_fits(self, obs_ids, has_fit=True):
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO observations (obs_id, starttime, has_fit) VALUES (?1, ?1, ?2) "
+                "ON CONFLICT (obs_id) DO UPDATE SET has_fit = excluded.has_fit",
+                ((int(obs_id), int(has_fit)) for obs_id in obs_ids))
+
+    def set_metadata(self, observations):
+        # observations are /metadata/obs responses
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO observations (obs_id, starttime, calibrator, channels, has_metadata) VALUES (?1, ?2, ?3, ?4, 1) "
+                "ON CONFLICT (obs_id) DO UPDATE SET starttime = excluded.starttime, calibrator = excluded.calibrator, "
+                "channels = excluded.channels, has_metadata = 1",
+                ((int(obs["metadata"]["observation_number"]), int(obs["starttime"]), obs["metadata"]["calibrators"],
+                  ",".join(str(c) for c in obs["rfstreams"]["0"]["frequencies"])) for obs in observations))
+
+    def set_not_found(self, obs_ids, when, attempts=None):
+        # Counts another attempt for each obs_id, or sets the count outright (e.g. when importing missing.csv)
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO not_found (obs_id, last_tried, attempts) VALUES (?1, ?2, COALESCE(?3, 1)) "
+                "ON CONFLICT (obs_id) DO UPDATE SET last_tried = excluded.last_tried, attempts = COALESCE(?3, attempts + 1)",
+                ((int(obs_id), when, attempts) for obs_id in obs_ids))
+
+    def clear_not_found(self, obs_ids):
+        with self.db:
+            self.db.executemany("DELETE FROM not_found WHERE obs_id = ?", ((int(obs_id),) for obs_id in obs_ids))
+
+    def set_failed(self, step, errors, when):
+        # errors is {obs_id: reason}. Counts another attempt for each.
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO failures (obs_id, step, error, attempts, last_tried) VALUES (?, ?, ?, 1, ?) "
+                "ON CONFLICT (obs_id, step) DO UPDATE SET error = excluded.error, attempts = attempts + 1, last_tried = excluded.last_tried",
+                ((int(obs_id), step, error, when) for obs_id, error in errors.items()))
+
+    def clear_failed(self, step, obs_ids):
+        with self.db:
+            self.db.executemany("DELETE FROM failures WHERE obs_id = ? AND step = ?", ((int(obs_id), step) for obs_id in obs_ids))
+
+    ############################################################################
+    # Shards (see shards.py)
+    ############################################################################
+
+    def copy(self, path):
+        # A consistent copy of the whole catalogue, for a shard to work on
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        destination = sqlite3.connect(path)
+        self.db.backup(destination)
+        destination.close()
+
+    def merge(self, path, belongs):
+        # Takes what the catalogue at path (a shard's copy) has for every obs_id where belongs(obs_id) is true, in place of
+        # what this one has. Observations are only ever added or updated; 404s and failures the shard cleared are dropped.
+        self.db.create_function("belongs", 1, belongs, deterministic=True)
+        self.db.execute("ATTACH DATABASE ? AS shard", (str(path),))
+        try:
+            with self.db:
+                self.db.execute("INSERT OR REPLACE INTO observations SELECT * FROM shard.observations WHERE belongs(obs_id)")
+                for table in ["failures", "not_found"]:
+                    self.db.execute(f"DELETE FROM main.{table} WHERE belongs(obs_id)")
+                    self.db.execute(f"INSERT INTO main.{table} SELECT * FROM shard.{table} WHERE belongs(obs_id)")
+        finally:
+            self.db.execute("DETACH DATABASE shard")
+
+    ############################################################################
+    # Reading
+    ############################################################################
+
+    def count(self, where="1", params=()):
+        return self.db.execute(f"SELECT COUNT(*) FROM observations WHERE {where}", params).fetchone()[0]
+
+    def ids(self, where="1", params=()):
+        return [obs_id for (obs_id,) in self.db.execute(f"SELECT obs_id FROM observations WHERE {where} ORDER BY obs_id", params)]
+
+    def window(self, calibrator, start, end):
+        # obs_ids of a calibrator's observations with fits and metadata, with start <= GPS start time < end
+        return self.ids("calibrator = ? AND starttime >= ? AND starttime < ? AND has_fit = 1 AND has_metadata = 1", (calibrator, start, end))
+
+    def not_found(self):
+        # {obs_id: (last_tried, attempts)}
+        return {obs_id: (last_tried, attempts) for obs_id, last_tried, attempts in self.db.execute("SELECT obs_id, last_tried, attempts FROM not_found")}
+
+    def failed(self, step):
+        # {obs_id: (error, attempts, last_tried)}
+        return {obs_id: (error, attempts, last_tried) for obs_id, error, attempts, last_tried in
+                self.db.execute("SELECT obs_id, error, attempts, last_tried FROM failures WHERE step = ?", (step,))}
+
+    def due(self, step, now):
+        # {obs_id: error} of the failures of a step that are due another try (see retry_due)
+        return {obs_id: error for obs_id, (error, attempts, last_tried) in self.failed(step).items()
+                if retry_due(attempts, last_tried, now)}
+
+    def listed(self, obs_ids):
+        # {obs_id: (starttime, project)} of the obs_ids that are in the catalogue (from past.csv or earlier metadata)
+        obs_ids = [int(obs_id) for obs_id in obs_ids]
+        found = {}
+        for i in range(0, len(obs_ids), 500):
+            chunk = obs_ids[i:i + 500]
+            found.update((obs_id, (starttime, project)) for obs_id, starttime, project in self.db.execute(
+                f"SELECT obs_id, starttime, project FROM observations WHERE obs_id IN ({','.join('?' * len(chunk))})", chunk))
+        return found
+
+    def calibrators(self):
+        # Number of observations with metadata for each calibrator
+        return dict(self.db.execute("SELECT calibrator, COUNT(*) FROM observations WHERE has_metadata = 1 GROUP BY calibrator"))
+
+    def calibrator_ids(self, calibrator):
+        return self.ids("calibrator = ? AND has_metadata = 1", (calibrator,))
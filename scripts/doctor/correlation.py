@@ -0,0 +1,173 @@
+################################################################################
+# correlation
+# Find groups of tiles (e.g. on a shared receiver or cable run) whose gains go wrong together
+################################################################################
+
+import warnings
+import numpy as np
+from pathlib import Path
+from doctor.bands import band_name
+from doctor.cube import POLS
+
+################################################################################
+# Layout
+################################################################################
+
+# <folder>/<obs_id // 100000>/<obs_id>.npz, one file per observation (they never change once in the cube), holding:
+#   tiles       tile numbers (tile)
+#   band        band_name of the observation's channels ("" if none)
+#   similarity  cosine similarity of every pair of tiles' normalised gain curves (pol x tile x tile, float16, NaN if missing)
+#   deviation   root mean square of each tile's normalised gain curve (tile x pol, NaN if missing)
+# A tile's normalised gain curve is the log of its gains over the median of the array in each channel, so a healthy tile's
+# is close to zero and two tiles dropping (or rippling) the same way have curves pointing the same way.
+BATCH = 256    # Observations worked out at once. Each needs about 400 kB while it is (its float64 similarity matrix,
+               # 128 x 128 x 2 x 8 bytes, and the gains, curves and masks worked out on the way), so about 100 MB a batch.
+
+################################################################################
+# Similarity of the tiles in a batch of observations
+################################################################################
+
+def normalised(gains):
+    # gains: obs x tile x pol x channel. NaN where a gain (or the whole tile) is missing.
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)    # All-NaN slices (unused channels) are expected
+        array = np.nanmedian(gains, axis=1, keepdims=True)
+        return np.log(np.where(gains > 0, gains, np.nan) / array)
+
+def similarity(gains):
+    # (similarity as obs x pol x tile x tile, deviation as obs x tile x pol) of a batch of observations, with one
+    # matrix product per observation and polarisation
+    curves = np.moveaxis(normalised(gains), 1, 2)       # obs x pol x tile x channel
+    counts = (~np.isnan(curves)).sum(axis=3)
+    curves = np.nan_to_num(curves)
+
+    norms = np.sqrt((curves ** 2).sum(axis=3))
+    unit = curves / np.where(norms > 0, norms, np.inf)[..., None]
+    matrix = unit @ unit.swapaxes(2, 3)
+
+    missing = counts == 0
+    matrix[np.broadcast_to(missing[..., :, None] | missing[..., None, :], matrix.shape)] = np.nan
+    deviation = np.where(missing, np.nan, norms / np.sqrt(np.maximum(counts, 1)))
+    return matrix, deviation.swapaxes(1, 2)
+
+################################################################################
+# Store
+################################################################################
+
+class CorrelationStore:
+    def __init__(self, folder):
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+
+    def path(self, obs_id):
+        return self.folder / str(obs_id // 100000) / f"{obs_id}.npz"
+
+    def update(self, cube, rows, log=print):
+        # Works out every observation in rows that is not stored yet. Returns how many were.
+        new = [row for row in rows if not self.path(int(cube.obs_ids[row])).exists()]
+        if not new: return 0
+        log(f"Comparing the tiles of {len(new)} new observations ({len(rows) - len(new)} already done)...")
+
+        for i in range(0, len(new), BATCH):
+            batch = np.sort(new[i:i + BATCH])
+            tiles = np.asarray(cube.tiles[batch])
+            gains = np.asarray(cube.gains[batch])
+            gains[tiles < 0] = np.nan
+            matrices, deviations = similarity(gains)
+
+            for row, slots, matrix, deviation in zip(batch, tiles, matrices, deviations):
+                used = slots >= 0
+                channels = cube.channels[row]
+                path = self.path(int(cube.obs_ids[row]))
+                path.parent.mkdir(parents=True, exist_ok=True)
+                tmp = path.with_name(path.name + ".tmp")
+                with open(tmp, "wb") as f:
+                    np.savez(f, tiles=slots[used], band=band_name(channels[channels >= 0]) or "",
+                             similarity=matrix[:, used][:, :, used].astype(np.float16), deviation=deviation[used])
+                tmp.replace(path)
+        return len(new)
+
+    def load(self, cube, rows):
+        # Everything stored for rows, with the tiles lined up:
+        #   obs_ids (obs), bands (obs), tiles (tile)
+        #   similarity (obs x pol x tile x tile) and deviation (obs x tile x pol), NaN where a tile is missing
+        obs_ids = np.asarray(cube.obs_ids[rows])
+        stored = []
+        for obs_id in obs_ids:
+            with np.load(self.path(int(obs_id))) as f:
+                stored.append({name: f[name] for name in f.files})
+        tiles = np.unique(np.concatenate([each["tiles"] for each in stored])) if stored else np.array([], dtype=np.int32)
+
+        matrices = np.full((len(stored), len(POLS), len(tiles), len(tiles)), np.nan, dtype=np.float32)
+        deviations = np.full((len(stored), len(tiles), len(POLS)), np.nan, dtype=np.float32)
+        for i, each in enumerate(stored):
+            index = np.searchsorted(tiles, each["tiles"])
+            matrices[i][:, index[:, None], index] = each["similarity"]
+            deviations[i, index] = each["deviation"]
+        return {"obs_ids": obs_ids, "bands": np.array([str(each["band"]) for each in stored]), "tiles": tiles,
+                "similarity": matrices, "deviation": deviations}
+
+################################################################################
+# Grouping
+################################################################################
+
+def components(linked):
+    # Connected components (of more than one tile) of a symmetric boolean matrix, largest first
+    unseen = set(range(len(linked)))
+    found = []
+    while unseen:
+        group, edge = set(), [unseen.pop()]
+        while edge:
+            group.update(edge)
+            edge = [int(j) for j in np.flatnonzero(linked[edge].any(axis=0)) if j not in group]
+            unseen.difference_update(edge)
+        if len(group) > 1: found.append(sorted(group))
+    return sorted(found, key=lambda group: (-len(group), group[0]))
+
+def groups(data, similar=0.7, deviating=3, together=0.5, minimum=3):
+    # Tiles that go wrong together over the window, one row per group and polarisation, largest first:
+    #   tiles          the tiles in the group (each linked to another in it, so a chain can join two pairs)
+    #   receivers      tile // 10 of each of them, which is the receiver on the 128 tile array's numbering
+    #   observations   observations where at least two of them were deviating in the same way
+    #   bands          the bands of those observations
+    #   first, last    obs_ids of the first and last of them
+    #   similarity     mean similarity of the pairs in the group in those observations
+    # A tile is deviating in an observation when its deviation is more than `deviating` median absolute deviations (normal
+    # scaled) above the median of the array's. Two tiles are linked when, of the observations (at least `minimum`) where
+    # either deviates, they both deviate with a similarity of at least `similar` in at least `together` of them.
+    report = []
+    tiles = data["tiles"]
+    for p, pol in enumerate(POLS):
+        matrices = data["similarity"][:, p]                         # obs x tile x tile
+        deviation = data["deviation"][:, :, p]                     # obs x tile
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            median = np.nanmedian(deviation, axis=1, keepdims=True)
+            mad = 1.4826 * np.nanmedian(np.abs(deviation - median), axis=1, keepdims=True)
+        off = (deviation - median) / np.maximum(mad, 1e-6) > deviating    # NaN (missing) counts as not deviating
+
+        same = off[:, :, None] & off[:, None, :] & (matrices >= similar)
+        same[:, np.arange(len(tiles)), np.arange(len(tiles))] = False
+        either = off[:, :, None] | off[:, None, :]
+        counts, totals = same.sum(axis=0), either.sum(axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            linked = (totals >= minimum) & (counts / totals >= together)
+
+        for group in components(linked):
+            pairs = same[:, group][:, :, group]
+            seen = pairs.any(axis=(1, 2))
+            values = np.where(pairs, matrices[:, group][:, :, group], np.nan)[seen]
+            mean = float(np.nanmean(values))    # Every group has at least one such observation (see linked)
+            report.append({
+                "pol": pol,
+                "tiles": [int(tiles[t]) for t in group],
+                "receivers": sorted({int(tiles[t]) // 10 for t in group}),
+                "observations": int(seen.sum()),
+                "bands": sorted(set(data["bands"][seen].tolist()) - {""}),
+                "first": int(data["obs_ids"][seen].min()),
+                "last": int(data["obs_ids"][seen].max()),
+                "similarity": round(mean, 3),
+            })
+
+    report.sort(key=lambda row: (-len(row["tiles"]), -row["observations"], row["tiles"], row["pol"]))
+    return report
@@ -0,0 +1,217 @@
+################################################################################
+# cube
+# Every calibration solution packed into a handful of memory-mapped arrays
+################################################################################
+
+import json
+import numpy as np
+from pathlib import Path
+from doctor import storage
+
+################################################################################
+# Layout
+################################################################################
+
+# One file per field, one row per observation, so new observations are appended to the end of each file
+# without touching what is already there. Rows are in the order they were added, not by obs_id.
+#   obs_ids     obs_id (which is also the GPS start time of the observation)
+#   calibrator  index into the "calibrators" list in meta.json
+#   channels    coarse channel numbers of the observation (-1 where there are fewer than CHANNELS)
+#   tiles       tile number in each slot (-1 for unused slots)
+#   gains       gains of each slot, polarisation (X, Y) and channel (NaN where missing)
+#   sigma, chi2, quality    phase_sigma_resid, phase_chi2dof and phase_fit_quality of each slot and polarisation
+# Everything is float64, as in the fits, so plots and band files made from the cube match ones made from the .jsons.
+# Cubes written before meta.json recorded "gains" hold float32 gains; they can still be read, and 002 rebuilds them.
+# There are as many slots as the observation with the most tiles needs (at least 128): the cube is widened when one needs more.
+POLS = ["X", "Y"]
+
+GAINS = "float64"
+SLOTTED = ["tiles", "gains", "sigma", "chi2", "quality"]    # Fields with a slot for each tile
+
+def fields(slots, channels, gains=GAINS):
+    return {
+        "obs_ids": (np.int64, ()),
+        "calibrator": (np.int16, ()),
+        "channels": (np.int16, (channels,)),
+        "tiles": (np.int32, (slots,)),
+        "gains": (np.dtype(gains).type, (slots, len(POLS), channels)),
+        "sigma": (np.float64, (slots, len(POLS))),
+        "chi2": (np.float64, (slots, len(POLS))),
+        "quality": (np.float64, (slots, len(POLS))),
+    }
+
+################################################################################
+# Converting fit and observation .jsons
+################################################################################
+
+def number(value):
+    return np.nan if value is None else value
+
+def empty(dtype, shape):
+    # -1 for integers (unused slots and channels), NaN for everything else
+    return np.full(shape, -1 if np.issubdtype(dtype, np.integer) else np.nan, dtype=dtype)
+
+def plain(values):
+    # Values back to the shortest floats that print the same (so float32 gains from older cubes do not gain extra digits), NaN back to None
+    return [None if np.isnan(v) else float(str(v)) for v in np.atleast_1d(values)]
+
+def record(fit_data, obs_data, channels=24):
+    # One row of the cube from a fit and its observation metadata, with a slot for each of its tiles (GainsCube.append
+    # pads it to the cube's width). Only tiles that are in the observation's tileset and have a solution in the fit are kept.
+    tileset = obs_data["rfstreams"]["0"]["tileset"]["xlist"]
+    tiles = [tile for tile in tileset if str(tile) in fit_data]
+    frequencies = obs_data["rfstreams"]["0"]["frequencies"][:channels]
+
+    row = {name: empty(dtype, shape) for name, (dtype, shape) in fields(len(tiles), channels).items()}
+    row["obs_ids"][...] = obs_data["metadata"]["observation_number"]
+    row["channels"][:len(frequencies)] = frequencies
+    row["tiles"][:len(tiles)] = tiles
+
+    for slot, tile in enumerate(tiles):
+        for p, pol in enumerate(POLS):
+            solution = fit_data[str(tile)][pol]
+            gains = [number(gain) for gain in solution["gains"][:channels]]
+            row["gains"][slot, p, :len(gains)] = gains
+            row["sigma"][slot, p] = number(solution["phase_sigma_resid"])
+            row["chi2"][slot, p] = number(solution["phase_chi2dof"])
+            row["quality"][slot, p] = number(solution["phase_fit_quality"])
+
+    return obs_data["metadata"]["calibrators"], row
+
+################################################################################
+# Cube
+################################################################################
+
+class GainsCube:
+    def __init__(self, folder, slots=128, channels=24):
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+
+        self.meta_path = self.folder / "meta.json"
+        if self.meta_path.exists():
+            with open(self.meta_path, "r") as f:
+                self.meta = json.load(f)
+        else:
+            self.meta = {"count": 0, "slots": slots, "channels": channels, "gains": GAINS, "calibrators": []}
+            self.write_meta()
+
+        self.fields = fields(self.meta["slots"], self.meta["channels"], self.meta.get("gains", "float32"))
+        self.map()
+
+    def outdated(self):
+        # Written with float32 gains, before they were kept at full precision
+        return self.meta.get("gains", "float32") != GAINS
+
+    def __len__(self):
+        return self.meta["count"]
+
+    def path(self, name):
+        return self.folder / f"{name}.bin"
+
+    def write_meta(self):
+        # The count in meta.json is only updated once the rows are written, so anything past it from an interrupted append is ignored
+        storage.write_json(self.meta_path, self.meta)
+
+    def map(self):
+        count = len(self)
+        for name, (dtype, shape) in self.fields.items():
+            if count: array = np.memmap(self.path(name), dtype=dtype, mode="r", shape=(count, *shape))
+            else: array = np.empty((0, *shape), dtype=dtype)
+            setattr(self, name, array)
+
+        # Index from obs_id to row
+        self.order = np.argsort(self.obs_ids, kind="stable")
+        self.sorted_ids = np.asarray(self.obs_ids)[self.order]
+        self.rows = dict(zip(self.obs_ids.tolist(), range(count)))
+
+    ############################################################################
+    # Reading
+    ############################################################################
+
+    def __contains__(self, obs_id):
+        return int(obs_id) in self.rows
+
+    def select(self, calibrator=None, start=None, end=None):
+        # Rows (in obs_id order) of the observations of a calibrator with start <= obs_id < end.
+        # obs_ids are GPS seconds, so start and end are GPS times.
+        lo = 0 if start is None else np.searchsorted(self.sorted_ids, start, side="left")
+        hi = len(self) if end is None else np.searchsorted(self.sorted_ids, end, side="left")
+        rows = self.order[lo:hi]
+
+        if calibrator is not None:
+            if calibrator not in self.meta["calibrators"]: return rows[:0]
+            rows = rows[self.calibrator[rows] == self.meta["calibrators"].index(calibrator)]
+        return rows
+
+    def tile(self, tile, rows=None):
+        # Gains of one tile as observation x polarisation x channel (NaN where the tile was not in the observation)
+        rows = np.arange(len(self)) if rows is None else np.asarray(rows)
+        tiles = self.tiles[rows]
+        present = (tiles == tile).any(axis=1)
+        slots = (tiles == tile).argmax(axis=1)
+
+        gains = np.full((len(rows), len(POLS), self.meta["channels"]), np.nan, dtype=self.gains.dtype)
+        gains[present] = self.gains[rows[present], slots[present]]
+        return gains
+
+    def calibrator_name(self, row):
+        return self.meta["calibrators"][self.calibrator[row]]
+
+    ############################################################################
+    # Writing
+    ############################################################################
+
+    def append(self, records):
+        # records is a list of (calibrator, row) pairs from record(). Observations already in the cube are skipped.
+        new = {}
+        for calibrator, row in records:
+            obs_id = int(row["obs_ids"])
+            if obs_id in self.rows or obs_id in new: continue
+            if calibrator not in self.meta["calibrators"]:
+                self.meta["calibrators"].append(calibrator)
+            row["calibrator"][...] = self.meta["calibrators"].index(calibrator)
+            new[obs_id] = row
+        if not new: return 0
+
+        widest = max(len(row["tiles"]) for row in new.values())
+        if widest > self.meta["slots"]: self.widen(widest)
+
+        for name, (dtype, shape) in self.fields.items():
+            row_bytes = np.dtype(dtype).itemsize * int(np.prod(shape, dtype=np.int64))
+            with open(self.path(name), "ab") as f:
+                f.truncate(len(self) * row_bytes)
+                f.write(np.stack([self.pad(name, row[name]) for row in new.values()]).astype(dtype).tobytes())
+
+        self.meta["count"] += len(new)
+        self.write_meta()
+        self.map()
+        return len(new)
+
+    def pad(self, name, values):
+        # A row's values for a field, with unused slots added up to the cube's width
+        dtype, shape = self.fields[name]
+        if name not in SLOTTED or len(values) == shape[0]: return values
+        padded = empty(dtype, shape)
+        padded[:len(values)] = values
+        return padded
+
+    def widen(self, slots):
+        # Rewrites the fields with a slot axis with more slots (unused), for an observation with more tiles than there is
+        # room for. Every new file is written before any is swapped in and meta.json is updated straight after; a cube
+        # left between the two (by a crash) has to be rebuilt, by deleting its folder and running 002's pack_cube.
+        count = len(self)
+        widened = fields(slots, self.meta["channels"], self.meta.get("gains", "float32"))
+        for name in SLOTTED:
+            dtype, shape = widened[name]
+            with open(self.path(name).with_suffix(".tmp"), "wb") as f:
+                for start in range(0, count, 4096):
+                    chunk = empty(dtype, (min(4096, count - start), *shape))
+                    chunk[:, :self.meta["slots"]] = getattr(self, name)[start:start + 4096]
+                    f.write(chunk.tobytes())
+        for name in SLOTTED:
+            self.path(name).with_suffix(".tmp").replace(self.path(name))
+
+        self.meta["slots"] = slots
+        self.write_meta()
+        self.fields = widened
+        self.map()
@@ -0,0 +1,180 @@
+################################################################################
+# diagnostics
+# Draw tile plots, combined band figures and animations from the gains cube only when they are asked for (see serve.py)
+################################################################################
+
+import io, threading
+import imageio
+import numpy as np
+from datetime import datetime, timedelta
+from pathlib import Path
+from astropy.time import Time
+from doctor import anomaly, animate, render, window
+from doctor.cache import BlobStore
+from doctor.bands import BANDS, band_name
+from doctor.cube import GainsCube
+
+RENDER_CACHE = Path("output/render_cache.db")
+
+MAX_BYTES = 200 * 1024**2    # Least recently viewed images are dropped once they add up to more than this
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    key TEXT PRIMARY KEY,               -- what was drawn, and from which version of the cube
+    content_type TEXT NOT NULL,
+    body BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS by_last_used ON images (last_used);
+"""
+
+################################################################################
+# Cache of drawn images (kept between runs of the server)
+################################################################################
+
+class RenderCache:
+    def __init__(self, path=RENDER_CACHE, max_bytes=MAX_BYTES):
+        self.blobs = BlobStore(path, SCHEMA, "images", "key", max_bytes)    # Shared by every request thread
+        self.stats = {"hits": 0, "drawn": 0}
+
+    def summary(self):
+        return f"{self.stats['hits']} hits, {self.stats['drawn']} drawn, {self.blobs.total / 1e6:.1f} MB cached"
+
+    def get(self, key):
+        # (content type, body), or None if it has not been drawn (or has been evicted)
+        row = self.blobs.find(key, ["content_type", "body"])
+        if row is None: return None
+        self.blobs.use(key)
+        with self.blobs.lock:
+            self.stats["hits"] += 1
+        return row
+
+    def store(self, key, content_type, body):
+        self.blobs.put(key, body, content_type=content_type)
+        with self.blobs.lock:
+            self.stats["drawn"] += 1
+
+################################################################################
+# Drawing from the cube
+################################################################################
+
+def png(fig):
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png")
+    return buffer.getvalue()
+
+class Diagnostics:
+    # Everything is read from the gains cube, which is reopened whenever 002 has added to it. The number of observations
+    # in the cube is part of every cache key, so nothing drawn from older data is ever shown.
+    def __init__(self, cube_folder, cache=None, y_lim=render.Y_LIM, fps=1):
+        self.cube_folder = Path(cube_folder)
+        self.cache = cache or RenderCache()
+        self.fps = fps
+        self.lock = threading.Lock()    # matplotlib (and the figures render reuses) is not thread safe
+        self.loading = threading.RLock()    # Held while the cube is reopened or a ranking worked out, by one request thread at a time
+        self.loaded = None
+        self.rankings = {}
+        render.setup(y_lim)
+
+    def cube(self):
+        meta = self.cube_folder / "meta.json"
+        stamp = meta.stat().st_mtime_ns if meta.exists() else 0
+        with self.loading:
+            if self.loaded is None or self.loaded[0] != stamp:
+                self.loaded = stamp, GainsCube(self.cube_folder)
+                self.rankings = {}
+            return self.loaded[1]
+
+    def cached(self, key, content_type, draw):
+        # The image for key, drawing it (once, however many requests ask at the same time) if it is not cached
+        key = f"{len(self.cube())}:{key}"
+        hit = self.cache.get(key)
+        if hit: return hit
+        with self.lock:
+            hit = self.cache.get(key)
+            if hit: return hit
+            body = draw()
+        self.cache.store(key, content_type, body)
+        return content_type, body
+
+    ############################################################################
+    # Listings
+    ############################################################################
+
+    def calibrators(self):
+        return list(self.cube().meta["calibrators"])
+
+    def ranking(self, calibrator, start, end):
+        # anomaly.scores for the calibrator and date range (most suspicious first), worked out once per version of the cube
+        with self.loading:
+            cube = self.cube()
+            key = calibrator, start, end
+            if key not in self.rankings:
+                self.rankings[key] = anomaly.scores(anomaly.load(cube, calibrator, *window.gps_bounds(start, end)))
+            return self.rankings[key]
+
+    def observations(self, calibrator, start, end):
+        # [(obs_id, datetime, band), ...] in the date range, oldest first
+        cube = self.cube()
+        rows = cube.select(calibrator, *window.gps_bounds(start, end))
+        obs_ids = np.asarray(cube.obs_ids[rows])
+        times = Time(obs_ids, format="gps").to_datetime() if len(rows) else []
+        return [(int(obs_id), time, band_name(cube.channels[row][cube.channels[row] >= 0]) or "") for obs_id, time, row in zip(obs_ids, times, rows)]
+
+    def latest(self, calibrator):
+        # When the calibrator was last observed, or None
+        cube = self.cube()
+        rows = cube.select(calibrator)
+        return Time(int(cube.obs_ids[rows[-1]]), format="gps").to_datetime() if len(rows) else None
+
+    def dates(self, calibrator, start, end):
+        return sorted({time.date() for _, time, _ in self.observations(calibrator, start, end)})
+
+    ############################################################################
+    # Images
+    ############################################################################
+
+    def band_data(self, calibrator, tile, date):
+        # {band: (x_gains, y_gains)} of a tile on a date, from the first observation in each band that day (the one 003 keeps)
+        cube = self.cube()
+        day = datetime(date.year, date.month, date.day)
+        rows = cube.select(calibrator, *window.gps_bounds(day, day + timedelta(days=1)))
+        gains = cube.tile(tile, rows)
+        data = {}
+        for row, tile_gains in zip(rows, gains):
+            band = band_name(cube.channels[row][cube.channels[row] >= 0])
+            if band is None or band in data or np.isnan(tile_gains).all(): continue
+            channels = len(BANDS[band])
+            data[band] = tile_gains[0, :channels], tile_gains[1, :channels]
+        return data
+
+    def tile_plot(self, obs_id, tile):
+        # The gains of one tile in one observation (as 003's plots/<calibrator>_<obs_id>/tile<tile>.png)
+        cube = self.cube()
+        if obs_id not in cube: raise KeyError(obs_id)
+        row = cube.rows[obs_id]
+
+        def draw():
+            channels = [int(c) for c in cube.channels[row] if c >= 0]
+            gains = cube.tile(tile, [row])[0]
+            obs_time = Time(obs_id, format="gps").to_datetime()
+            title = f"Tile: {tile}, Calibrator: {cube.calibrator_name(row)}, Date: {obs_time}"
+            return png(render.draw_tile(title, channels, gains[0, :len(channels)], gains[1, :len(channels)]))
+        return self.cached(f"tile/{obs_id}/{tile}", "image/png", draw)
+
+    def combined(self, calibrator, tile, date):
+        # Every band of one tile on one date (a frame of 003's animations)
+        def draw():
+            return png(render.draw_combined(f"Tile {tile} - {date}", self.band_data(calibrator, tile, date)))
+        return self.cached(f"combined/{calibrator}/{tile}/{date}", "image/png", draw)
+
+    def animation(self, calibrator, tile, start, end):
+        # The combined figures of one tile over every date in the range with observations, as a GIF
+        def draw():
+            buffer = io.BytesIO()
+            with imageio.get_writer(buffer, format="GIF-PIL", mode="I", duration=1 / self.fps, loop=0) as w:
+                for date in self.dates(calibrator, start, end):
+                    w.append_data(animate.frame(render.draw_combined(f"Tile {tile} - {date}", self.band_data(calibrator, tile, date))))
+            return buffer.getvalue()
+        return self.cached(f"animation/{calibrator}/{tile}/{start.date()}/{end.date()}", "image/gif", draw)
@@ -0,0 +1,164 @@
+################################################################################
+# documents
+# Read just the tiles and fields asked for from fit and observation .jsons, as NumPy arrays
+################################################################################
+
+import gzip, json, re, sqlite3, threading, zlib
+import numpy as np
+from pathlib import Path
+from doctor import storage
+from doctor.cube import POLS, number
+
+INDEX = Path("output/document_index.db")
+
+FIT_FIELDS = ["gains", "phase_sigma_resid", "phase_chi2dof", "phase_fit_quality"]
+
+CHUNK = 64 * 1024    # Bytes decompressed at a time when only the start of a document is needed
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    inode INTEGER PRIMARY KEY,          -- hard links (e.g. 002/fits and 002/calibrators/*/fits) share one entry
+    size INTEGER NOT NULL,              -- the entry is rebuilt if the file's size or modification time has changed
+    mtime_ns INTEGER NOT NULL,
+    keys TEXT NOT NULL,                 -- top-level keys, as a JSON list
+    spans BLOB NOT NULL                 -- int64 (start, end) of each key's value in the decompressed document
+);
+"""
+
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+################################################################################
+# Index of where each top-level value starts and ends
+################################################################################
+
+def spans(text):
+    # {key: (start, end)} of every value of the top-level object in text, found by json's own (C) scanner in one pass.
+    # Offsets are in characters, which are bytes because every .json here is written as ASCII.
+    decoder = json.JSONDecoder()
+    found = {}
+    i = WHITESPACE.match(text, 0).end()
+    if text[i] != "{": raise ValueError("not a JSON object")
+    i = WHITESPACE.match(text, i + 1).end()
+    while text[i] != "}":
+        key, i = decoder.raw_decode(text, i)
+        i = WHITESPACE.match(text, i).end() + 1    # ":"
+        start = WHITESPACE.match(text, i).end()
+        _, end = decoder.raw_decode(text, start)
+        found[key] = (start, end)
+        i = WHITESPACE.match(text, end).end()
+        if text[i] == ",": i = WHITESPACE.match(text, i + 1).end()
+    return found
+
+class Index:
+    def __init__(self, path=INDEX):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.lock = threading.Lock()    # Shared by the threads loading documents (see window.load_pairs)
+
+    def get(self, stat):
+        with self.lock:
+            row = self.db.execute("SELECT size, mtime_ns, keys, spans FROM documents WHERE inode = ?", (stat.st_ino,)).fetchone()
+        if row is None or (row[0], row[1]) != (stat.st_size, stat.st_mtime_ns): return None
+        return dict(zip(json.loads(row[2]), np.frombuffer(row[3], dtype=np.int64).reshape(-1, 2).tolist()))
+
+    def put(self, stat, found):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO documents (inode, size, mtime_ns, keys, spans) VALUES (?, ?, ?, ?, ?)",
+                            (stat.st_ino, stat.st_size, stat.st_mtime_ns, json.dumps(list(found)),
+                             np.array(list(found.values()), dtype=np.int64).tobytes()))
+
+INDEXES = {}
+
+def index():
+    # One per process, opened the first time it is needed
+    if "index" not in INDEXES: INDEXES["index"] = Index()
+    return INDEXES["index"]
+
+################################################################################
+# Reading part of a document
+################################################################################
+
+def head(path, end):
+    # The first `end` bytes of the document (decompressed), without decompressing or reading the rest
+    with open(path, "rb") as f:
+        if f.read(2) != storage.GZIP_MAGIC:
+            f.seek(0)
+            return f.read(end)
+        f.seek(0)
+        decompressor = zlib.decompressobj(wbits=31)
+        parts, length = [], 0
+        while length < end:
+            chunk = f.read(CHUNK)
+            if not chunk: break
+            part = decompressor.decompress(chunk)
+            parts.append(part)
+            length += len(part)
+        return b"".join(parts)[:end]
+
+def indexed(path):
+    # (spans, document) where the document is the whole decompressed document if it had to be read to index it, or None
+    stat = path.stat()
+    found = index().get(stat)
+    if found is not None: return found, None
+
+    with open(path, "rb") as f:
+        raw = f.read()
+    document = gzip.decompress(raw) if raw[:2] == storage.GZIP_MAGIC else raw
+    found = spans(document.decode("ascii"))
+    index().put(stat, found)
+    return found, document
+
+def values(path, keys):
+    # {key: parsed value} for the top-level keys asked for that are in the document. The first read of a document
+    # parses all of it to index it; later reads only decompress up to the last key asked for and only parse those keys.
+    path = Path(path)
+    found, document = indexed(path)
+    if document is None:
+        ends = [found[key][1] for key in keys if key in found]
+        document = head(path, max(ends)) if ends else b""
+    return {key: storage.loads(document[found[key][0]:found[key][1]]) for key in keys if key in found}
+
+################################################################################
+# Fits and observations
+################################################################################
+
+def read_fit(path, tiles=None, fields=FIT_FIELDS, pols=POLS):
+    # For the tiles asked for (all of them if None) that have a solution in the fit:
+    #   tiles   tile numbers (tile)
+    #   gains   tile x pol x channel (float64, NaN where missing), if asked for
+    #   and each other field asked for (e.g. phase_chi2dof) as tile x pol (float64)
+    if tiles is None:
+        # Every tile: parsing the whole document at once is quicker than parsing it a tile at a time
+        solutions = {key: value for key, value in storage.read(path).items() if key.isdigit()}
+        tiles = [int(key) for key in solutions]
+    else:
+        solutions = values(path, [str(tile) for tile in tiles])
+    present = [tile for tile in tiles if str(tile) in solutions]
+
+    out = {"tiles": np.array(present, dtype=np.int32)}
+    for field in fields:
+        if field == "gains":
+            channels = max((len(solutions[str(tile)][pol]["gains"]) for tile in present for pol in pols), default=0)
+            gains = np.full((len(present), len(pols), channels), np.nan, dtype=np.float64)
+            for t, tile in enumerate(present):
+                for p, pol in enumerate(pols):
+                    pol_gains = solutions[str(tile)][pol]["gains"]
+                    gains[t, p, :len(pol_gains)] = [number(gain) for gain in pol_gains]
+            out["gains"] = gains
+        else:
+            out[field] = np.array([[number(solutions[str(tile)][pol][field]) for pol in pols] for tile in present], dtype=np.float64).reshape(len(present), len(pols))
+    return out
+
+def read_observation(path):
+    # The parts of a /metadata/obs document that the scripts use (not the per-tile details, which are most of it):
+    #   obs_id, starttime, calibrator, channels (channel) and tiles (tile) of the first rfstream
+    data = values(path, ["starttime", "metadata", "rfstreams"])
+    stream = data["rfstreams"]["0"]
+    return {
+        "obs_id": int(data["metadata"]["observation_number"]),
+        "starttime": int(data["starttime"]),
+        "calibrator": data["metadata"]["calibrators"],
+        "channels": np.array(stream["frequencies"], dtype=np.int16),
+        "tiles": np.array(stream["tileset"]["xlist"], dtype=np.int32),
+    }
@@ -0,0 +1,79 @@
+################################################################################
+# fetch
+# Pooled, concurrent requests to the MWA web services
+################################################################################
+
+import itertools, os, time, requests
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from requests.adapters import HTTPAdapter
+from doctor import profiling
+from doctor.cache import ResponseCache
+from doctor.logs import Meter
+
+################################################################################
+# Paths and Constants
+################################################################################
+
+# Point this at a local stand-in server to run the scripts without touching the real web services
+WEB_SERVICE = os.environ.get("MWA_WEB_SERVICE", "https://ws.mwatelescope.org")
+
+TIMEOUT = 60    # Seconds to wait for a response before giving up on a request
+
+USE_CACHE = True    # Answer repeated requests from output/http_cache.db where the endpoint allows it (see cache.TTLS)
+
+################################################################################
+# Sessions and single requests
+################################################################################
+
+def session(pool_size=8, cache=USE_CACHE):
+    # One session per run so connections are kept alive and reused between requests
+    s = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    s.mount("http://", adapter)
+    s.mount("https://", adapter)
+    s.cache = ResponseCache() if cache else None
+    return s
+
+def get(s, endpoint, params, retries=3, backoff=2):
+    # Internal server errors and dropped connections are retried, waiting backoff, 2*backoff, 4*backoff... seconds.
+    # Anything else (200, 400, 404) is returned straight away for the caller to deal with.
+    for attempt in range(retries + 1):
+        if attempt: time.sleep(backoff * 2 ** (attempt - 1))
+        try:
+            with profiling.timer("fetch"):
+                if s.cache: r = s.cache.get(s, endpoint, WEB_SERVICE + endpoint, params, TIMEOUT)
+                else: r = s.get(WEB_SERVICE + endpoint, params=params, timeout=TIMEOUT)
+        except requests.RequestException:
+            if attempt == retries: raise
+            continue
+        if r.status_code < 500: break
+    return r
+
+################################################################################
+# Many requests at once
+################################################################################
+
+def fetch_many(endpoint, ids, param="obs_id", workers=8, retries=3, backoff=2, log=print):
+    # Yields (id, response) as each request finishes, in whatever order they finish.
+    # If every retry failed to connect, the response is the exception that was raised instead.
+    # Only 2 * workers requests are queued at a time, so responses are not held once the caller has dealt with them.
+    ids = list(ids)
+    meter = Meter(endpoint, log, total=len(ids), unit="requests")
+
+    with session(workers) as s, ThreadPoolExecutor(max_workers=workers) as pool:
+        queue = iter(ids)
+        pending = {}
+        while True:
+            for id in itertools.islice(queue, 2 * workers - len(pending)):
+                pending[pool.submit(get, s, endpoint, {param: id}, retries, backoff)] = id
+            if not pending: break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                id = pending.pop(future)
+                try: r = future.result()
+                except requests.RequestException as e: r = e
+                if isinstance(r, Exception): meter.count("failed")
+                else: meter.count(str(r.status_code), size=len(r.content))
+                yield id, r
+    meter.finish()
@@ -0,0 +1,22 @@
+################################################################################
+# files
+# Put a file in more than one place without storing it more than once
+################################################################################
+
+import os, shutil
+from doctor import profiling
+
+def link(source, destination):
+    # A hard link where possible (same file system), otherwise a symbolic link, otherwise (e.g. on Windows without
+    # permission to create symbolic links) a plain copy as before. Replaces anything already at destination.
+    with profiling.timer("copy"):
+        tmp = destination.with_name(destination.name + ".tmp")
+        tmp.unlink(missing_ok=True)
+        try:
+            os.link(source, tmp)
+        except OSError:
+            try:
+                os.symlink(os.path.abspath(source), tmp)
+            except OSError:
+                shutil.copy2(source, tmp)
+        tmp.replace(destination)
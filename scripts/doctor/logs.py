@@ -0,0 +1,104 @@
+################################################################################
+# logs
+# Buffered logging shared by the scripts, and meters that report counts, rates and ETAs at intervals
+################################################################################
+
+import logging, os, time
+from collections import Counter
+from datetime import datetime
+from logging.handlers import MemoryHandler
+from pathlib import Path
+from doctor import profiling
+
+LOGS = Path("logging/")
+
+CONSOLE_LEVEL = os.environ.get("MWA_LOG_LEVEL", "INFO")    # DEBUG also prints a line for every file, tile and request
+FILE_LEVEL = "DEBUG"        # The log file keeps everything
+
+BUFFER_LINES = 1000     # Lines held in memory before they are written to the log file...
+BUFFER_SECONDS = 5      # ...or seconds, whichever comes first (warnings and errors are written straight away)
+
+FORMAT = logging.Formatter("(%(asctime)s) %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+
+################################################################################
+# Setting up
+################################################################################
+
+class BufferedHandler(MemoryHandler):
+    # A MemoryHandler that also writes out whatever it holds every BUFFER_SECONDS
+    def __init__(self, target):
+        super().__init__(BUFFER_LINES, flushLevel=logging.WARNING, target=target)
+        self.last = time.monotonic()
+
+    def shouldFlush(self, record):
+        return super().shouldFlush(record) or time.monotonic() - self.last >= BUFFER_SECONDS
+
+    def flush(self):
+        super().flush()
+        self.last = time.monotonic()
+
+def setup(name):
+    # A logger writing to logging/<name>/log_<start time>.txt (through a buffer) and to the terminal.
+    # Anything still buffered is written when the script exits (logging.shutdown runs at exit).
+    folder = LOGS / name
+    folder.mkdir(parents=True, exist_ok=True)
+    log_file = folder / f"log_{datetime.now().strftime('%Y-%m-%dT%H-%M-%S')}.txt"
+
+    file_handler = logging.FileHandler(log_file, encoding="utf-8")
+    file_handler.setFormatter(FORMAT)
+    buffered = BufferedHandler(file_handler)
+    buffered.setLevel(FILE_LEVEL)
+
+    console = logging.StreamHandler()
+    console.setFormatter(FORMAT)
+    console.setLevel(CONSOLE_LEVEL)
+
+    logger = logging.getLogger(f"doctor.{name}")
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    logger.handlers = [buffered, console]
+    logger.info("Starting...")
+    return logger
+
+################################################################################
+# Meters
+################################################################################
+
+class Meter:
+    # Counts what happens to each item of a stage (e.g. fetched, skipped, failed) and logs one line every `every` seconds:
+    #   <name>: 1200/5000 (fetched 1000, skipped 150, failed 50), 40.0 items/s, 1.2 MB/s, ~95s remaining
+    def __init__(self, name, log, total=None, unit="items", every=10):
+        self.name = name
+        self.log = log
+        self.total = total
+        self.unit = unit
+        self.every = every
+        self.counts = Counter()
+        self.done = 0
+        self.bytes = 0
+        self.start = time.monotonic()
+        self.last = self.start
+
+    def count(self, outcome, n=1, size=0):
+        self.counts[outcome] += n
+        self.done += n
+        self.bytes += size
+        if time.monotonic() - self.last >= self.every: self.report()
+
+    def report(self, final=False):
+        now = time.monotonic()
+        self.last = now
+        elapsed = max(now - self.start, 1e-9)
+        rate = self.done / elapsed
+
+        message = f"{self.name}: {self.done}" + (f"/{self.total}" if self.total is not None else "")
+        if self.counts: message += " (" + ", ".join(f"{outcome} {n}" for outcome, n in self.counts.items()) + ")"
+        message += f", {rate:.1f} {self.unit}/s"
+        if self.bytes: message += f", {self.bytes / elapsed / 1e6:.1f} MB/s"
+        if final: message += f", {elapsed:.1f}s"
+        elif self.total is not None and rate: message += f", ~{(self.total - self.done) / rate:.0f}s remaining"
+        self.log(message)
+
+    def finish(self):
+        self.report(final=True)
+        profiling.count(self.name, self.counts)
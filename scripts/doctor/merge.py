@@ -0,0 +1,120 @@
+################################################################################
+# merge
+# Incrementally combine pages of results into a single .csv file
+################################################################################
+
+import json, csv, hashlib, io
+from pathlib import Path
+from doctor import storage
+
+################################################################################
+# Helper functions
+################################################################################
+
+# A manifest records, for each page that went into a .csv file, the hash of the page and where its rows are in the file:
+#   {"results0001.json": {"hash": "...", "start": 0, "end": 1234}, ...}
+# Pages are listed in the order their rows appear in the file.
+
+def read_manifest(manifest, combined):
+    # Without the .csv file the manifest is useless, so start from scratch
+    if not Path(combined).exists(): return {}
+    try:
+        with open(manifest, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def write_manifest(manifest, pages):
+    storage.write_json(manifest, pages)
+
+def page_hash(page):
+    return hashlib.sha256(page.read_bytes()).hexdigest()
+
+def csv_bytes(rows):
+    # Exactly what csv.writer writes to a file opened with newline=""
+    buffer = io.StringIO(newline="")
+    writer = csv.writer(buffer)
+    for row in rows: writer.writerow(row)
+    return buffer.getvalue().encode("utf-8")
+
+def rewrite(combined, manifest, pages):
+    # pages is a list of (name, hash, rows) in file order, where rows is either bytes to write as they are,
+    # or (start, end) to copy that range of the existing file. Returns the names of pages that were not copied.
+    old = open(combined, "rb") if Path(combined).exists() else None
+    tmp = combined.with_suffix(".tmp")
+    entries = {}
+    changed = []
+
+    with open(tmp, "wb") as f:
+        for name, digest, rows in pages:
+            start = f.tell()
+            if isinstance(rows, bytes):
+                f.write(rows)
+                changed.append(name)
+            else:
+                old.seek(rows[0])
+                f.write(old.read(rows[1] - rows[0]))
+            entries[name] = {"hash": digest, "start": start, "end": f.tell()}
+
+    if old: old.close()
+    tmp.replace(combined)
+    write_manifest(manifest, entries)
+    return changed
+
+################################################################################
+# Merging
+################################################################################
+
+def merge_pages(folder, combined, manifest):
+    # Rebuilds combined (newest page first, as before) from the resultsXXXX.json pages in folder.
+    # Pages whose hash matches the manifest are copied straight from the existing file without being parsed,
+    # so only new and changed pages are loaded. Returns the names of the new and changed pages.
+    old = read_manifest(manifest, combined)
+
+    pages = []
+    for page in sorted(folder.glob("results*.json"), reverse=True):
+        digest = page_hash(page)
+        entry = old.get(page.name)
+        if entry and entry["hash"] == digest:
+            pages.append((page.name, digest, (entry["start"], entry["end"])))
+            continue
+
+        data = storage.read(page)
+        pages.append((page.name, digest, csv_bytes(data)))
+
+    return rewrite(combined, manifest, pages)
+
+def filter_pages(combined, combined_manifest, filtered, filtered_manifest, keep):
+    # Rebuilds filtered from the rows of combined where keep(row) is True, page by page.
+    # Only the pages of combined that changed since filtered was last built are read and filtered again.
+    # Returns the names of the new and changed pages.
+    source = read_manifest(combined_manifest, combined)
+    old = read_manifest(filtered_manifest, filtered)
+
+    # A .csv file from before manifests were kept is treated as one big page
+    if not source and Path(combined).exists():
+        source = {Path(combined).name: {"hash": page_hash(Path(combined)), "start": 0, "end": Path(combined).stat().st_size}}
+
+    pages = []
+    with open(combined, "rb") as f:
+        for name, entry in source.items():
+            previous = old.get(name)
+            if previous and previous["hash"] == entry["hash"]:
+                pages.append((name, entry["hash"], (previous["start"], previous["end"])))
+                continue
+
+            f.seek(entry["start"])
+            text = f.read(entry["end"] - entry["start"]).decode("utf-8")
+            rows = [row for row in csv.reader(io.StringIO(text, newline="")) if keep(row)]
+            pages.append((name, entry["hash"], csv_bytes(rows)))
+
+    return rewrite(filtered, filtered_manifest, pages)
+
+def read_rows(combined, manifest, names):
+    # Rows of combined that came from the given pages
+    entries = read_manifest(manifest, combined)
+    with open(combined, "rb") as f:
+        for name in names:
+            f.seek(entries[name]["start"])
+            text = f.read(entries[name]["end"] - entries[name]["start"]).decode("utf-8")
+            yield from csv.reader(io.StringIO(text, newline=""))
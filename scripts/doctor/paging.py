@@ -0,0 +1,116 @@
+################################################################################
+# paging
+# Concurrent, resumable walk over the pages of /metadata/find
+################################################################################
+
+import json, time, requests
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from doctor import fetch, storage
+
+MAX_DELAY = 60  # Longest wait (in seconds) between batches while the server is struggling
+
+################################################################################
+# Helper functions
+################################################################################
+
+def page_path(folder, page):
+    return Path(folder / f"results{page:04d}.json")
+
+def page_number(path):
+    return int(path.name.removeprefix("results").removesuffix(".json"))
+
+def read_checkpoint(checkpoint):
+    try:
+        with open(checkpoint, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_checkpoint(checkpoint, state):
+    # Replaced rather than written over, so an interrupted run never leaves a half-written checkpoint
+    storage.write_json(checkpoint, state)
+
+def fetch_page(s, page, future):
+    # Returns the list of observations on the page ([] past the last page), or None if the request failed.
+    try:
+        r = fetch.get(s, "/metadata/find", {"page": page, "future": future}, retries=0)
+        observations = r.json() if r.status_code == 200 else None
+    except (requests.RequestException, ValueError):
+        return None
+    return observations if isinstance(observations, list) else None
+
+################################################################################
+# Paging
+################################################################################
+
+def fetch_pages(folder, checkpoint, start_page=1, future=0, workers=4, retries=5, backoff=2, log=print):
+    # Fetches pages from start_page until the first empty page, writing each to folder/resultsXXXX.json.
+    #
+    # Up to `workers` pages are requested at once. A failed request (connection error, non-200 status or a
+    # body that is not a list) is never mistaken for the end of the results: the batch size is halved and
+    # the wait between batches doubled until requests succeed again, and the page is retried up to `retries`
+    # times before giving up. Progress is saved to `checkpoint` so a run that gives up or is interrupted
+    # carries on from the first page it has not fetched yet. Returns True once the end has been reached.
+    state = read_checkpoint(checkpoint)
+    if state and not state["done"] and state["future"] == future and state["next"] > start_page:
+        log(f"Resuming from page {state['next']} (checkpoint)...")
+        start_page = state["next"]
+
+    next_page = start_page      # All pages before this one have been saved
+    fetched = set()             # Pages after next_page that have already been saved
+    concurrency = workers
+    delay = 0
+    failures = 0                # Consecutive failed attempts at next_page
+
+    with fetch.session(workers) as s, ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            pages = [p for p in range(next_page, next_page + concurrency) if p not in fetched]
+            log(f"Fetching pages {pages[0]}-{pages[-1]}...")
+            results = dict(zip(pages, pool.map(lambda p: fetch_page(s, p, future), pages)))
+
+            end = None
+            for page in sorted(results):
+                observations = results[page]
+                if observations is None:
+                    continue
+                if not observations:
+                    end = page if end is None else min(end, page)
+                    continue
+                # Pages that come back unchanged are left alone, so nothing downstream sees them as new
+                path = page_path(folder, page)
+                if not path.exists() or storage.read(path) != observations:
+                    storage.write(path, observations)
+                fetched.add(page)
+
+            # Move past every page that is now saved
+            while next_page in fetched:
+                fetched.remove(next_page)
+                next_page += 1
+
+            if end is not None and end == next_page:
+                # Anything numbered from here on is left over from when there were more pages (e.g. future observations that have since happened)
+                for stale in folder.glob("results*.json"):
+                    if page_number(stale) >= end:
+                        stale.unlink()
+                write_checkpoint(checkpoint, {"future": future, "next": next_page, "done": True})
+                log(f"Reached the last page ({next_page - 1}).")
+                if s.cache: log(f"Response cache: {s.cache.summary()}.")
+                return True
+
+            write_checkpoint(checkpoint, {"future": future, "next": next_page, "done": False})
+
+            if any(observations is None for observations in results.values()):
+                failures = failures + 1 if results.get(next_page) is None else 0
+                if failures > retries:
+                    log(f"Failed to fetch page {next_page} after {retries} retries! Run again to continue from here.")
+                    return False
+                concurrency = max(1, concurrency // 2)
+                delay = min(MAX_DELAY, max(backoff, delay * 2))
+                log(f"Server errors, slowing down to {concurrency} page(s) every {delay}s...")
+            else:
+                failures = 0
+                concurrency = min(workers, concurrency + 1)
+                delay = delay / 2 if delay > backoff else 0
+
+            time.sleep(delay)
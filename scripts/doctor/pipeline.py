@@ -0,0 +1,142 @@
+################################################################################
+# pipeline
+# Run the steps of the numbered scripts in order, skipping any whose inputs have not changed
+################################################################################
+
+import json, hashlib, os, time, importlib.util
+from datetime import datetime
+from pathlib import Path
+from doctor import profiling, storage
+
+STATE = Path("output/pipeline.json")
+SCRIPTS = Path(__file__).parent.parent
+
+################################################################################
+# Fingerprints
+################################################################################
+
+def files(path):
+    # Every file under path (or just path, if it is a file), in a fixed order
+    if path.is_file():
+        yield path
+        return
+    if not path.is_dir():
+        return
+    for entry in sorted(os.scandir(path), key=lambda entry: entry.name):
+        if entry.is_dir(follow_symlinks=False): yield from files(Path(entry.path))
+        else: yield Path(entry.path)
+
+def fingerprint(paths):
+    # Files named directly (e.g. past.csv) are hashed by content, so rewriting one with the same rows does not count as a
+    # change. Folders can hold many thousands of files, so for those only the name, size and modification time of each file count.
+    digest = hashlib.sha256()
+    for path in map(Path, paths):
+        digest.update(f"{path}\0".encode())
+        if path.is_file():
+            with open(path, "rb") as f:
+                digest.update(hashlib.file_digest(f, "sha256").digest())
+            continue
+        for file in files(path):
+            stat = file.stat()
+            digest.update(f"{file}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+################################################################################
+# Stages
+################################################################################
+
+class Stage:
+    # A step of one of the scripts. It is rerun when the fingerprint of its inputs or outputs differs from the last
+    # time it finished. Sources (steps that fetch from the web services) have nothing local to compare, so they always run.
+    # retry, if given, returns whatever the stage left to try again (e.g. requests that failed); while it returns
+    # anything the stage runs, even with its inputs and outputs unchanged.
+    def __init__(self, name, run, inputs=(), outputs=(), after=(), source=False, retry=None):
+        self.name = name
+        self.run = run
+        self.inputs = inputs
+        self.outputs = outputs
+        self.after = after
+        self.source = source
+        self.retry = retry
+
+def load_script(number, loaded={}):
+    # The numbered scripts cannot be imported by name, so load them from their files (once each, only when needed)
+    if number not in loaded:
+        spec = importlib.util.spec_from_file_location(f"script{number}", SCRIPTS / f"{number}.py")
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        loaded[number] = module
+    return loaded[number]
+
+################################################################################
+# Pipeline
+################################################################################
+
+class Pipeline:
+    def __init__(self, stages, state=STATE, log=print):
+        self.stages = {stage.name: stage for stage in stages}
+        self.state_path = state
+        self.log = log
+        self.profile = profiling.Run()
+
+        try:
+            with open(state, "r") as f:
+                self.state = json.load(f)
+        except (OSError, ValueError):
+            self.state = {}
+
+    def save(self):
+        storage.write_json(self.state_path, self.state)
+
+    def plan(self, targets=None):
+        # The targets and everything they depend on, with every stage after the stages it depends on
+        order = []
+        def visit(name):
+            if name in order: return
+            for dependency in self.stages[name].after: visit(dependency)
+            order.append(name)
+        for name in targets or self.stages: visit(name)
+        return [self.stages[name] for name in order]
+
+    def reason(self, stage, force=False, offline=False):
+        # Why the stage needs to run, or None if it does not
+        previous = self.state.get(stage.name)
+        if force: return "forced"
+        if stage.source: return None if offline else "fetching"
+        if previous is None: return "never run"
+        if stage.retry is not None:
+            left = stage.retry()
+            if left: return f"retrying {len(left)} failures"
+        if previous["inputs"] != fingerprint(stage.inputs): return "inputs changed"
+        if previous["outputs"] != fingerprint(stage.outputs): return "outputs changed"
+        return None
+
+    def run(self, targets=None, force=False, offline=False):
+        # Stops at the first stage that fails, so nothing runs on top of its partial outputs.
+        # Each stage is recorded as soon as it finishes, so an interrupted run carries on where it stopped.
+        # With profiling on (see profiling.MODE) the report of the stages that ran is written at the end, even if one failed.
+        try:
+            self.run_stages(targets, force, offline)
+        finally:
+            report = self.profile.write()
+            if report: self.log(f"Wrote {report}.")
+
+    def run_stages(self, targets, force, offline):
+        for stage in self.plan(targets):
+            reason = self.reason(stage, force, offline)
+            if reason is None:
+                self.log(f"Skipping {stage.name} (up to date).")
+                continue
+
+            self.log(f"Running {stage.name} ({reason})...")
+            start = time.monotonic()
+            with self.profile.stage(stage.name):
+                stage.run()
+            self.state[stage.name] = {
+                "inputs": fingerprint(stage.inputs),
+                "outputs": fingerprint(stage.outputs),
+                "seconds": round(time.monotonic() - start, 3),
+                "finished": datetime.now().isoformat(timespec="seconds"),
+            }
+            self.save()
+            self.log(f"Finished {stage.name} in {self.state[stage.name]['seconds']}s.")
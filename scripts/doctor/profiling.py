@@ -0,0 +1,182 @@
+################################################################################
+# profiling
+# Optional timers around the hot loops, per-stage profiles and a .json report of each run
+################################################################################
+
+import cProfile, json, os, pstats, resource, sys, threading, time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+MODE = os.environ.get("MWA_PROFILE", "")    # "" (off), "timers", "cprofile" (deterministic, slower) or "sample" (statistical)
+MODES = ["timers", "cprofile", "sample"]
+
+REPORTS = Path("output/runs/")
+
+SAMPLE_INTERVAL = 0.005     # Seconds between stack samples in "sample" mode
+TOP = 20                    # Functions listed for each stage in the report
+
+################################################################################
+# Timers (summed over threads, so they can add up to more than the wall time)
+################################################################################
+
+TIMERS = defaultdict(lambda: [0.0, 0])    # {name: [seconds, count]}
+LOCK = threading.Lock()
+
+@contextmanager
+def timer(name):
+    if not MODE:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with LOCK:
+            TIMERS[name][0] += elapsed
+            TIMERS[name][1] += 1
+
+def drain():
+    # The timers since the last drain, which are then reset
+    with LOCK:
+        timers = {name: tuple(value) for name, value in TIMERS.items()}
+        TIMERS.clear()
+    return timers
+
+def merge(timers):
+    # Adds timers drained in another process (e.g. a render worker)
+    with LOCK:
+        for name, (seconds, count) in timers.items():
+            TIMERS[name][0] += seconds
+            TIMERS[name][1] += count
+
+COUNTS = defaultdict(Counter)    # {meter name: {outcome: n}}, from the logs.Meter of each loop
+
+def count(name, counts):
+    if not MODE: return
+    with LOCK:
+        COUNTS[name].update(counts)
+
+def traced(function, *args):
+    # Runs function in a worker process and sends its timers back with the result (see Renderer.submit)
+    return function(*args), drain()
+
+################################################################################
+# Sampling
+################################################################################
+
+class Sampler:
+    # Records the stack of every thread every SAMPLE_INTERVAL seconds. Unlike cProfile it does not slow down every call,
+    # so it can be left on for a whole run. Stacks are kept in the "folded" format read by flame graph tools.
+    def __init__(self):
+        self.stacks = Counter()
+        self.running = False
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+    def sample(self):
+        me = threading.get_ident()
+        while self.running:
+            for ident, frame in sys._current_frames().items():
+                if ident == me: continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{Path(frame.f_code.co_filename).name}:{frame.f_code.co_name}")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+            time.sleep(SAMPLE_INTERVAL)
+
+    def top(self):
+        # Share of samples in which each function was running (i.e. at the top of the stack)
+        total = sum(self.stacks.values()) or 1
+        leaves = Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        return [{"function": function, "share": round(count / total, 4)} for function, count in leaves.most_common(TOP)]
+
+    def write(self, path):
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+################################################################################
+# Runs
+################################################################################
+
+def rss_bytes(maxrss):
+    # ru_maxrss is in bytes on macOS and in kB on Linux
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+def peak_rss_mb():
+    # Of the whole run so far
+    return round(rss_bytes(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss) / 1024**2, 1)
+
+class Run:
+    # Collects the report for one run of the pipeline: for each stage its wall and CPU time, peak RSS, timers and
+    # (in cprofile or sample mode) the functions it spent longest in
+    def __init__(self, name="run"):
+        self.started = datetime.now()
+        self.name = f"{name}_{self.started.strftime('%Y-%m-%dT%H-%M-%S')}"
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        if not MODE:
+            yield
+            return
+
+        drain()
+        COUNTS.clear()
+        profiler = cProfile.Profile() if MODE == "cprofile" else Sampler() if MODE == "sample" else None
+        start, cpu = time.perf_counter(), time.process_time()
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        if MODE == "cprofile": profiler.enable()
+        if MODE == "sample": profiler.start()
+        try:
+            yield
+        finally:
+            if MODE == "cprofile": profiler.disable()
+            if MODE == "sample": profiler.stop()
+            children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+            entry = {
+                "seconds": round(time.perf_counter() - start, 3),
+                "cpu_seconds": round(time.process_time() - cpu, 3),
+                "worker_cpu_seconds": round(children_after.ru_utime + children_after.ru_stime - children.ru_utime - children.ru_stime, 3),
+                "peak_rss_mb": peak_rss_mb(),
+                "timers": {timer: {"seconds": round(seconds, 3), "count": count} for timer, (seconds, count) in sorted(drain().items())},
+                "counts": {meter: dict(counts) for meter, counts in COUNTS.items()},
+            }
+
+            folder = REPORTS / self.name
+            if MODE == "cprofile":
+                folder.mkdir(parents=True, exist_ok=True)
+                profiler.dump_stats(folder / f"{name}.prof")    # For snakeviz, or python -m pstats
+                stats = pstats.Stats(profiler).sort_stats("cumulative")
+                entry["top"] = [{"function": f"{Path(file).name}:{line}({function})", "calls": calls, "seconds": round(total, 3), "cumulative": round(cumulative, 3)}
+                                for (file, line, function), (_, calls, total, cumulative, _) in
+                                sorted(stats.stats.items(), key=lambda item: -item[1][3])[:TOP]]
+            if MODE == "sample":
+                folder.mkdir(parents=True, exist_ok=True)
+                profiler.write(folder / f"{name}.folded")
+                entry["top"] = profiler.top()
+
+            self.stages[name] = entry
+
+    def write(self):
+        # Writes output/runs/<name>.json (compare two with compare_runs.py). Returns its path, or None if profiling is off.
+        if not MODE: return None
+        REPORTS.mkdir(parents=True, exist_ok=True)
+        path = REPORTS / f"{self.name}.json"
+        with open(path, "w") as f:
+            json.dump({"started": self.started.isoformat(timespec="seconds"), "mode": MODE, "argv": sys.argv, "stages": self.stages}, f, indent=4)
+        return path
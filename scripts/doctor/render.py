@@ -0,0 +1,149 @@
+################################################################################
+# render
+# Draw tile plots on a pool of worker processes, reusing one figure per worker
+################################################################################
+
+import multiprocessing
+import numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from doctor.bands import BANDS
+from doctor import profiling, storage
+
+################################################################################
+# Figures (one of each per process, built the first time they are needed)
+################################################################################
+
+Y_LIM = (0, 2)
+FIGURES = {}
+
+def setup(y_lim):
+    global Y_LIM
+    import matplotlib
+    matplotlib.use("Agg")
+    Y_LIM = y_lim
+
+def tile_figure():
+    # Gains of one tile in one observation
+    if "tile" not in FIGURES:
+        import matplotlib.pyplot as plt
+        fig = plt.figure(figsize=(10, 6))
+        ax = fig.gca()
+        x_line, = ax.plot([], [], label="X Gain", color="blue")
+        y_line, = ax.plot([], [], label="Y Gain", color="red")
+        ax.set_xlabel("Channel")
+        ax.set_ylabel("Gain")
+        ax.legend()
+        FIGURES["tile"] = fig, ax, x_line, y_line
+    return FIGURES["tile"]
+
+def combined_figure():
+    # Gains of one tile in every band on one date
+    if "combined" not in FIGURES:
+        import matplotlib.pyplot as plt
+        fig, axs = plt.subplots(2, 3, figsize=(15, 10))
+        lines = {}
+        for ax, band in zip(axs.flat, BANDS):
+            ax.set_title(band)
+            x_line, = ax.plot([], [], label="X Gain", color="blue")
+            y_line, = ax.plot([], [], label="Y Gain", color="red")
+            ax.set_ylim(Y_LIM)
+            ax.legend()
+            # The channels of each band never change, so fix the x limits now (even if a band has no data)
+            ax.update_datalim(np.column_stack([BANDS[band], np.ones(len(BANDS[band]))]))
+            ax.autoscale_view(scaley=False)
+            ax.set_autoscalex_on(False)
+            lines[band] = ax, x_line, y_line
+        FIGURES["combined"] = fig, lines
+    return FIGURES["combined"]
+
+def values(gains):
+    return np.asarray(gains, dtype=float)  # None (missing gains) becomes NaN
+
+################################################################################
+# Drawing (these run in the worker processes)
+################################################################################
+
+def draw_tile(title, channels, x_gains, y_gains):
+    fig, ax, x_line, y_line = tile_figure()
+    x_line.set_data(channels, values(x_gains))
+    y_line.set_data(channels, values(y_gains))
+    ax.set_title(title)
+    ax.relim()
+    ax.autoscale_view()
+    return fig
+
+def draw_combined(title, band_data):
+    # band_data maps band names to (x_gains, y_gains); bands that are missing are left empty
+    fig, lines = combined_figure()
+    for band, (ax, x_line, y_line) in lines.items():
+        x_gains, y_gains = band_data.get(band, ([np.nan] * len(BANDS[band]),) * 2)
+        x_line.set_data(BANDS[band], values(x_gains))
+        y_line.set_data(BANDS[band], values(y_gains))
+    fig.suptitle(title)
+    return fig
+
+def read_band(path):
+    data = storage.read(path)
+    return data["x"]["x_gains"], data["y"]["y_gains"]
+
+def save_tiles(jobs):
+    # jobs: [(path, title, channels, x_gains, y_gains), ...]
+    for path, title, channels, x_gains, y_gains in jobs:
+        with profiling.timer("plot"):
+            fig = draw_tile(title, channels, x_gains, y_gains)
+        with profiling.timer("savefig"):
+            fig.savefig(path)
+    return len(jobs)
+
+################################################################################
+# Renderer
+################################################################################
+
+class Renderer:
+    # Hands batches of plots to worker processes. Each worker keeps its figures between batches and only updates
+    # the line data, titles and limits, so no figure is created or destroyed per plot.
+    # With workers=0 (or where processes cannot be forked) everything is drawn in this process instead.
+    def __init__(self, workers=4, y_lim=Y_LIM):
+        self.pending = deque()
+        self.pool = None
+        self.workers = workers
+
+        if workers and "fork" in multiprocessing.get_all_start_methods():
+            # Forking (rather than spawning) means the calling script is not run again in each worker.
+            # All the workers are started now, before the caller has any threads of its own running.
+            context = multiprocessing.get_context("fork")
+            self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=setup, initargs=(y_lim,))
+            for future in [self.pool.submit(int) for _ in range(workers)]: future.result()
+        else:
+            setup(y_lim)
+
+    def submit(self, function, jobs):
+        if not jobs: return
+        if not self.pool:
+            function(jobs)
+            return
+
+        # Split the batch between the workers, and wait for older batches when too many are queued.
+        # When profiling, each batch brings back the worker's timers with it.
+        size = -(-len(jobs) // self.workers)
+        for i in range(0, len(jobs), size):
+            if profiling.MODE: self.pending.append(self.pool.submit(profiling.traced, function, jobs[i:i + size]))
+            else: self.pending.append(self.pool.submit(function, jobs[i:i + size]))
+        while len(self.pending) > 4 * self.workers:
+            self.collect()
+
+    def tiles(self, jobs):
+        self.submit(save_tiles, jobs)
+
+    def collect(self):
+        result = self.pending.popleft().result()
+        if profiling.MODE: profiling.merge(result[1])
+
+    def wait(self):
+        while self.pending:
+            self.collect()
+
+    def close(self):
+        self.wait()
+        if self.pool: self.pool.shutdown()
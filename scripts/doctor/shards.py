@@ -0,0 +1,110 @@
+################################################################################
+# shards
+# Split the obs_ids between workers (processes on this machine, or other machines) and merge what they wrote back together
+################################################################################
+
+import filecmp, hashlib, json, os, re, time
+from pathlib import Path
+from doctor import files, storage
+from doctor.catalogue import Catalogue, CATALOGUE
+from doctor.pipeline import files as tree_files
+
+MARKER = Path("output/shard.json")    # Written in a shard's tree once its worker has finished
+
+OBS_ID = re.compile(r"\d{10}")        # Every per-observation file has its obs_id (GPS seconds, 10 digits) in its name
+
+################################################################################
+# Which shard an obs_id is in
+################################################################################
+
+def parse(text):
+    # "1/4" is the second of four shards (they are numbered from 0)
+    index, count = map(int, text.split("/"))
+    if not 0 <= index < count: raise ValueError(f"there is no shard {text} (shards are numbered from 0)")
+    return index, count
+
+# (index, count) of the shard this process works on, or None to work on every obs_id. Set by shard.py (or MWA_SHARD=1/4).
+SHARD = parse(os.environ["MWA_SHARD"]) if os.environ.get("MWA_SHARD") else None
+
+def shard_of(obs_id, count):
+    # The same on every machine and Python version (unlike hash()), and even however the obs_ids are spaced
+    digest = hashlib.blake2b(str(int(obs_id)).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % count
+
+def mine(obs_id):
+    return SHARD is None or shard_of(obs_id, SHARD[1]) == SHARD[0]
+
+################################################################################
+# A shard's tree
+################################################################################
+
+# A shard works in a tree of its own (every path in the scripts is relative to the working directory), which is seeded
+# with links to the inputs and outputs of its stages here, so nothing already fetched or worked out is done again, and a
+# copy of the catalogue. Files are only ever replaced (see storage.write), never written over, so the links are safe.
+
+def seed(tree, stages, log=print):
+    tree = Path(tree)
+    linked = 0
+    for stage in stages:
+        for path in [*stage.inputs, *stage.outputs]:
+            for file in tree_files(Path(path)):
+                destination = tree / file
+                if destination.exists() and os.path.samefile(file, destination): continue
+                destination.parent.mkdir(parents=True, exist_ok=True)
+                files.link(file, destination)
+                linked += 1
+    if CATALOGUE.exists(): Catalogue().copy(tree / CATALOGUE)
+    (tree / MARKER).unlink(missing_ok=True)
+    log(f"Seeded {tree} with {linked} files.")
+
+def finish(stages):
+    # Marks this tree as finished (run by the worker, in the tree)
+    MARKER.parent.mkdir(parents=True, exist_ok=True)
+    storage.write_json(MARKER, {"shard": SHARD[0], "count": SHARD[1], "stages": [stage.name for stage in stages], "finished": time.time()})
+
+def marker(tree):
+    path = Path(tree) / MARKER
+    if not path.exists(): raise ValueError(f"{tree} has not finished (no {MARKER})")
+    with open(path, "r") as f:
+        return json.load(f)
+
+################################################################################
+# Merging a shard back in
+################################################################################
+
+def merge(tree, stages, log=print):
+    # Adds what a finished shard wrote for stages to this tree. Returns the counts of files added, replaced, the same
+    # here already and in conflict. Only files of the shard's own obs_ids can replace one here; any other file that
+    # differs (which a shard should never write) is left as it is here, counted as a conflict and logged.
+    tree = Path(tree)
+    done = marker(tree)
+    index, count = done["shard"], done["count"]
+    missing = [stage.name for stage in stages if stage.name not in done["stages"]]
+    if missing: raise ValueError(f"{tree} did not run {', '.join(missing)}")
+
+    def belongs(obs_id):
+        return shard_of(obs_id, count) == index
+
+    counts = {"added": 0, "replaced": 0, "same": 0, "conflicts": 0}
+    for stage in stages:
+        for path in stage.outputs:
+            for file in tree_files(tree / path):
+                if file.name.endswith(".tmp"): continue    # Left by a worker that was stopped part way through a write
+                here = file.relative_to(tree)
+                if here.exists():
+                    if os.path.samefile(file, here) or filecmp.cmp(file, here, shallow=False):
+                        counts["same"] += 1
+                        continue
+                    obs_id = OBS_ID.search(here.name)
+                    if obs_id is None or not belongs(obs_id.group()):
+                        log(f"Conflict: {file} differs from {here}, which is kept.")
+                        counts["conflicts"] += 1
+                        continue
+                    counts["replaced"] += 1
+                else:
+                    counts["added"] += 1
+                here.parent.mkdir(parents=True, exist_ok=True)
+                files.link(file, here)
+
+    if (tree / CATALOGUE).exists(): Catalogue().merge(tree / CATALOGUE, belongs)
+    return counts
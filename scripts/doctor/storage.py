@@ -0,0 +1,84 @@
+################################################################################
+# storage
+# Read and write the .json artefacts (pages, fits, observations and band files) compactly
+################################################################################
+
+import gzip, json
+from doctor import profiling
+
+try:
+    import orjson    # Optional: parses several times faster than the json module
+except ImportError:
+    orjson = None
+
+COMPRESS = True         # gzip artefacts as they are written (False writes compact plain JSON)
+COMPRESS_LEVEL = 6      # 1 (fastest) to 9 (smallest)
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+# Where the artefacts are kept, relative to output/ (used by migrate.py and benchmark_storage.py)
+ARTEFACTS = [
+    "001/past/*.json",
+    "001/future/*.json",
+    "001/calibrations/*.json",
+    "002/fits/*.json",
+    "002/observations/*.json",
+    "002/calibrators/*/*/*.json",
+    "003/*/dates/*/*/*.json",
+]
+
+################################################################################
+# Encoding
+################################################################################
+
+def dumps(data, compress=None):
+    # No indentation or spaces after separators. mtime=0 keeps the bytes the same for the same data, so unchanged
+    # pages still hash the same.
+    raw = json.dumps(data, separators=(",", ":")).encode()
+    if COMPRESS if compress is None else compress:
+        return gzip.compress(raw, compresslevel=COMPRESS_LEVEL, mtime=0)
+    return raw
+
+def loads(raw):
+    # Takes gzipped or plain JSON (including pretty-printed files written before this module existed)
+    if raw[:2] == GZIP_MAGIC:
+        raw = gzip.decompress(raw)
+    if orjson is not None:
+        try:
+            return orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            pass    # orjson rejects NaN and Infinity, which the json module writes for missing gains
+    return json.loads(raw)
+
+################################################################################
+# Files (names keep their .json suffix whatever the encoding, so every glob and obs_id lookup still works)
+################################################################################
+
+def read(path):
+    with profiling.timer("read"), open(path, "rb") as f:
+        raw = f.read()
+    with profiling.timer("parse"):
+        return loads(raw)
+
+def write(path, data, compress=None):
+    # Replaces the file rather than writing over it, so a file that is also linked somewhere else (another search in 003,
+    # or a shard's tree, see shards.seed) keeps its old contents there, and nothing is ever left half written
+    with profiling.timer("dump"):
+        raw = dumps(data, compress)
+    with profiling.timer("write"):
+        tmp = path.with_name(path.name + ".tmp")
+        with open(tmp, "wb") as f:
+            f.write(raw)
+        tmp.replace(path)
+
+def write_json(path, data):
+    # Indented plain JSON, for the small files meant to be read by people too (manifests, checkpoints, cube and pipeline
+    # state). Replaced the same way as write.
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(data, f, indent=4)
+    tmp.replace(path)
+
+def is_compressed(path):
+    with open(path, "rb") as f:
+        return f.read(2) == GZIP_MAGIC
@@ -0,0 +1,155 @@
+################################################################################
+# synthetic
+# Realistic fake web service data, and a local stand-in server for it (see benchmark.py)
+################################################################################
+
+import json, hashlib, threading
+import numpy as np
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from doctor.bands import BANDS
+
+################################################################################
+# Paths and Constants
+################################################################################
+
+START = 1448582424          # First obs_id (a multiple of 8, like real ones) after 2025-12-01 00:00 UTC, so the default window of 003 and 004 covers everything
+SPAN = 31 * 24 * 3600       # All observations start within this many seconds of START
+
+TILES = [10 * row + column for row in range(1, 17) for column in range(1, 9)]    # 128 tiles, numbered 11-18, 21-28, ... 161-168
+CALIBRATORS = ["PicA", "3C444", "PKS0408", "HerA"]
+PLOT_CALIBRATOR = "HydA"    # The calibrator 003 and 004 look at by default...
+PLOT_OBSERVATIONS = 5       # ...has this many observations, however big the data set, so plotting does not swamp the benchmark
+
+PAGE_SIZE = 200             # Observations per /metadata/find page
+TEMPLATES = 64              # Distinct fits to serve (generating 100k fits of random gains would take longer than the stage being measured)
+
+################################################################################
+# Data set
+################################################################################
+
+class Dataset:
+    # `calibrations` calibration (D0006) observations, with as many other observations in between, spread evenly over SPAN.
+    # missing_fraction of the calibrations have no fit (404).
+    def __init__(self, calibrations, missing_fraction=0.05, seed=0):
+        self.calibrations = calibrations
+        self.count = 2 * calibrations
+        self.spacing = max(8, SPAN // self.count // 8 * 8)
+        self.missing_every = int(1 / missing_fraction) if missing_fraction else 0
+        self.seed = seed
+        self.templates = [self.fit_template(i) for i in range(TEMPLATES)]
+
+    def obs_id(self, index):
+        return START + index * self.spacing
+
+    def index(self, obs_id):
+        # Index of the observation, or None if obs_id is not one of them
+        index, remainder = divmod(int(obs_id) - START, self.spacing)
+        return index if remainder == 0 and 0 <= index < self.count else None
+
+    def is_calibration(self, index):
+        return index % 2 == 0
+
+    def calibrator(self, index):
+        calibration = index // 2
+        step = max(1, self.calibrations // PLOT_OBSERVATIONS)
+        if calibration % step == 0 and calibration // step < PLOT_OBSERVATIONS: return PLOT_CALIBRATOR
+        return CALIBRATORS[calibration % len(CALIBRATORS)]
+
+    def has_fit(self, index):
+        return self.is_calibration(index) and not (self.missing_every and (index // 2) % self.missing_every == 1)
+
+    ############################################################################
+    # Documents
+    ############################################################################
+
+    def page(self, page):
+        # Rows of /metadata/find (obs_id, name, creator, project, ...) for page 1, 2, ... ([] past the last page)
+        start = (page - 1) * PAGE_SIZE
+        return [[self.obs_id(i), f"obs_{i}", "benchmark", "D0006" if self.is_calibration(i) else "G0008", "", 0]
+                for i in range(max(start, 0), min(start + PAGE_SIZE, self.count))]
+
+    def observation(self, index):
+        # The parts of /metadata/obs that the scripts use, plus some of the bulk of the real thing
+        obs_id = self.obs_id(index)
+        band = list(BANDS.values())[index // 2 % len(BANDS)]
+        return {
+            "starttime": obs_id,
+            "stoptime": obs_id + 120,
+            "obsname": f"obs_{index}",
+            "metadata": {"observation_number": obs_id, "calibrators": self.calibrator(index), "project": "D0006",
+                         "ra_pointing": 139.5, "dec_pointing": -12.1, "gridpoint_name": "sweet", "gridpoint_number": 0},
+            "rfstreams": {"0": {"frequencies": band,
+                                "tileset": {"xlist": TILES, "ylist": TILES}, "azimuth": 0.0, "elevation": 90.0}},
+            "alltiledata": {str(tile): {"tile_name": f"Tile{tile:03d}", "flagged": False} for tile in TILES},
+        }
+
+    def fit_template(self, number):
+        # A /calib/get_cal_json response for 128 tiles x X/Y x 24 channels. "OBSID" is swapped for the obs_id when served.
+        rng = np.random.default_rng((self.seed, number))
+        fit = {"metadata": {"obsid": "OBSID", "version": 3}}
+        for tile in TILES:
+            fit[str(tile)] = {pol: {
+                "gains": np.round(1 + 0.1 * rng.standard_normal(24), 6).tolist(),
+                "gains_fit": np.round(1 + 0.05 * rng.standard_normal(24), 6).tolist(),
+                "phase_sigma_resid": round(float(rng.random()), 6),
+                "phase_chi2dof": round(float(rng.random() * 3), 6),
+                "phase_fit_quality": round(float(rng.random()), 6),
+            } for pol in ("X", "Y")}
+        return json.dumps(fit).encode()
+
+    def fit(self, index):
+        return self.templates[index // 2 % TEMPLATES].replace(b'"OBSID"', str(self.obs_id(index)).encode())
+
+################################################################################
+# Stand-in server
+################################################################################
+
+class Handler(BaseHTTPRequestHandler):
+    dataset = None
+    requests = None     # {endpoint: count}
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        self.requests[url.path] = self.requests.get(url.path, 0) + 1
+        index = self.dataset.index(params.get("obs_id", -1))
+
+        if url.path == "/metadata/find":
+            body = json.dumps(self.dataset.page(int(params["page"])) if params.get("future") == "0" else []).encode()
+        elif url.path == "/metadata/obs" and index is not None:
+            body = json.dumps(self.dataset.observation(index)).encode()
+        elif url.path == "/calib/get_cal_json" and index is not None and self.dataset.has_fit(index):
+            body = self.dataset.fit(index)
+        else:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        etag = '"' + hashlib.md5(body).hexdigest() + '"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+def serve(dataset, port=0):
+    # Serves dataset on 127.0.0.1 from a background thread. Returns the server (server.url is the base URL to use
+    # for MWA_WEB_SERVICE, server.requests counts requests per endpoint). Call server.shutdown() when done.
+    handler = type("DatasetHandler", (Handler,), {"dataset": dataset, "requests": {}})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    server.requests = handler.requests
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,156 @@
+################################################################################
+# trends
+# Daily and weekly summaries of every tile's gains, kept up to date from the gains cube as it grows
+################################################################################
+
+import json, warnings
+import numpy as np
+from datetime import datetime, timedelta
+from pathlib import Path
+from astropy.time import Time
+from doctor import anomaly, storage, window
+from doctor.bands import BANDS
+from doctor.cube import POLS
+
+################################################################################
+# Layout
+################################################################################
+
+# <folder>/<calibrator>/<period>/<first date>.npz, one file per day or week (starting on Monday), each holding for every
+# tile, band and polarisation seen in it (tile x band x pol):
+#   count       observations with a solution for the tile
+#   gain        median gain over those observations and every channel
+#   spread      normal-scaled median absolute deviation of the same gains
+#   chi2        median phase_chi2dof
+#   quality     median phase_fit_quality
+# <folder>/meta.json has how many rows of the cube have been summarised. Rows are only ever appended to the cube, so an
+# update only reads the rows after that, plus the rest of the days and weeks they fall in.
+PERIODS = {"daily": timedelta(days=1), "weekly": timedelta(weeks=1)}
+STATISTICS = ["count", "gain", "spread", "chi2", "quality"]
+
+def period_start(date, period):
+    day = datetime(date.year, date.month, date.day)
+    return day - timedelta(days=day.weekday()) if period == "weekly" else day
+
+################################################################################
+# Summarising
+################################################################################
+
+def summarise(data):
+    # The statistics of data (from anomaly.load) for each tile, band and polarisation
+    shape = (len(data["tiles"]), len(BANDS), len(POLS))
+    summary = {name: np.full(shape, np.nan, dtype=np.float32) for name in STATISTICS}
+    summary["count"] = np.zeros(shape, dtype=np.int32)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)    # All-NaN slices (missing tiles) are expected
+
+        for b, band in enumerate(BANDS):
+            in_band = data["bands"] == band
+            if not in_band.any(): continue
+            gains = np.moveaxis(data["gains"][in_band], 0, 2)    # tile x pol x obs x channel
+            gains = gains.reshape(*gains.shape[:2], -1)
+
+            median = np.nanmedian(gains, axis=2)
+            summary["count"][:, b] = (~np.isnan(data["gains"][in_band]).all(axis=3)).sum(axis=0)
+            summary["gain"][:, b] = median
+            summary["spread"][:, b] = 1.4826 * np.nanmedian(np.abs(gains - median[..., None]), axis=2)
+            summary["chi2"][:, b] = np.nanmedian(data["chi2"][in_band], axis=0)
+            summary["quality"][:, b] = np.nanmedian(data["quality"][in_band], axis=0)
+    return summary
+
+################################################################################
+# Store
+################################################################################
+
+class TrendStore:
+    def __init__(self, folder):
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+
+        self.meta_path = self.folder / "meta.json"
+        if self.meta_path.exists():
+            with open(self.meta_path, "r") as f:
+                self.meta = json.load(f)
+        else:
+            self.meta = {"rows": 0}
+
+    def write_meta(self):
+        # Only updated once every period touched is written, so an interrupted update is simply done again
+        storage.write_json(self.meta_path, self.meta)
+
+    def path(self, calibrator, period, start):
+        return self.folder / calibrator / period / f"{start.strftime('%Y-%m-%d')}.npz"
+
+    ############################################################################
+    # Updating
+    ############################################################################
+
+    def update(self, cube, log=print):
+        # Summarises the rows added to the cube since the last update. Returns the number of days and weeks rewritten.
+        new = np.arange(self.meta["rows"], len(cube))
+        if not len(new): return 0
+
+        # Every (calibrator, period, first date) the new rows fall in
+        dates = Time(np.asarray(cube.obs_ids[new]), format="gps").to_datetime()
+        touched = set()
+        for row, date in zip(new, dates):
+            for period in PERIODS:
+                touched.add((cube.calibrator_name(row), period, period_start(date, period)))
+        log(f"Summarising {len(new)} new observations into {len(touched)} days and weeks...")
+
+        for calibrator, period, start in sorted(touched):
+            self.write(cube, calibrator, period, start)
+
+        self.meta["rows"] = len(cube)
+        self.write_meta()
+        return len(touched)
+
+    def write(self, cube, calibrator, period, start):
+        data = anomaly.load(cube, calibrator, *window.gps_bounds(start, start + PERIODS[period]))
+        path = self.path(calibrator, period, start)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + ".tmp")
+        with open(tmp, "wb") as f:
+            np.savez(f, tiles=data["tiles"], **summarise(data))
+        tmp.replace(path)
+
+    ############################################################################
+    # Reading
+    ############################################################################
+
+    def calibrators(self):
+        return sorted(folder.name for folder in self.folder.iterdir() if folder.is_dir())
+
+    def series(self, calibrator, period="daily", start=None, end=None):
+        # The days (or weeks) with start <= first date < end, with the tiles lined up:
+        #   dates (period), tiles (tile), and each of STATISTICS (period x tile x band x pol, NaN or 0 where a tile is missing)
+        # Only the summaries are read, so a query over years of data costs one small file per day or week.
+        paths = sorted((self.folder / calibrator / period).glob("*.npz"))
+        dates = [datetime.strptime(path.stem, "%Y-%m-%d") for path in paths]
+        selected = [(date, path) for date, path in zip(dates, paths) if (start is None or date >= start) and (end is None or date < end)]
+
+        loaded = []
+        for date, path in selected:
+            with np.load(path) as f:
+                loaded.append({name: f[name] for name in f.files})
+        tiles = np.unique(np.concatenate([summary["tiles"] for summary in loaded])) if loaded else np.array([], dtype=np.int32)
+
+        series = {"dates": [date for date, _ in selected], "tiles": tiles}
+        for name in STATISTICS:
+            missing = 0 if name == "count" else np.nan
+            dtype = np.int32 if name == "count" else np.float32
+            series[name] = np.full((len(selected), len(tiles), len(BANDS), len(POLS)), missing, dtype=dtype)
+            for i, summary in enumerate(loaded):
+                series[name][i, np.searchsorted(tiles, summary["tiles"])] = summary[name]
+        return series
+
+def rolling(values, length):
+    # Median over each run of `length` periods, ending at each period (NaN until there are that many), ignoring missing ones
+    out = np.full(values.shape, np.nan, dtype=np.float32)
+    if len(values) < length: return out
+    windows = np.lib.stride_tricks.sliding_window_view(values, length, axis=0)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        out[length - 1:] = np.nanmedian(windows, axis=-1)
+    return out
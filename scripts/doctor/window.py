@@ -0,0 +1,44 @@
+################################################################################
+# window
+# Pick out the fit/observation pairs in a date range (looked up in the catalogue) without opening any of them
+################################################################################
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from astropy.time import Time
+from doctor import storage
+
+################################################################################
+# Helper functions
+################################################################################
+
+def gps_bounds(start, end):
+    # An obs_id is the GPS second the observation started, so a date range is a range of obs_ids
+    return int(Time(start).gps), int(Time(end).gps)
+
+def load(path):
+    return storage.read(path)
+
+################################################################################
+# Selecting and loading
+################################################################################
+
+def pairs(folder, obs_ids):
+    # (obs_id, fit, observation) for each of obs_ids (e.g. from Catalogue.window) that has both files in folder/{fits,observations}
+    found = [(obs_id, folder / "fits" / f"fit_{obs_id}.json", folder / "observations" / f"obs_{obs_id}.json") for obs_id in sorted(obs_ids)]
+    return [(obs_id, fit, obs) for obs_id, fit, obs in found if fit.exists() and obs.exists()]
+
+def load_pairs(selected, workers=8, load_fit=load, load_obs=load):
+    # Yields (obs_id, fit_data, obs_data) in the order of selected, loading a few pairs ahead in the background.
+    # Only about 2 * workers pairs are held in memory at once. load_fit and load_obs can read just part of each file
+    # (see documents.read_fit and documents.read_observation).
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for obs_id, fit, obs in selected:
+            pending.append((obs_id, pool.submit(load_fit, fit), pool.submit(load_obs, obs)))
+            if len(pending) >= 2 * workers:
+                obs_id, fit_data, obs_data = pending.popleft()
+                yield obs_id, fit_data.result(), obs_data.result()
+        while pending:
+            obs_id, fit_data, obs_data = pending.popleft()
+            yield obs_id, fit_data.result(), obs_data.result()
@@ -0,0 +1,96 @@
+################################################################################
+# migrate
+# Rewrite the .json artefacts of an existing output/ tree in the compact storage format
+################################################################################
+
+import argparse, os
+from collections import defaultdict
+from pathlib import Path
+from doctor import storage, logs
+from doctor.files import link
+
+################################################################################
+# Paths and Constants
+################################################################################
+
+OUTPUT = Path("output/")
+
+# Create log file
+LOGGER = logs.setup("migrate")
+log = LOGGER.info
+
+################################################################################
+# Helper functions
+################################################################################
+
+def artefacts(root):
+    # Every artefact under root, grouped by the file they are (the same fit is hard linked into 001, 002 and its
+    # calibrator folder). Symbolic links are left alone, since rewriting what they point to updates them too.
+    groups = defaultdict(list)
+    for pattern in storage.ARTEFACTS:
+        for path in root.glob(pattern):
+            if path.is_symlink(): continue
+            stat = path.stat()
+            groups[(stat.st_dev, stat.st_ino)].append(path)
+    return list(groups.values())
+
+def migrate(paths, compress):
+    # Written to a temporary file first, so an interrupted migration never leaves a half written artefact.
+    # The other names are then pointed at the new file, so the paths stay hard linked to each other.
+    data = storage.read(paths[0])
+    stat = paths[0].stat()
+    tmp = paths[0].with_name(paths[0].name + ".tmp")
+    storage.write(tmp, data, compress)
+    os.utime(tmp, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    for path in paths[1:]:
+        link(tmp, path)
+    tmp.replace(paths[0])
+    return stat.st_size, paths[0].stat().st_size
+
+################################################################################
+# Migrate every artefact that is not already in the requested format
+################################################################################
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rewrite the .json artefacts under output/ in the compact storage format.")
+    parser.add_argument("--root", type=Path, default=OUTPUT, help="output folder to migrate (default: output/)")
+    parser.add_argument("--plain", action="store_true", help="write compact uncompressed JSON instead of gzip (e.g. to undo a migration)")
+    parser.add_argument("--dry-run", action="store_true", help="only count what would be migrated")
+    args = parser.parse_args()
+
+    groups = artefacts(args.root)
+    log(f"Found {sum(len(paths) for paths in groups)} artefacts ({len(groups)} distinct files) under {args.root}.")
+
+    meter = logs.Meter("Migrate", log, total=len(groups), unit="files")
+    migrated = skipped = failed = before = after = 0
+    for paths in groups:
+        if storage.is_compressed(paths[0]) != args.plain:
+            skipped += 1
+            meter.count("skipped")
+            continue
+        if args.dry_run:
+            migrated += 1
+            before += paths[0].stat().st_size
+            meter.count("to migrate")
+            continue
+
+        try:
+            old, new = migrate(paths, not args.plain)
+        except (OSError, ValueError) as e:
+            log(f"Could not migrate {paths[0]} ({e!r}). Skipping...")
+            failed += 1
+            meter.count("failed")
+            continue
+        migrated += 1
+        before += old
+        after += new
+        meter.count("migrated", size=old)
+    meter.finish()
+
+    log(f"Skipped {skipped} files already in the requested format.")
+    if failed: log(f"Failed to migrate {failed} files.")
+    if args.dry_run:
+        log(f"Would migrate {migrated} files ({before / 1e6:.1f} MB).")
+    else:
+        log(f"Migrated {migrated} files: {before / 1e6:.1f} MB -> {after / 1e6:.1f} MB.")
+    log(f"Done!")
@@ -0,0 +1,91 @@
+################################################################################
+# run
+# Run the whole pipeline (001 to 006), skipping every step whose inputs and outputs have not changed since it last ran
+################################################################################
+
+import argparse, time
+from pathlib import Path
+from doctor import logs, profiling
+from doctor.catalogue import Catalogue, CATALOGUE
+from doctor.pipeline import Pipeline, Stage, load_script
+
+################################################################################
+# Paths and Constants
+################################################################################
+
+OUTPUT = Path("output/")
+
+OUTPUT_001 = OUTPUT / "001"
+OUTPUT_002 = OUTPUT / "002"
+
+################################################################################
+# Helper functions
+################################################################################
+
+def step(number, name, *args):
+    # The scripts are only loaded when one of their steps actually runs
+    return lambda: getattr(load_script(number), name)(*args)
+
+def failures(name):
+    # The obs_ids whose requests failed in a step and are due another try (see Catalogue.due), which it tries again
+    def failed():
+        if not CATALOGUE.exists(): return {}
+        catalogue = Catalogue()
+        try:
+            return catalogue.due(name, time.time())
+        finally:
+            catalogue.close()
+    return failed
+
+################################################################################
+# Stages, in the order they run
+################################################################################
+
+STAGES = [
+    Stage("past", step("001", "refresh_past"), outputs=[OUTPUT_001 / "past"], source=True),
+    Stage("future", step("001", "refresh_future"), outputs=[OUTPUT_001 / "future"], source=True),
+    Stage("past_csv", step("001", "combine_past"), inputs=[OUTPUT_001 / "past"], outputs=[OUTPUT_001 / "past.csv"], after=["past"]),
+    Stage("future_csv", step("001", "combine_future"), inputs=[OUTPUT_001 / "future"], outputs=[OUTPUT_001 / "future.csv"], after=["future"]),
+    Stage("calibrations", step("001", "refresh_calibs"), inputs=[OUTPUT_001 / "past.csv"], outputs=[OUTPUT_001 / "calibrations.csv"], after=["past_csv"]),
+    Stage("fits", step("001", "fetch_fits"), inputs=[OUTPUT_001 / "calibrations.csv"], outputs=[OUTPUT_001 / "calibrations"], after=["calibrations"], source=True),    # Missing fits fall due for a retry
+    Stage("metadata", step("002", "fetch_metadata"), inputs=[OUTPUT_001 / "calibrations"], outputs=[OUTPUT_002 / "observations", OUTPUT_002 / "fits"], after=["fits"], retry=failures("metadata")),
+    Stage("partition", step("002", "partition"), inputs=[OUTPUT_002 / "observations"], outputs=[OUTPUT_002 / "calibrators"], after=["metadata"]),
+    Stage("cube", step("002", "pack_cube"), inputs=[OUTPUT_002 / "observations", OUTPUT_002 / "fits"], outputs=[OUTPUT_002 / "cube"], after=["metadata"]),
+    Stage("trends", step("002", "update_trends"), inputs=[OUTPUT_002 / "cube"], outputs=[OUTPUT_002 / "trends"], after=["cube"]),
+    Stage("plots", step("003", "run", True), inputs=[OUTPUT_002 / "cube", OUTPUT_002 / "calibrators"], outputs=[OUTPUT / "003"], after=["cube", "partition"]),
+    Stage("report", step("004", "write_report"), inputs=[OUTPUT_002 / "cube"], outputs=[OUTPUT / "004"], after=["cube"]),
+    Stage("trend_plots", step("005", "plot_trends"), inputs=[OUTPUT_002 / "trends"], outputs=[OUTPUT / "005"], after=["trends"]),
+    Stage("groups", step("006", "write_groups"), inputs=[OUTPUT_002 / "cube"], outputs=[OUTPUT / "006"], after=["cube"]),
+]
+
+################################################################################
+# Run the stages asked for (all of them by default) and everything they depend on
+################################################################################
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the mwa-doctor pipeline, skipping steps that are already up to date.")
+    parser.add_argument("stages", nargs="*", help="stages to run (default: all): " + ", ".join(stage.name for stage in STAGES))
+    parser.add_argument("--force", action="store_true", help="run every stage, even if it is up to date")
+    parser.add_argument("--offline", action="store_true", help="do not fetch new pages of observations (work from what is already saved)")
+    parser.add_argument("--list", action="store_true", help="list the stages and whether they would run, without running anything")
+    parser.add_argument("--profile", choices=profiling.MODES, default=profiling.MODE or None,
+                        help="time each stage and write a report to output/runs/ (cprofile and sample also record where the time went)")
+    args = parser.parse_args()
+    profiling.MODE = args.profile or ""
+
+    # Only when run, so shard.py can import STAGES without creating run's log and output folder
+    OUTPUT.mkdir(parents=True, exist_ok=True)
+    LOGGER = logs.setup("run")
+    log = LOGGER.info
+    for name in args.stages:
+        if name not in [stage.name for stage in STAGES]: parser.error(f"unknown stage {name}")
+
+    pipeline = Pipeline(STAGES, log=log)
+
+    if args.list:
+        for stage in pipeline.plan(args.stages):
+            reason = pipeline.reason(stage, args.force, args.offline)
+            log(f"{stage.name}: {reason or 'up to date'}")
+    else:
+        pipeline.run(args.stages, args.force, args.offline)
+        log(f"Done!")
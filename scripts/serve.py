@@ -0,0 +1,157 @@
+################################################################################
+# serve
+# A local web page over the gains cube: tiles ranked by anomaly, with their plots drawn only when they are opened
+################################################################################
+
+import argparse
+from datetime import datetime, timedelta
+from html import escape
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs, urlencode
+from doctor import logs
+from doctor.diagnostics import Diagnostics, RenderCache, MAX_BYTES
+
+################################################################################
+# Paths and Constants
+################################################################################
+
+PORT = 8000
+CALIBRATOR = "HydA"     # Shown first, until another calibrator is picked on the page
+DAYS = 31               # The date range shown first ends with the calibrator's latest observation and starts this many days earlier
+
+Y_LIM = (0, 2)
+GIF_FPS = 1
+
+CUBE = Path("output/002/") / "cube"
+
+# Create log file
+LOGGER = logs.setup("serve")
+log = LOGGER.info
+
+################################################################################
+# Pages
+################################################################################
+
+PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>{title}</title>
+<style>body {{ font-family: sans-serif; }} td, th {{ padding: 2px 8px; text-align: right; }} img {{ max-width: 100%; }}</style>
+</head><body><h1>{title}</h1>{body}</body></html>"""
+
+def page(title, body):
+    return PAGE.format(title=escape(title), body=body).encode()
+
+def link(path, text, **params):
+    return f'<a href="{path}?{escape(urlencode(params))}">{escape(str(text))}</a>'
+
+class Handler(BaseHTTPRequestHandler):
+    diagnostics = None
+
+    def log_message(self, format, *args):
+        LOGGER.debug(format % args)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        routes = {
+            "/": self.index,
+            "/tile": self.tile,
+            "/plot.png": self.plot,
+            "/combined.png": self.combined,
+            "/animation.gif": self.animation,
+        }
+        if url.path not in routes: return self.send(404, "text/plain", b"Not found")
+        try:
+            routes[url.path](params)
+        except (KeyError, ValueError) as e:
+            self.send(400, "text/plain", f"Bad request ({e!r})".encode())
+
+    def send(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def window(self, params):
+        # calibrator, start and end (datetimes) from the query string, or the defaults
+        calibrator = params.get("calibrator", CALIBRATOR)
+        latest = self.diagnostics.latest(calibrator) or datetime.now()
+        end = datetime.strptime(params["end"], "%Y-%m-%d") if "end" in params else datetime.combine(latest.date(), datetime.min.time()) + timedelta(days=1)
+        start = datetime.strptime(params["start"], "%Y-%m-%d") if "start" in params else end - timedelta(days=DAYS)
+        return calibrator, start, end
+
+    ############################################################################
+    # Pages
+    ############################################################################
+
+    def index(self, params):
+        calibrator, start, end = self.window(params)
+        window = {"calibrator": calibrator, "start": start.strftime("%Y-%m-%d"), "end": end.strftime("%Y-%m-%d")}
+
+        options = "".join(f'<option{" selected" if name == calibrator else ""}>{escape(name)}</option>' for name in self.diagnostics.calibrators())
+        body = (f'<form>Calibrator <select name="calibrator">{options}</select> '
+                f'from <input name="start" value="{window["start"]}"> to <input name="end" value="{window["end"]}"> '
+                f'<input type="submit" value="Show"></form>')
+
+        # Most suspicious first (see anomaly.scores)
+        rows = "".join(f"<tr><td>{link('/tile', row['tile'], tile=row['tile'], **window)}</td><td>{row['band']}</td><td>{row['pol']}</td>"
+                       f"<td>{row['observations']}</td><td>{row['array']}</td><td>{row['history']}</td><td>{row['chi2']}</td>"
+                       f"<td>{row['missing']}</td><td><b>{row['score']}</b></td></tr>"
+                       for row in self.diagnostics.ranking(calibrator, start, end))
+        body += ("<table><tr><th>Tile</th><th>Band</th><th>Pol</th><th>Observations</th><th>Array</th><th>History</th>"
+                 f"<th>Chi2</th><th>Missing</th><th>Score</th></tr>{rows}</table>")
+        self.send(200, "text/html; charset=utf-8", page(f"{calibrator} from {window['start']} to {window['end']}", body))
+
+    def tile(self, params):
+        tile = int(params["tile"])
+        calibrator, start, end = self.window(params)
+        window = {"calibrator": calibrator, "start": start.strftime("%Y-%m-%d"), "end": end.strftime("%Y-%m-%d")}
+
+        body = f"<p>{link('/', 'All tiles', **window)}</p>"
+        body += f'<img src="/animation.gif?{escape(urlencode(dict(tile=tile, **window)))}">'
+        body += "<h2>Dates</h2><ul>" + "".join(
+            f"<li>{link('/combined.png', date, tile=tile, calibrator=calibrator, date=date)}</li>"
+            for date in self.diagnostics.dates(calibrator, start, end)) + "</ul>"
+        body += "<h2>Observations</h2><ul>" + "".join(
+            f"<li>{link('/plot.png', obs_id, tile=tile, obs_id=obs_id)} {time} {escape(band)}</li>"
+            for obs_id, time, band in self.diagnostics.observations(calibrator, start, end)) + "</ul>"
+        self.send(200, "text/html; charset=utf-8", page(f"Tile {tile}, {calibrator}", body))
+
+    ############################################################################
+    # Images
+    ############################################################################
+
+    def plot(self, params):
+        self.send(200, *self.diagnostics.tile_plot(int(params["obs_id"]), int(params["tile"])))
+
+    def combined(self, params):
+        date = datetime.strptime(params["date"], "%Y-%m-%d").date()
+        self.send(200, *self.diagnostics.combined(params["calibrator"], int(params["tile"]), date))
+
+    def animation(self, params):
+        calibrator, start, end = self.window(params)
+        self.send(200, *self.diagnostics.animation(calibrator, int(params["tile"]), start, end))
+
+################################################################################
+# Serve until interrupted
+################################################################################
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve tile diagnostics drawn on demand from the gains cube.")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: this machine only)")
+    parser.add_argument("--cache-mb", type=float, default=MAX_BYTES / 1024**2, help="size of the cache of drawn images")
+    args = parser.parse_args()
+
+    cache = RenderCache(max_bytes=int(args.cache_mb * 1024**2))
+    handler = type("DiagnosticsHandler", (Handler,), {"diagnostics": Diagnostics(CUBE, cache, Y_LIM, GIF_FPS)})
+    server = ThreadingHTTPServer((args.host, args.port), handler)
+    server.daemon_threads = True
+    log(f"Serving on http://{args.host}:{args.port}/ (Ctrl+C to stop)...")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    log(f"Render cache: {cache.summary()}.")
+    log(f"Done!")
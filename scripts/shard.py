@@ -0,0 +1,107 @@
+################################################################################
+# shard
+# Run the per-observation stages over deterministic shards of the obs_ids, in several processes here or on other
+# machines, and merge what each shard wrote back into this output tree
+################################################################################
+
+import argparse, os, subprocess, sys, time
+from pathlib import Path
+from doctor import logs, shards
+from run import STAGES
+
+################################################################################
+# Paths and Constants
+################################################################################
+
+SHARDED = ["fits", "metadata", "groups"]    # Stages that only work on each obs_id on its own (see shards.mine)
+
+TREES = Path("output/shards/")    # Where `run` builds a tree for each shard (<index>of<count>/)
+
+SCRIPT = Path(__file__).resolve()
+
+# Create log file
+LOGGER = logs.setup("shard")
+log = LOGGER.info
+
+################################################################################
+# Helper functions
+################################################################################
+
+def stages(names):
+    # The stages asked for, in the order they run
+    for name in names:
+        if name not in SHARDED: raise SystemExit(f"{name} cannot be sharded (only {', '.join(SHARDED)} can)")
+    return [stage for stage in STAGES if stage.name in names]
+
+def work(selected):
+    # Runs in a shard's tree, with shards.SHARD set
+    log(f"Running {', '.join(stage.name for stage in selected)} for shard {shards.SHARD[0]}/{shards.SHARD[1]}...")
+    for stage in selected:
+        start = time.perf_counter()
+        stage.run()
+        log(f"Finished {stage.name} in {time.perf_counter() - start:.1f}s.")
+    shards.finish(selected)
+
+def merge(trees, selected):
+    total = {}
+    for tree in trees:
+        counts = shards.merge(tree, selected, log)
+        log(f"Merged {tree}: {', '.join(f'{count} {name}' for name, count in counts.items())}.")
+        for name, count in counts.items(): total[name] = total.get(name, 0) + count
+    if total.get("conflicts"):
+        LOGGER.warning(f"{total['conflicts']} files differed from ours without belonging to the shard that wrote them, and were not merged.")
+
+################################################################################
+# Seed, work on and merge shards
+################################################################################
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run per-observation stages over shards of the obs_ids and merge the results.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    local = commands.add_parser("run", help="seed a tree for each shard, run them all in parallel here and merge them")
+    local.add_argument("stages", nargs="+", help=f"stages to run: {', '.join(SHARDED)}")
+    local.add_argument("--shards", type=int, default=os.cpu_count(), help="number of shards, each run in its own process (default: one per CPU)")
+
+    seed = commands.add_parser("seed", help="build the tree for one shard (e.g. to copy to another machine)")
+    seed.add_argument("stages", nargs="+")
+    seed.add_argument("--shard", type=shards.parse, required=True, help="index/count, e.g. 0/4 (numbered from 0)")
+    seed.add_argument("--tree", type=Path, required=True)
+
+    worker = commands.add_parser("work", help="run the stages for one shard, in its tree (the working directory)")
+    worker.add_argument("stages", nargs="+")
+    worker.add_argument("--shard", type=shards.parse, default=shards.SHARD, help="index/count (default: MWA_SHARD)")
+
+    combine = commands.add_parser("merge", help="merge finished shards' trees into this one")
+    combine.add_argument("stages", nargs="+")
+    combine.add_argument("trees", nargs="+", type=Path)
+
+    args = parser.parse_args()
+    selected = stages(args.stages)
+
+    if args.command == "seed":
+        shards.seed(args.tree, selected, log)
+
+    elif args.command == "work":
+        if args.shard is None: parser.error("--shard (or MWA_SHARD) is needed")
+        shards.SHARD = args.shard
+        work(selected)
+
+    elif args.command == "merge":
+        merge(args.trees, selected)
+
+    else:
+        trees = [TREES / f"{index}of{args.shards}" for index in range(args.shards)]
+        for tree in trees:
+            shards.seed(tree, selected, log)
+
+        log(f"Running {', '.join(args.stages)} over {args.shards} shards...")
+        start = time.perf_counter()
+        processes = [subprocess.Popen([sys.executable, str(SCRIPT), "work", *args.stages, "--shard", f"{index}/{args.shards}"], cwd=tree)
+                     for index, tree in enumerate(trees)]
+        failed = [tree for tree, process in zip(trees, processes) if process.wait() != 0]
+        log(f"Shards finished in {time.perf_counter() - start:.1f}s.")
+        if failed: LOGGER.warning(f"Not merging {len(failed)} shards that failed (run them again to retry): {', '.join(map(str, failed))}")
+
+        merge([tree for tree in trees if tree not in failed], selected)
+    log(f"Done!")